@@ -0,0 +1,75 @@
+"""
+Асинхронный фасад над database.py
+
+Чтения выполняются в небольшом пуле потоков, записи — в очереди писателя
+database.py (group commit), поэтому event loop только ждёт (await) и не
+блокируется на запросах и busy_timeout.
+
+    slots = await adb.get_available_slots(date_str, exclude_supplier=uid)
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import database as db
+from config import DB_READER_THREADS
+
+_readers = ThreadPoolExecutor(max_workers=DB_READER_THREADS, thread_name_prefix="db-read")
+
+# Функции database.py, которые пишут в БД (в т.ч. «читающие», но способные сделать UPDATE)
+WRITES = {
+    'init_database',
+    'create_user', 'update_user', 'ban_user', 'unban_user',
+    'set_user_role', 'block_user', 'unblock_user',
+    'create_parking_spot', 'get_or_create_spot', 'create_spot_availability',
+    'update_slot_times', 'delete_slot', 'delete_spot', 'merge_free_availability',
+    'create_booking', 'cancel_booking', 'confirm_booking', 'reject_booking',
+    'admin_edit_booking_hours', 'admin_toggle_slot', 'mark_booking_paid',
+    'confirm_booking_idempotent', 'decline_payment',
+    'create_review',
+    'add_to_blacklist', 'remove_from_blacklist',
+    'create_spot_notification', 'deactivate_notification',
+    'create_admin_session', 'delete_admin_session', 'log_admin_action', 'lift_expired_bans',
+    'create_slot_confirm', 'delete_slot_confirm',
+    'save_fsm_states',
+    'create_broadcast_job', 'record_broadcast_results', 'finish_broadcast_job',
+    'enqueue_notification', 'mark_notification_sent', 'mark_notification_failed',
+    'schedule_job', 'cancel_job', 'expire_unpaid_booking',
+    'retention_batch',
+}
+
+
+async def run_read(fn, *args, **kwargs):
+    """Выполняет fn в пуле читателей."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_readers, functools.partial(fn, *args, **kwargs))
+
+
+async def run_write(fn, *args, **kwargs):
+    """Ставит fn в очередь писателя (записи идут строго по очереди, коммит пачками)."""
+    return await asyncio.wrap_future(db.submit_write(fn, *args, **kwargs))
+
+
+def _wrap(name):
+    fn = getattr(db, name)
+    runner = run_write if name in WRITES else run_read
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await runner(fn, *args, **kwargs)
+    return wrapper
+
+
+def __getattr__(name):
+    # adb.<имя> → async-обёртка над database.<имя>; кэшируем в модуле
+    if name.startswith('_') or not callable(getattr(db, name, None)):
+        raise AttributeError(f"module 'adb' has no attribute {name!r}")
+    wrapper = _wrap(name)
+    globals()[name] = wrapper
+    return wrapper
+
+
+def shutdown():
+    """Дожидается текущих операций и останавливает потоки."""
+    _readers.shutdown(wait=True)
+    db.stop_writer()
@@ -1,21 +1,24 @@
 """
 Админ-панель ParkingBot
 """
-import logging, asyncio
-from datetime import datetime
+import logging
+from datetime import datetime, timedelta
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.types import FSInputFile
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
 import database as db
+import adb
+import backup
+import broadcast
+import export
+import outbox
 import os
-import sqlite3
-import tempfile
-from openpyxl import Workbook
-from config import ADMIN_PASSWORD, DATABASE_PATH
+from config import ADMIN_PASSWORD
 from keyboards import *
 from utils import *
 
@@ -27,14 +30,14 @@ class AdminStates(StatesGroup):
     waiting_ban_reason = State()
     waiting_broadcast_message = State()
     waiting_edit_hours = State()
+    waiting_export_period = State()
 
 
 # ==================== AUTH ====================
 @router.message(Command("admin"))
-async def cmd_admin(message: Message, state: FSMContext):
+async def cmd_admin(message: Message, state: FSMContext, user: dict):
     """Команда /admin"""
     await state.clear()
-    user = db.get_user_by_telegram_id(message.from_user.id)
     if not user:
         await message.answer("❌ Сначала /start"); return
     if user['role'] == 'admin':
@@ -44,9 +47,8 @@ async def cmd_admin(message: Message, state: FSMContext):
         await state.set_state(AdminStates.waiting_password)
 
 @router.message(F.text == "🔑 Админ-панель")
-async def admin_start(message: Message, state: FSMContext):
+async def admin_start(message: Message, state: FSMContext, user: dict):
     await state.clear()
-    user = db.get_user_by_telegram_id(message.from_user.id)
     if not user: return
     if user['role'] == 'admin':
         await message.answer("🔑 <b>Админ-панель</b>", reply_markup=get_admin_panel_keyboard(), parse_mode="HTML")
@@ -55,11 +57,10 @@ async def admin_start(message: Message, state: FSMContext):
         await state.set_state(AdminStates.waiting_password)
 
 @router.message(AdminStates.waiting_password)
-async def admin_password(message: Message, state: FSMContext):
+async def admin_password(message: Message, state: FSMContext, user: dict):
     if message.text == ADMIN_PASSWORD:
-        user = db.get_user_by_telegram_id(message.from_user.id)
-        db.set_user_role(user['id'], 'admin')
-        db.create_admin_session(user['id'], message.from_user.id)
+        await adb.set_user_role(user['id'], 'admin')
+        await adb.create_admin_session(user['id'], message.from_user.id)
         await state.clear()
         await message.answer("✅ Вы админ!", reply_markup=get_main_menu_keyboard(True))
         await message.answer("🔑 <b>Админ-панель</b>", reply_markup=get_admin_panel_keyboard(), parse_mode="HTML")
@@ -72,7 +73,7 @@ async def admin_password(message: Message, state: FSMContext):
 @router.callback_query(F.data == "admin_pending")
 async def admin_pending(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
-    bookings = db.get_pending_bookings()
+    bookings = await adb.get_pending_bookings()
     if not bookings:
         await callback.message.edit_text("✅ Нет ожидающих заявок.",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
@@ -90,7 +91,7 @@ async def admin_pending(callback: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data == "admin_all_bookings")
 async def admin_all_bookings(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
-    bookings = db.get_all_bookings(limit=20)
+    bookings = await adb.get_all_bookings(limit=20)
     if not bookings:
         await callback.message.edit_text("📋 Нет бронирований.",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
@@ -110,7 +111,7 @@ async def admin_all_bookings(callback: CallbackQuery, state: FSMContext):
 async def admin_booking_detail(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     bid = int(callback.data.replace("adm_bk_",""))
-    b = db.get_booking_by_id(bid)
+    b = await adb.get_booking_by_id(bid)
     if not b: await callback.message.edit_text("❌ Не найдена."); return
     s = datetime.fromisoformat(b['start_time'])
     e = datetime.fromisoformat(b['end_time'])
@@ -138,7 +139,7 @@ async def admin_booking_detail(callback: CallbackQuery, state: FSMContext):
 async def admin_confirm(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     bid = int(callback.data.replace("adm_confirm_",""))
-    ok, status = db.confirm_booking_idempotent(bid)
+    ok, status = await adb.confirm_booking_idempotent(bid)
 
     if status == 'already':
         try:
@@ -155,56 +156,49 @@ async def admin_confirm(callback: CallbackQuery, state: FSMContext):
         await callback.message.answer(f"❌ Не удалось подтвердить бронь #{bid}.")
         return
 
-    b = db.get_booking_by_id(bid)
+    b = await adb.get_booking_by_id(bid)
     await callback.message.edit_text(f"✅ Бронь #{bid} подтверждена!")
 
     # Финальное сообщение пользователю с адресом
-    try:
-        await callback.bot.send_message(
-            b['customer_telegram_id'],
-            f"🎉 <b>Всё подтверждено!</b>\n\n"
-            f"🏠 {b['spot_number']}\n"
-            f"📍 {b.get('address','')}\n"
-            f"📅 {format_datetime(b['start_time'])} — {format_datetime(b['end_time'])}\n"
-            f"💰 {b['total_price']}₽",
-            parse_mode="HTML"
-        )
-    except:
-        pass
-    db.log_admin_action('booking_confirmed', booking_id=bid)
+    await outbox.notify(
+        b['customer_telegram_id'],
+        f"🎉 <b>Всё подтверждено!</b>\n\n"
+        f"🏠 {b['spot_number']}\n"
+        f"📍 {b.get('address','')}\n"
+        f"📅 {format_datetime(b['start_time'])} — {format_datetime(b['end_time'])}\n"
+        f"💰 {b['total_price']}₽",
+        parse_mode="HTML"
+    )
+    await adb.log_admin_action('booking_confirmed', booking_id=bid)
 @router.callback_query(F.data.startswith("adm_reject_"))
 async def admin_reject(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     bid = int(callback.data.replace("adm_reject_",""))
-    b = db.get_booking_by_id(bid)
-    db.reject_booking(bid)
+    b = await adb.get_booking_by_id(bid)
+    await adb.reject_booking(bid)
     await callback.message.edit_text(f"❌ Бронь #{bid} отклонена.")
     if b:
-        try:
-            await callback.bot.send_message(b['customer_telegram_id'],
-                f"❌ <b>Бронь #{bid} отклонена.</b>\n🏠 {b['spot_number']}", parse_mode="HTML")
-        except: pass
-    db.log_admin_action('booking_rejected', booking_id=bid)
+        await outbox.notify(b['customer_telegram_id'],
+            f"❌ <b>Бронь #{bid} отклонена.</b>\n🏠 {b['spot_number']}", parse_mode="HTML")
+    await adb.log_admin_action('booking_rejected', booking_id=bid)
 
 @router.callback_query(F.data.startswith("adm_cancel_"))
 async def admin_cancel(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     bid = int(callback.data.replace("adm_cancel_",""))
-    b = db.get_booking_by_id(bid)
-    db.cancel_booking(bid)
+    b = await adb.get_booking_by_id(bid)
+    await adb.cancel_booking(bid)
     await callback.message.edit_text(f"❌ Бронь #{bid} отменена админом.")
     if b:
-        try:
-            await callback.bot.send_message(b['customer_telegram_id'],
-                f"❌ <b>Бронь #{bid} отменена администратором.</b>", parse_mode="HTML")
-        except: pass
-    db.log_admin_action('booking_cancelled_admin', booking_id=bid)
+        await outbox.notify(b['customer_telegram_id'],
+            f"❌ <b>Бронь #{bid} отменена администратором.</b>", parse_mode="HTML")
+    await adb.log_admin_action('booking_cancelled_admin', booking_id=bid)
 
 @router.callback_query(F.data.startswith("adm_edit_"))
 async def admin_edit(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     bid = int(callback.data.replace("adm_edit_",""))
-    b = db.get_booking_by_id(bid)
+    b = await adb.get_booking_by_id(bid)
     if not b: return
     s = datetime.fromisoformat(b['start_time'])
     e = datetime.fromisoformat(b['end_time'])
@@ -228,19 +222,17 @@ async def admin_edit_hours(message: Message, state: FSMContext):
         await message.answer("❌ Введите число (3 или 4.5)"); return
     data = await state.get_data()
     bid = data['edit_booking_id']
-    ok = db.admin_edit_booking_hours(bid, hours)
+    ok = await adb.admin_edit_booking_hours(bid, hours)
     await state.clear()
     if ok:
-        b = db.get_booking_by_id(bid)
+        b = await adb.get_booking_by_id(bid)
         await message.answer(f"✅ Бронь #{bid}: {hours}ч оплачено. Остаток свободен.",
                             reply_markup=get_main_menu_keyboard(True))
-        db.log_admin_action('booking_edited', booking_id=bid, details=f"paid={hours}h")
+        await adb.log_admin_action('booking_edited', booking_id=bid, details=f"paid={hours}h")
         if b:
-            try:
-                await message.bot.send_message(b['customer_telegram_id'],
-                    f"📝 <b>Бронь #{bid} обновлена.</b>\nОплачено: {hours}ч",
-                    parse_mode="HTML")
-            except: pass
+            await outbox.notify(b['customer_telegram_id'],
+                f"📝 <b>Бронь #{bid} обновлена.</b>\nОплачено: {hours}ч",
+                parse_mode="HTML")
     else:
         await message.answer("❌ Ошибка.", reply_markup=get_main_menu_keyboard(True))
 
@@ -249,7 +241,7 @@ async def admin_edit_hours(message: Message, state: FSMContext):
 @router.callback_query(F.data == "admin_slots")
 async def admin_slots(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
-    spots = db.get_all_spots()
+    spots = await adb.get_all_spots()
     if not spots:
         await callback.message.edit_text("🏠 Нет мест.",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
@@ -267,8 +259,8 @@ async def admin_slots(callback: CallbackQuery, state: FSMContext):
 async def admin_spot_detail(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     sid = int(callback.data.replace("adm_spot_",""))
-    avails = db.get_spot_availabilities(sid)
-    spot = db.get_spot_by_id(sid)
+    avails = await adb.get_spot_availabilities(sid)
+    spot = await adb.get_spot_by_id(sid)
     if not spot: return
     buttons = []
     for a in avails[:15]:
@@ -285,7 +277,7 @@ async def admin_spot_detail(callback: CallbackQuery, state: FSMContext):
 async def admin_slot_action(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     aid = int(callback.data.replace("adm_sa_",""))
-    slot = db.get_availability_by_id(aid)
+    slot = await adb.get_availability_by_id(aid)
     if not slot: return
     s = datetime.fromisoformat(slot['start_time'])
     e = datetime.fromisoformat(slot['end_time'])
@@ -298,11 +290,11 @@ async def admin_slot_action(callback: CallbackQuery, state: FSMContext):
 async def admin_toggle(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     aid = int(callback.data.replace("adm_toggle_",""))
-    new_status = db.admin_toggle_slot(aid)
+    new_status = await adb.admin_toggle_slot(aid)
     if new_status is not None:
         st = "🔴 забронированным" if new_status else "🟢 свободным"
         await callback.message.edit_text(f"✅ Слот стал {st}.")
-        db.log_admin_action('slot_toggled', details=f"slot={aid}, booked={new_status}")
+        await adb.log_admin_action('slot_toggled', details=f"slot={aid}, booked={new_status}")
     else:
         await callback.message.edit_text("❌ Слот не найден.")
 
@@ -311,7 +303,7 @@ async def admin_toggle(callback: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data == "admin_users")
 async def admin_users(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
-    users = db.get_all_users(limit=30)
+    users = await adb.get_all_users(limit=30)
     buttons = []
     for u in users:
         icon = "👑" if u['role']=='admin' else "👤"
@@ -326,7 +318,7 @@ async def admin_users(callback: CallbackQuery, state: FSMContext):
 async def admin_user_detail(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     uid = int(callback.data.replace("adm_user_",""))
-    user = db.get_user_by_id(uid)
+    user = await adb.get_user_by_id(uid)
     if not user: return
     card = f"\n💳 {user['bank']}: {user['card_number']}" if user.get('card_number') else ""
     car = ""
@@ -346,13 +338,13 @@ async def admin_user_detail(callback: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data.startswith("set_admin_"))
 async def set_admin(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
-    db.set_user_role(int(callback.data.replace("set_admin_","")), 'admin')
+    await adb.set_user_role(int(callback.data.replace("set_admin_","")), 'admin')
     await callback.message.edit_text("✅ Теперь админ.")
 
 @router.callback_query(F.data.startswith("set_user_"))
 async def set_user(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
-    db.set_user_role(int(callback.data.replace("set_user_","")), 'user')
+    await adb.set_user_role(int(callback.data.replace("set_user_","")), 'user')
     await callback.message.edit_text("✅ Теперь обычный пользователь.")
 
 @router.callback_query(F.data.startswith("ban_menu_"))
@@ -375,22 +367,20 @@ async def ban_duration(callback: CallbackQuery, state: FSMContext):
 async def ban_reason(message: Message, state: FSMContext):
     data = await state.get_data()
     reason = "" if message.text == "-" else message.text[:200]
-    db.ban_user(data['ban_user_id'], data.get('ban_hours'), reason)
+    await adb.ban_user(data['ban_user_id'], data.get('ban_hours'), reason)
     await state.clear()
-    user = db.get_user_by_id(data['ban_user_id'])
+    user = await adb.get_user_by_id(data['ban_user_id'])
     await message.answer(f"🚫 {user['full_name']} забанен.", reply_markup=get_main_menu_keyboard(True))
-    try:
-        t = "🚫 Вы заблокированы"
-        if data.get('ban_hours'): t += f" на {data['ban_hours']}ч"
-        else: t += " навсегда"
-        if reason: t += f"\n📝 {reason}"
-        await message.bot.send_message(user['telegram_id'], t)
-    except: pass
+    t = "🚫 Вы заблокированы"
+    if data.get('ban_hours'): t += f" на {data['ban_hours']}ч"
+    else: t += " навсегда"
+    if reason: t += f"\n📝 {reason}"
+    await outbox.notify(user['telegram_id'], t)
 
 @router.callback_query(F.data.startswith("unban_"))
 async def unban(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
-    db.unban_user(int(callback.data.replace("unban_","")))
+    await adb.unban_user(int(callback.data.replace("unban_","")))
     await callback.message.edit_text("✅ Разбанен.")
 
 
@@ -398,7 +388,7 @@ async def unban(callback: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data == "admin_stats")
 async def admin_stats(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
-    s = db.get_statistics()
+    s = await adb.get_statistics()
     await callback.message.edit_text(
         f"📈 <b>Статистика</b>\n\n"
         f"👥 Пользователи: {s['total_users']} (активных: {s['active_users']})\n"
@@ -426,18 +416,28 @@ async def broadcast_target(callback: CallbackQuery, state: FSMContext):
 
 @router.message(AdminStates.waiting_broadcast_message)
 async def broadcast_send(message: Message, state: FSMContext):
+    if not message.text:
+        await message.answer("❌ Нужен текст рассылки."); return
     data = await state.get_data()
-    target = data.get('broadcast_target','all')
-    users = db.get_active_users() if target == 'active' else db.get_all_users(limit=10000)
+    target = data.get('broadcast_target', 'all')
     await state.clear()
-    sent = 0; fail = 0
-    for u in users:
-        try:
-            await message.bot.send_message(u['telegram_id'], message.text)
-            sent += 1
-            if sent % 20 == 0: await asyncio.sleep(0.5)
-        except: fail += 1
-    await message.answer(f"📢 Отправлено: {sent}, ошибок: {fail}", reply_markup=get_main_menu_keyboard(True))
+    # Рассылка идёт в фоне (broadcast.py), прогресс — правками этого сообщения
+    progress = await message.answer("📢 Рассылка: подготовка…")
+    job_id = await adb.create_broadcast_job(target if target in ('all', 'active') else 'all', message.text,
+                                            message.from_user.id, progress.chat.id, progress.message_id)
+    broadcast.start(message.bot, job_id)
+    await message.answer(f"📢 Рассылка #{job_id} запущена.", reply_markup=get_main_menu_keyboard(True))
+
+@router.callback_query(F.data.startswith("bcstop_"))
+async def broadcast_stop(callback: CallbackQuery, is_admin: bool):
+    if not is_admin:
+        await callback.answer(); return
+    job_id = int(callback.data.replace("bcstop_", ""))
+    await broadcast.cancel(job_id)
+    job = await adb.get_broadcast_job(job_id)
+    await callback.answer("⏹ Остановлено")
+    await callback.message.edit_text(f"⏹ Рассылка #{job_id} остановлена\n\n"
+                                     f"Отправлено: {job['sent']}, ошибок: {job['failed']} из {job['total']}")
 
 
 # ==================== NAV ====================
@@ -451,18 +451,33 @@ async def admin_panel(callback: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data == "admin_export_db")
 async def admin_export_db(callback: CallbackQuery):
     await callback.answer()
+    # Снимок через backup API (backup.py): сам файл БД без -wal может быть неполным
+    progress = await callback.message.answer("💾 Резервная копия: снимок базы…")
+    paths = {}
     try:
-        file = FSInputFile(DATABASE_PATH)
-        await callback.message.answer_document(file, caption="💾 Резервная копия базы данных")
+        paths, report = await backup.run()
+        # основная база и архив — одним снимком, отдельными файлами
+        for role, path in paths.items():
+            caption = ("💾 Резервная копия базы данных\n" + backup.format_report(report) if role == 'main'
+                       else "🗄 Архив (тот же снимок)")
+            await callback.message.answer_document(FSInputFile(path, filename=report['names'][role]), caption=caption)
+        await progress.delete()
     except Exception as e:
-        await callback.message.answer(f"Не удалось выгрузить базу: {e}")
+        logger.error(f"Backup export failed: {e}")
+        await progress.edit_text(f"Не удалось выгрузить базу: {e}")
+    finally:
+        for path in paths.values():
+            try:
+                os.remove(path)
+            except Exception:
+                pass
 
 
 @router.callback_query(F.data.startswith("adm_pay_confirm_"))
 async def admin_pay_confirm(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     bid = int(callback.data.replace("adm_pay_confirm_", ""))
-    ok, status = db.confirm_booking_idempotent(bid)
+    ok, status = await adb.confirm_booking_idempotent(bid)
     if status == 'already':
         await callback.message.answer(f"ℹ️ Бронь #{bid} уже подтверждена.")
         return
@@ -472,78 +487,125 @@ async def admin_pay_confirm(callback: CallbackQuery, state: FSMContext):
     if not ok:
         await callback.message.answer(f"❌ Не удалось подтвердить бронь #{bid}.")
         return
-    b = db.get_booking_full(bid)
+    b = await adb.get_booking_full(bid)
     if b:
         # финальное сообщение клиенту с адресом
-        try:
-            await callback.bot.send_message(
-                b["customer_telegram_id"],
-                f"🎉 Всё подтверждено!\n\n"
-                f"🏠 {b.get('spot_number','')}\n"
-                f"📍 {b.get('address','')}\n"
-                f"📅 {b.get('start_time')} — {b.get('end_time')}\n"
-                f"💰 {b.get('total_price')}₽"
-            )
-        except:
-            pass
+        await outbox.notify(
+            b["customer_telegram_id"],
+            f"🎉 Всё подтверждено!\n\n"
+            f"🏠 {b.get('spot_number','')}\n"
+            f"📍 {b.get('address','')}\n"
+            f"📅 {b.get('start_time')} — {b.get('end_time')}\n"
+            f"💰 {b.get('total_price')}₽"
+        )
     await callback.message.answer(f"✅ Бронь #{bid} подтверждена.")
 
 @router.callback_query(F.data.startswith("adm_pay_decline_"))
 async def admin_pay_decline(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     bid = int(callback.data.replace("adm_pay_decline_", ""))
-    ok = db.decline_payment(bid)
-    b = db.get_booking_full(bid)
+    ok = await adb.decline_payment(bid)
+    b = await adb.get_booking_full(bid)
     if b:
-        try:
-            await callback.bot.send_message(
-                b["customer_telegram_id"],
-                f"❌ Оплата по брони #{bid} отклонена администратором.\n"
-                f"Проверьте чек и отправьте снова."
-            )
-        except:
-            pass
+        await outbox.notify(
+            b["customer_telegram_id"],
+            f"❌ Оплата по брони #{bid} отклонена администратором.\n"
+            f"Проверьте чек и отправьте снова."
+        )
     await callback.message.answer("Готово." if ok else "Не удалось.")
 
+# ==================== EXCEL EXPORT ====================
+# Выбор таблиц и периода хранится в FSM (xls_tables, xls_period, xls_from, xls_to)
+def _export_period(data):
+    period = data.get('xls_period', 'all')
+    if period in ('7', '30'):
+        today = now_local().date()
+        return (today - timedelta(days=int(period))).isoformat(), today.isoformat()
+    if period == 'custom':
+        return data.get('xls_from'), data.get('xls_to')
+    return None, None
+
+def _export_text(data):
+    date_from, date_to = _export_period(data)
+    period = f"{date_from or '…'} — {date_to or '…'}" if date_from or date_to else "всё время"
+    return f"📊 <b>Выгрузка в Excel</b>\n\nПериод: {period}\nОтметьте таблицы и нажмите «Выгрузить»."
+
+async def _show_export_menu(message, data, edit=True):
+    kb = get_export_keyboard(data.get('xls_tables', list(export.DEFAULT_TABLES)), data.get('xls_period', 'all'))
+    send = message.edit_text if edit else message.answer
+    await send(_export_text(data), reply_markup=kb, parse_mode="HTML")
+
 @router.callback_query(F.data == "admin_export_excel")
-async def admin_export_excel(callback: CallbackQuery):
+async def admin_export_excel(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
-    try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
+    await state.update_data(xls_tables=list(export.DEFAULT_TABLES), xls_period='all')
+    await _show_export_menu(callback.message, await state.get_data())
 
-        wb = Workbook()
-        wb.remove(wb.active)
+@router.callback_query(F.data.startswith("xls_t_"))
+async def export_toggle_table(callback: CallbackQuery, state: FSMContext):
+    await callback.answer()
+    table = callback.data.replace("xls_t_", "")
+    data = await state.get_data()
+    tables = data.get('xls_tables', list(export.DEFAULT_TABLES))
+    tables = [t for t in tables if t != table] if table in tables else tables + [table]
+    await state.update_data(xls_tables=[t for t in db.EXPORT_TABLES if t in tables])
+    await _show_export_menu(callback.message, await state.get_data())
 
-        def add_sheet(table_name: str):
-            try:
-                cur.execute(f"SELECT * FROM {table_name}")
-                rows = cur.fetchall()
-            except Exception:
-                return
-            ws = wb.create_sheet(title=table_name[:31])
-            if not rows:
-                ws.append(["(empty)"])
-                return
-            headers = rows[0].keys()
-            ws.append(list(headers))
-            for r in rows:
-                ws.append([r[h] for h in headers])
-
-        for tname in ("users", "parking_spots", "spot_availability", "bookings", "events_log"):
-            add_sheet(tname)
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx") as tmp:
-            tmp_path = tmp.name
-        wb.save(tmp_path)
-
-        file = FSInputFile(tmp_path)
-        await callback.message.answer_document(file, caption="📊 Выгрузка в Excel (.xlsx)")
+@router.callback_query(F.data.startswith("xls_p_"))
+async def export_period(callback: CallbackQuery, state: FSMContext):
+    await callback.answer()
+    period = callback.data.replace("xls_p_", "")
+    if period == 'custom':
+        await callback.message.edit_text("📅 Введите период: ДД.ММ.ГГГГ-ДД.ММ.ГГГГ (или одну дату)")
+        await state.set_state(AdminStates.waiting_export_period)
+        return
+    await state.update_data(xls_period=period)
+    await _show_export_menu(callback.message, await state.get_data())
+
+@router.message(AdminStates.waiting_export_period)
+async def export_custom_period(message: Message, state: FSMContext):
+    try:
+        parts = [datetime.strptime(p.strip(), "%d.%m.%Y").date() for p in (message.text or '').split('-')]
+        if len(parts) not in (1, 2) or parts[0] > parts[-1]:
+            raise ValueError
+    except ValueError:
+        await message.answer("❌ Формат: 01.01.2025-31.01.2025"); return
+    await state.set_state(None)
+    await state.update_data(xls_period='custom', xls_from=parts[0].isoformat(), xls_to=parts[-1].isoformat())
+    await _show_export_menu(message, await state.get_data(), edit=False)
+
+@router.callback_query(F.data == "xls_go")
+async def export_go(callback: CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    tables = data.get('xls_tables', list(export.DEFAULT_TABLES))
+    if not tables:
+        await callback.answer("Выберите хотя бы одну таблицу", show_alert=True); return
+    await callback.answer()
+    date_from, date_to = _export_period(data)
 
+    async def show_progress(p):
         try:
-            os.remove(tmp_path)
-        except Exception:
-            pass
+            await callback.message.edit_text(
+                f"📊 Выгрузка: {EXPORT_TABLE_LABELS.get(p.get('table'), p.get('table'))}\n"
+                f"Строк: {p.get('rows', 0)} из {p.get('total', '…')}")
+        except TelegramBadRequest:
+            pass   # не изменилось
+
+    await callback.message.edit_text("📊 Выгрузка: подготовка…")
+    path = None
+    try:
+        path = await export.run(tables, date_from, date_to, show_progress)
+        await callback.message.answer_document(FSInputFile(path, filename="parking_export.xlsx"),
+                                               caption="📊 Выгрузка в Excel (.xlsx)")
+        await callback.message.edit_text("✅ Выгрузка готова.")
+    except export.ExportBusy:
+        await callback.message.edit_text("⏳ Другая выгрузка ещё собирается, попробуйте позже.")
     except Exception as e:
+        logger.error(f"Excel export failed: {e}")
         await callback.message.answer(f"Не удалось выгрузить Excel: {e}")
+    finally:
+        if path:
+            try:
+                os.remove(path)
+            except Exception:
+                pass
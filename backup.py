@@ -0,0 +1,252 @@
+"""
+Резервные копии базы ParkingBot
+
+Файл БД нельзя просто скопировать: в WAL последние коммиты лежат в -wal, и
+копия получится старой или битой. Снимок делается backup API SQLite шагами
+по BACKUP_PAGES_PER_STEP страниц с паузой BACKUP_STEP_PAUSE_SECONDS между
+ними. Перед копированием на исходном соединении открывается читающая
+транзакция: все шаги видят один снимок, записи бота идут параллельно (в WAL
+читатель не блокирует писателя), а копирование не начинается заново после
+каждого чужого коммита. Пока идёт снимок, checkpoint не может дочистить WAL.
+
+Архив (ARCHIVE_DATABASE_PATH) копируется вместе с основной БД в той же
+читающей транзакции: снимок основной БД фиксируется раньше снимка архива,
+поэтому строка, перенесённая в архив между ними, окажется в обоих файлах
+(чтения убирают дубли по id), но не пропадёт.
+
+Затем снимки проверяются PRAGMA integrity_check и сжимаются (BACKUP_COMPRESSION).
+Всё это синхронно — из бота вызывается через run() в рабочем потоке.
+
+Фоновые копии (задача 'backup' планировщика, main.py) — run_generation():
+поколение — каталог <база>-ГГГГММДД-ЧЧММСС[-N] в BACKUP_DIR с копиями основной
+БД и архива, хранятся последние BACKUP_KEEP, время и размер каждого пишутся в
+admin_logs. Восстановление — restore.py (бот должен быть остановлен).
+
+    paths, report = await backup.run()
+"""
+import asyncio
+import gzip
+import logging
+import lzma
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from datetime import datetime
+
+import adb
+from config import (DATABASE_PATH, ARCHIVE_DATABASE_PATH, DB_BUSY_TIMEOUT_MS, BACKUP_PAGES_PER_STEP,
+                    BACKUP_STEP_PAUSE_SECONDS, BACKUP_COMPRESSION, BACKUP_DIR, BACKUP_KEEP)
+from utils import now_local
+
+logger = logging.getLogger(__name__)
+
+COMPRESSORS = {'gzip': ('.gz', gzip.open), 'lzma': ('.xz', lzma.open)}
+
+_lock = asyncio.Lock()
+
+
+class BackupError(Exception):
+    pass
+
+
+def _ro_uri(path):
+    return 'file:' + os.path.abspath(path) + '?mode=ro'
+
+
+def snapshot(dests, src_path=DATABASE_PATH, archive_path=ARCHIVE_DATABASE_PATH,
+             pages=BACKUP_PAGES_PER_STEP, pause=BACKUP_STEP_PAUSE_SECONDS):
+    """Копирует src_path (dests['main']) и, если задан dests['archive'], архив одним
+    согласованным снимком. Возвращает число страниц."""
+    src = sqlite3.connect(_ro_uri(src_path), uri=True, timeout=DB_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+    total = 0
+
+    def step(status, remaining, count):
+        if remaining and pause:
+            time.sleep(pause)
+
+    try:
+        if 'archive' in dests:
+            src.execute('ATTACH DATABASE ? AS archive', (_ro_uri(archive_path),))
+        src.execute('BEGIN')
+        # фиксирует снимки: сначала основной БД, потом архива
+        for schema in dests:
+            src.execute(f'SELECT 1 FROM {schema}.sqlite_master LIMIT 1').fetchall()
+        for schema, dest in dests.items():
+            dst = sqlite3.connect(dest, isolation_level=None)
+            try:
+                src.backup(dst, pages=pages, progress=step, name=schema)
+                total += dst.execute('PRAGMA page_count').fetchone()[0]
+                # снимок — один самодостаточный файл, без -wal рядом
+                dst.execute('PRAGMA journal_mode=DELETE')
+            finally:
+                dst.close()
+        src.execute('ROLLBACK')
+    finally:
+        src.close()
+    return total
+
+
+def check(path):
+    conn = sqlite3.connect(_ro_uri(path), uri=True)
+    try:
+        problems = [r[0] for r in conn.execute('PRAGMA integrity_check').fetchall()]
+    finally:
+        conn.close()
+    if problems != ['ok']:
+        raise BackupError(f'integrity_check {os.path.basename(path)}: ' + '; '.join(problems[:5]))
+
+
+def compress(path, method=BACKUP_COMPRESSION):
+    """Сжимает файл рядом с исходным (path + .gz/.xz) и удаляет исходный."""
+    if method not in COMPRESSORS:
+        return path
+    suffix, opener = COMPRESSORS[method]
+    with open(path, 'rb') as f_in, opener(path + suffix, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+    os.remove(path)
+    return path + suffix
+
+
+def create_backup(dest_dir=None, src_path=DATABASE_PATH, archive_path=ARCHIVE_DATABASE_PATH,
+                  method=BACKUP_COMPRESSION, **step):
+    """Снимок основной БД и архива (если он есть) + проверка + сжатие во временные
+    файлы в dest_dir. Возвращает ({'main'|'archive': путь}, отчёт);
+    report['names'] — имена копий для пользователя. step — pages/pause для snapshot()."""
+    started = time.monotonic()
+    sources = {'main': src_path}
+    if archive_path and os.path.exists(archive_path):
+        sources['archive'] = archive_path
+    stamp = f"{now_local(precise=True):%Y%m%d-%H%M%S}"
+    suffix = COMPRESSORS[method][0] if method in COMPRESSORS else ''
+    names, paths = {}, {}
+    try:
+        for role, src in sources.items():
+            base, ext = os.path.splitext(os.path.basename(src))
+            names[role] = f"{base}-{stamp}{ext}{suffix}"
+            fd, paths[role] = tempfile.mkstemp(prefix=f"{base}-{stamp}.", dir=dest_dir)
+            os.close(fd)
+        pages = snapshot(paths, src_path, archive_path, **step)
+        copied = time.monotonic()
+        for path in paths.values():
+            check(path)
+        checked = time.monotonic()
+        db_bytes = sum(os.path.getsize(p) for p in paths.values())
+        for role in paths:
+            paths[role] = compress(paths[role], method)
+    except Exception:
+        for path in paths.values():
+            for p in (path, *(path + s for s, _ in COMPRESSORS.values())):
+                if os.path.exists(p):
+                    os.remove(p)
+        raise
+    report = {
+        'names': names, 'stamp': stamp,
+        'pages': pages, 'db_bytes': db_bytes, 'file_bytes': sum(os.path.getsize(p) for p in paths.values()),
+        'copy_seconds': round(copied - started, 3), 'check_seconds': round(checked - copied, 3),
+        'compress_seconds': round(time.monotonic() - checked, 3),
+        'seconds': round(time.monotonic() - started, 3),
+    }
+    logger.info(f"Backup {', '.join(paths.values())}: {report}")
+    return paths, report
+
+
+async def run(**kwargs):
+    """create_backup() в рабочем потоке; одновременно делается одна копия."""
+    async with _lock:
+        return await asyncio.to_thread(create_backup, **kwargs)
+
+
+def format_report(r):
+    return (f"{r['db_bytes'] / 1e6:.1f} МБ → {r['file_bytes'] / 1e6:.1f} МБ, "
+            f"{r['seconds']:.1f} с (снимок {r['copy_seconds']:.1f}, проверка {r['check_seconds']:.1f}, "
+            f"сжатие {r['compress_seconds']:.1f})")
+
+
+# ==================== GENERATIONS ====================
+# Поколение — каталог с файлами <имя основной БД>[.gz|.xz] и <имя архива>[.gz|.xz].
+# Каталог заполняется под временным именем и переименовывается целиком: недописанное
+# поколение в список не попадает, а существующее не перезаписывается (rename каталога
+# на занятое имя не проходит — берётся следующий номер -N).
+def _generation_re(src_path=DATABASE_PATH):
+    base = os.path.splitext(os.path.basename(src_path))[0]
+    return re.compile(re.escape(base) + r'-(\d{8}-\d{6})(?:-(\d+))?$')
+
+
+def list_generations(dest_dir=BACKUP_DIR, src_path=DATABASE_PATH):
+    """Поколения в dest_dir, новые первыми: [(время снимка, каталог)]."""
+    if not os.path.isdir(dest_dir):
+        return []
+    pattern = _generation_re(src_path)
+    found = []
+    for name in os.listdir(dest_dir):
+        m = pattern.match(name)
+        if m and os.path.isdir(os.path.join(dest_dir, name)):
+            found.append((datetime.strptime(m.group(1), '%Y%m%d-%H%M%S'), int(m.group(2) or 1),
+                          os.path.join(dest_dir, name)))
+    return [(at, path) for at, _, path in sorted(found, reverse=True)]
+
+
+def generation_files(path, src_path=DATABASE_PATH, archive_path=ARCHIVE_DATABASE_PATH):
+    """{'main'|'archive': файл} поколения; archive нет, если архива на момент копии не было."""
+    files = {}
+    for role, src in (('main', src_path), ('archive', archive_path)):
+        for suffix in ('', *(s for s, _ in COMPRESSORS.values())):
+            candidate = os.path.join(path, os.path.basename(src) + suffix)
+            if os.path.exists(candidate):
+                files[role] = candidate
+    return files
+
+
+def rotate(keep=BACKUP_KEEP, dest_dir=BACKUP_DIR, src_path=DATABASE_PATH):
+    """Удаляет поколения сверх keep последних. Возвращает удалённые пути."""
+    removed = [path for _, path in list_generations(dest_dir, src_path)[keep:]]
+    for path in removed:
+        shutil.rmtree(path)
+    return removed
+
+
+def _create_generation(dest_dir, src_path=DATABASE_PATH, archive_path=ARCHIVE_DATABASE_PATH):
+    os.makedirs(dest_dir, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix='.tmp-', dir=dest_dir)
+    try:
+        paths, report = create_backup(dest_dir=tmp, src_path=src_path, archive_path=archive_path)
+        sources = {'main': src_path, 'archive': archive_path}
+        suffixes = tuple(s for s, _ in COMPRESSORS.values())
+        for role, path in paths.items():
+            suffix = os.path.splitext(path)[1] if path.endswith(suffixes) else ''
+            os.replace(path, os.path.join(tmp, os.path.basename(sources[role]) + suffix))
+        name = f"{os.path.splitext(os.path.basename(src_path))[0]}-{report['stamp']}"
+        final, n = os.path.join(dest_dir, name), 1
+        while True:
+            try:
+                os.rename(tmp, final)
+                break
+            except OSError:
+                if not os.path.exists(final):
+                    raise
+                n += 1
+                final = os.path.join(dest_dir, f"{name}-{n}")
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    report['removed'] = len(rotate(dest_dir=dest_dir, src_path=src_path))
+    return final, report
+
+
+async def run_generation(dest_dir=BACKUP_DIR):
+    """Очередное поколение фоновой копии; результат (или ошибка) — в admin_logs.
+    Возвращает (каталог, отчёт) или None, если копия не удалась."""
+    try:
+        async with _lock:
+            path, report = await asyncio.to_thread(_create_generation, dest_dir)
+    except Exception as e:
+        # без повтора: следующая попытка — в очередной срок
+        logger.error(f"Scheduled backup failed: {e}")
+        await adb.log_admin_action('backup_failed', details=str(e)[:500])
+        return None
+    await adb.log_admin_action('backup', details=f"{os.path.basename(path)}: {format_report(report)}")
+    return path, report
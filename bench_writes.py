@@ -0,0 +1,88 @@
+"""
+Замер пропускной способности записей: коммит на каждый вызов против очереди
+писателя database.py (group commit).
+
+База создаётся во временном каталоге внутри --dir (по умолчанию — текущий):
+мерить надо на том же диске, где живёт рабочая база, а не на tmpfs — на tmpfs
+fsync бесплатный, и выигрыш group commit не виден.
+
+    python bench_writes.py --ops 4000 --threads 8
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+
+def _args():
+    parser = argparse.ArgumentParser(description="Пропускная способность записей в admin_logs")
+    parser.add_argument('--ops', type=int, default=4000, help="операций в каждом режиме")
+    parser.add_argument('--threads', type=int, default=8, help="пишущих потоков")
+    parser.add_argument('--dir', default='.', help="где создать временную базу")
+    return parser.parse_args()
+
+
+def _insert(i):
+    import database as db
+    with db.get_connection() as conn:
+        conn.execute("INSERT INTO admin_logs (action_type, details) VALUES ('bench', ?)", (str(i),))
+
+
+def _threaded(call, ops, threads):
+    per = ops // threads
+
+    def worker(k):
+        for i in range(per):
+            call(k * per + i)
+
+    pool = [threading.Thread(target=worker, args=(k,)) for k in range(threads)]
+    started = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return per * threads, time.perf_counter() - started
+
+
+def main():
+    args = _args()
+    tmp = tempfile.mkdtemp(prefix='bench-writes-', dir=args.dir)
+    os.environ['DATABASE_PATH'] = os.path.join(tmp, 'bench.db')
+    os.environ.setdefault('BOT_TOKEN', '0:bench')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import database as db
+    from config import DB_GROUP_COMMIT_MAX, DB_GROUP_COMMIT_WAIT_MS
+
+    try:
+        db.init_database()
+        print(f"{os.environ['DATABASE_PATH']}: {args.ops} вставок в admin_logs, synchronous=NORMAL, "
+              f"DB_GROUP_COMMIT_MAX={DB_GROUP_COMMIT_MAX}, DB_GROUP_COMMIT_WAIT_MS={DB_GROUP_COMMIT_WAIT_MS}")
+
+        def report(name, done, seconds, commits=None):
+            line = f"  {name:<36} {done / seconds:9.0f} оп/с"
+            print(line + (f"  ({done} оп за {commits} коммитов)" if commits is not None else ""))
+
+        report(f"коммит на вызов, {args.threads} потоков", *_threaded(_insert, args.ops, args.threads))
+
+        before = db.writer_stats['commits']
+        done, seconds = _threaded(lambda i: db.write(_insert, i), args.ops, args.threads)
+        report(f"очередь писателя, {args.threads} потоков", done, seconds, db.writer_stats['commits'] - before)
+
+        before = db.writer_stats['commits']
+        started = time.perf_counter()
+        futures = [db.submit_write(_insert, i) for i in range(args.ops)]
+        for f in futures:
+            f.result()
+        report("очередь писателя, без ожидания", args.ops, time.perf_counter() - started,
+               db.writer_stats['commits'] - before)
+    finally:
+        db.stop_writer()
+        db.close_pool()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Рассылки ParkingBot
+
+Рассылка — строка broadcast_jobs и по строке broadcast_deliveries на получателя
+(database.py). Отправляют BROADCAST_WORKERS корутин с общим ограничением
+скорости (ratelimit.telegram_limiter), RetryAfter приостанавливает отправку на
+указанное Telegram время. Результаты пишутся пачками; после рестарта
+незавершённые рассылки продолжаются с неотправленных получателей (resume()).
+Между последней записанной пачкой и падением возможен повтор — не более
+нескольких секунд отправки.
+"""
+import asyncio
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import (TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest,
+                                TelegramNetworkError, TelegramServerError)
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+import adb
+from config import BROADCAST_WORKERS, BROADCAST_PROGRESS_SECONDS
+from ratelimit import telegram_limiter
+
+logger = logging.getLogger(__name__)
+
+MAX_NETWORK_RETRIES = 3
+
+_tasks = {}   # job_id -> asyncio.Task
+
+
+def start(bot: Bot, job_id):
+    task = _tasks.get(job_id)
+    if task is None or task.done():
+        _tasks[job_id] = asyncio.create_task(_run(bot, job_id))
+
+
+async def resume(bot: Bot):
+    """Продолжает рассылки, прерванные рестартом."""
+    for job in await adb.get_running_broadcast_jobs():
+        logger.info(f"Resuming broadcast #{job['id']} ({job['sent'] + job['failed']}/{job['total']})")
+        start(bot, job['id'])
+
+
+async def cancel(job_id):
+    task = _tasks.pop(job_id, None)
+    if task:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    await adb.finish_broadcast_job(job_id, 'cancelled')
+
+
+async def stop():
+    """Останавливает отправку при выключении; рассылки остаются running и продолжатся."""
+    tasks = list(_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _tasks.clear()
+
+
+async def _send(bot: Bot, telegram_id, text):
+    retries = 0
+    while True:
+        await telegram_limiter.acquire(telegram_id)
+        try:
+            await bot.send_message(telegram_id, text)
+            return 'sent', None
+        except TelegramRetryAfter as e:
+            telegram_limiter.retry_after(e.retry_after)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            retries += 1
+            if retries > MAX_NETWORK_RETRIES:
+                return 'failed', str(e)[:200]
+            await asyncio.sleep(2 ** retries)
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            return 'failed', str(e)[:200]
+        except Exception as e:
+            return 'failed', str(e)[:200]
+
+
+def _progress_keyboard(job_id):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⏹ Остановить", callback_data=f"bcstop_{job_id}")]])
+
+
+async def _show_progress(bot: Bot, job, final=False):
+    if not job or not job['progress_message_id']:
+        return
+    done = job['sent'] + job['failed']
+    head = "✅ Рассылка завершена" if final else f"📢 Рассылка #{job['id']}"
+    text = f"{head}\n\nОтправлено: {job['sent']}, ошибок: {job['failed']}, всего: {done}/{job['total']}"
+    try:
+        await bot.edit_message_text(text, chat_id=job['progress_chat_id'], message_id=job['progress_message_id'],
+                                    reply_markup=None if final else _progress_keyboard(job['id']))
+    except TelegramBadRequest:
+        pass   # не изменилось / сообщение удалено
+    except Exception as e:
+        logger.error(f"Broadcast progress edit failed: {e}")
+
+
+async def _run(bot: Bot, job_id):
+    job = await adb.get_broadcast_job(job_id)
+    if not job or job['status'] != 'running':
+        return
+    queue = asyncio.Queue(maxsize=BROADCAST_WORKERS * 4)
+    results = []
+
+    async def produce():
+        after = 0
+        while True:
+            batch = await adb.get_broadcast_recipients(job_id, after)
+            if not batch:
+                break
+            for telegram_id in batch:
+                await queue.put(telegram_id)
+            after = batch[-1]
+        for _ in range(BROADCAST_WORKERS):
+            await queue.put(None)
+
+    async def work():
+        while (telegram_id := await queue.get()) is not None:
+            status, error = await _send(bot, telegram_id, job['text'])
+            results.append((telegram_id, status, error))
+
+    async def flush():
+        if results:
+            batch = results[:]
+            del results[:]
+            await adb.record_broadcast_results(job_id, batch)
+
+    started = time.monotonic()
+    senders = asyncio.gather(produce(), *(work() for _ in range(BROADCAST_WORKERS)))
+    try:
+        while not senders.done():
+            await asyncio.wait([senders], timeout=BROADCAST_PROGRESS_SECONDS)
+            await flush()
+            await _show_progress(bot, await adb.get_broadcast_job(job_id))
+        senders.result()
+        await adb.finish_broadcast_job(job_id)
+        job = await adb.get_broadcast_job(job_id)
+        await _show_progress(bot, job, final=True)
+        logger.info(f"Broadcast #{job_id} done in {time.monotonic() - started:.1f}s: "
+                    f"sent {job['sent']}, failed {job['failed']}")
+    except Exception as e:
+        logger.error(f"Broadcast #{job_id} error: {e}")
+    finally:
+        senders.cancel()
+        await asyncio.gather(senders, return_exceptions=True)
+        await flush()
+        if _tasks.get(job_id) is asyncio.current_task():
+            del _tasks[job_id]
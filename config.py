@@ -12,6 +12,8 @@ ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "qwerty123")
 ADMIN_SESSION_HOURS = 24
 TIMEZONE = os.getenv("TIMEZONE", "Europe/Bucharest")
 BOOKING_TIMEOUT_MINUTES = int(os.getenv("BOOKING_TIMEOUT_MINUTES", "30"))
+# За сколько минут до начала брони напоминать (через запятую)
+REMINDER_OFFSETS_MINUTES = sorted({int(m) for m in os.getenv("REMINDER_OFFSETS_MINUTES", "1440,60").split(",") if m.strip()}, reverse=True)
 ADMIN_CHECK_USERNAME = os.getenv("ADMIN_CHECK_USERNAME", "@timofey_zhuravel")
 CARD_NUMBER = os.getenv("CARD_NUMBER", "")
 TIME_STEP_MINUTES = int(os.getenv("TIME_STEP_MINUTES", "15"))
@@ -22,6 +24,87 @@ AVAILABILITY_LOOKAHEAD_DAYS = int(os.getenv("AVAILABILITY_LOOKAHEAD_DAYS", "7"))
 EXPIRED_CLEANUP_DAYS = int(os.getenv("EXPIRED_CLEANUP_DAYS", "30"))
 EXPIRE_CHECK_INTERVAL_SECONDS = int(os.getenv("EXPIRE_CHECK_INTERVAL_SECONDS", "60"))
 
+# SQLite: пул соединений и PRAGMA
+# Пул ≥ DB_READER_THREADS + 1 (поток писателя database.py) + фоновые задачи в event loop
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "6"))
+DB_READER_THREADS = int(os.getenv("DB_READER_THREADS", "3"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "30000"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "8192"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+# Писатель: сколько операций максимум в одной транзакции и сколько ждать добора пачки
+DB_GROUP_COMMIT_MAX = int(os.getenv("DB_GROUP_COMMIT_MAX", "64"))
+DB_GROUP_COMMIT_WAIT_MS = float(os.getenv("DB_GROUP_COMMIT_WAIT_MS", "0"))
+# Кэш поиска свободных слотов (сбрасывается при любой записи в слоты/места)
+SEARCH_CACHE_TTL_SECONDS = int(os.getenv("SEARCH_CACHE_TTL_SECONDS", "60"))
+SEARCH_CACHE_MAX_DATES = int(os.getenv("SEARCH_CACHE_MAX_DATES", "32"))
+# Кэш строк users (get_user_by_telegram_id / get_user_by_id)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "2048"))
+USER_CACHE_TTL_SECONDS = int(os.getenv("USER_CACHE_TTL_SECONDS", "300"))
+# FSM: sqlite — состояния переживают рестарт (fsm_storage.py), memory — aiogram MemoryStorage,
+# bounded — в памяти с лимитом ключей FSM_MAX_ENTRIES и вытеснением после FSM_IDLE_TTL_SECONDS простоя
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")
+FSM_FLUSH_INTERVAL_SECONDS = float(os.getenv("FSM_FLUSH_INTERVAL_SECONDS", "2"))
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "5000"))
+FSM_MAX_ENTRIES = int(os.getenv("FSM_MAX_ENTRIES", "10000"))
+FSM_IDLE_TTL_SECONDS = int(os.getenv("FSM_IDLE_TTL_SECONDS", "86400"))
+# Сколько апдейтов обрабатывается одновременно (разные чаты; внутри чата — по очереди)
+UPDATES_CONCURRENCY = int(os.getenv("UPDATES_CONCURRENCY", "16"))
+
+# Отправка в Telegram (ratelimit.py): общий лимит бота и интервал между сообщениями в один чат
+TELEGRAM_RATE_PER_SECOND = float(os.getenv("TELEGRAM_RATE_PER_SECOND", "25"))
+TELEGRAM_CHAT_INTERVAL_SECONDS = float(os.getenv("TELEGRAM_CHAT_INTERVAL_SECONDS", "1"))
+# Рассылки (broadcast.py)
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+BROADCAST_PROGRESS_SECONDS = float(os.getenv("BROADCAST_PROGRESS_SECONDS", "3"))
+
+# Outbox уведомлений (outbox.py)
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_RETRY_BASE_SECONDS = float(os.getenv("OUTBOX_RETRY_BASE_SECONDS", "5"))
+
+# Хранение данных (retention.py): сроки в днях (0 — политика выключена), очистка пачками
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "500"))
+RETENTION_PAUSE_SECONDS = float(os.getenv("RETENTION_PAUSE_SECONDS", "0.05"))
+RETENTION_COMPLETE_BOOKINGS_DAYS = int(os.getenv("RETENTION_COMPLETE_BOOKINGS_DAYS", "30"))
+RETENTION_AVAILABILITY_DAYS = int(os.getenv("RETENTION_AVAILABILITY_DAYS", "30"))
+RETENTION_SPOT_NOTIFICATIONS_DAYS = int(os.getenv("RETENTION_SPOT_NOTIFICATIONS_DAYS", "7"))
+RETENTION_OUTBOX_DAYS = int(os.getenv("RETENTION_OUTBOX_DAYS", "7"))
+RETENTION_OUTBOX_DEAD_DAYS = int(os.getenv("RETENTION_OUTBOX_DEAD_DAYS", "30"))
+RETENTION_BROADCAST_DAYS = int(os.getenv("RETENTION_BROADCAST_DAYS", "30"))
+RETENTION_FSM_DAYS = int(os.getenv("RETENTION_FSM_DAYS", "30"))
+
+# Архив (отдельный файл SQLite, ATTACH по требованию): завершённые брони, их слоты, старые admin_logs
+ARCHIVE_DATABASE_PATH = os.getenv("ARCHIVE_DATABASE_PATH", os.path.splitext(DATABASE_PATH)[0] + "_archive.db")
+ARCHIVE_BOOKINGS_DAYS = int(os.getenv("ARCHIVE_BOOKINGS_DAYS", "30"))
+# Завершённые брони без отзыва: отзыв можно оставить, пока бронь в основной БД, поэтому
+# срок должен быть заметно больше RETENTION_COMPLETE_BOOKINGS_DAYS (когда бронь становится completed)
+ARCHIVE_UNREVIEWED_BOOKINGS_DAYS = int(os.getenv("ARCHIVE_UNREVIEWED_BOOKINGS_DAYS",
+                                                 str(RETENTION_COMPLETE_BOOKINGS_DAYS + 60)))
+ARCHIVE_ADMIN_LOGS_DAYS = int(os.getenv("ARCHIVE_ADMIN_LOGS_DAYS", "90"))
+
+# Выгрузка в Excel (export.py): строк за одно чтение курсора, период обновления прогресса
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "2000"))
+EXPORT_PROGRESS_SECONDS = float(os.getenv("EXPORT_PROGRESS_SECONDS", "3"))
+
+# Резервные копии (backup.py): снимок через backup API шагами по BACKUP_PAGES_PER_STEP страниц
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "256"))
+BACKUP_STEP_PAUSE_SECONDS = float(os.getenv("BACKUP_STEP_PAUSE_SECONDS", "0.005"))
+BACKUP_COMPRESSION = os.getenv("BACKUP_COMPRESSION", "gzip")   # gzip | lzma | none
+# Фоновые копии: каталог, интервал в минутах (0 — выключены), сколько поколений хранить
+BACKUP_DIR = os.getenv("BACKUP_DIR", os.path.join(os.path.dirname(DATABASE_PATH) or '.', "backups"))
+BACKUP_INTERVAL_MINUTES = int(os.getenv("BACKUP_INTERVAL_MINUTES", "60"))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "24"))
+
+# Получение апдейтов: polling | webhook (webhook.py, aiohttp-сервер за reverse proxy)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")   # https://host; пусто — setWebhook не вызывается
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "127.0.0.1")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+WEBHOOK_MAX_CONCURRENT = int(os.getenv("WEBHOOK_MAX_CONCURRENT", "32"))
+
 MAX_SPOTS_PER_USER = 10
 MAX_ACTIVE_BOOKINGS = 5
 MIN_ACTION_INTERVAL = 1
@@ -1,145 +1,706 @@
 """
 БД ParkingBot — SQLite + WAL
 """
-import sqlite3, json, logging, os
-from datetime import datetime, timedelta
+import sqlite3, heapq, json, logging, os, queue, threading, time, uuid
+from concurrent.futures import Future
+from collections import OrderedDict
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 from contextlib import contextmanager
-from config import DATABASE_PATH
+from config import (DATABASE_PATH, DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_BUSY_TIMEOUT_MS,
+                    DB_CACHE_SIZE_KB, DB_MMAP_SIZE, DB_GROUP_COMMIT_MAX, DB_GROUP_COMMIT_WAIT_MS,
+                    SEARCH_CACHE_TTL_SECONDS, SEARCH_CACHE_MAX_DATES, USER_CACHE_SIZE, USER_CACHE_TTL_SECONDS,
+                    BOOKING_TIMEOUT_MINUTES, TIMEZONE, REMINDER_OFFSETS_MINUTES, RETENTION_BATCH_SIZE,
+                    RETENTION_COMPLETE_BOOKINGS_DAYS, RETENTION_AVAILABILITY_DAYS,
+                    RETENTION_SPOT_NOTIFICATIONS_DAYS, RETENTION_OUTBOX_DAYS, RETENTION_OUTBOX_DEAD_DAYS,
+                    RETENTION_BROADCAST_DAYS, RETENTION_FSM_DAYS,
+                    ARCHIVE_DATABASE_PATH, ARCHIVE_BOOKINGS_DAYS, ARCHIVE_UNREVIEWED_BOOKINGS_DAYS,
+                    ARCHIVE_ADMIN_LOGS_DAYS)
 from utils import normalize_dt, now_local
 
 logger = logging.getLogger(__name__)
-_wal_set = False
 
-@contextmanager
-def get_connection():
-    global _wal_set
+# ==================== CONNECTION POOL ====================
+# Соединения живут в пуле и настраиваются один раз при открытии.
+# Вложенный get_connection() в том же потоке/задаче получает то же соединение
+# (commit делает только внешний блок) — иначе вложенная запись ждала бы
+# busy_timeout на собственной блокировке.
+_pool = queue.LifoQueue()
+_pool_lock = threading.Lock()
+_pool_created = 0
+_current_conn = ContextVar('db_current_conn', default=None)
+
+def _open_connection():
     os.makedirs(os.path.dirname(DATABASE_PATH) or '.', exist_ok=True)
-    conn = sqlite3.connect(DATABASE_PATH, timeout=30)
+    conn = sqlite3.connect(DATABASE_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
     conn.row_factory = sqlite3.Row
-    if not _wal_set:
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT_MS)}")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{int(DB_CACHE_SIZE_KB)}")
+    conn.execute(f"PRAGMA mmap_size={int(DB_MMAP_SIZE)}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA foreign_keys=ON")
+    return conn
+
+def _acquire():
+    global _pool_created
+    try:
+        return _pool.get_nowait()
+    except queue.Empty:
+        pass
+    with _pool_lock:
+        if _pool_created < DB_POOL_SIZE:
+            _pool_created += 1
+            try:
+                return _open_connection()
+            except Exception:
+                _pool_created -= 1
+                raise
+    try:
+        return _pool.get(timeout=DB_POOL_TIMEOUT)
+    except queue.Empty:
+        raise sqlite3.OperationalError(f"DB pool exhausted ({DB_POOL_SIZE} connections, {DB_POOL_TIMEOUT}s)")
+
+def _release(conn, broken=False):
+    global _pool_created
+    if broken:
+        with _pool_lock:
+            _pool_created -= 1
+        try: conn.close()
+        except Exception: pass
+        return
+    _pool.put(conn)
+
+def close_pool():
+    """Закрывает все свободные соединения пула (при остановке бота)."""
+    global _pool_created
+    while True:
         try:
-            conn.execute("PRAGMA journal_mode=WAL")
-            conn.execute("PRAGMA busy_timeout=30000")
-            _wal_set = True
-        except: pass
+            conn = _pool.get_nowait()
+        except queue.Empty:
+            break
+        with _pool_lock:
+            _pool_created -= 1
+        try: conn.close()
+        except Exception: pass
+
+@contextmanager
+def get_connection():
+    outer = _current_conn.get()
+    if outer is not None:
+        yield outer
+        return
+    conn = _acquire()
+    token = _current_conn.set(conn)
+    changes = set()
+    ctoken = _changes.set(changes)
+    broken = False
     try:
         yield conn
         conn.commit()
     except Exception as e:
-        conn.rollback()
+        try:
+            conn.rollback()
+        except Exception:
+            broken = True
         logger.error(f"DB error: {e}")
         raise
     finally:
+        _current_conn.reset(token)
+        _changes.reset(ctoken)
+        _apply_changes(changes)
+        if conn.in_transaction:
+            # Незавершённая транзакция (например, GeneratorExit) — не отдаём соединение в пул
+            broken = True
+        _release(conn, broken)
+
+@contextmanager
+def get_readonly_connection(archive=False):
+    """Отдельное read-only соединение для отчётов/выгрузок.
+
+    mode=ro + query_only, весь блок — одна читающая транзакция: в WAL она видит
+    один снимок БД и не мешает писателям (create_booking, expire_unpaid_booking).
+    archive=True — с подключённым архивом (схема archive), если он уже создан.
+    """
+    uri = 'file:' + os.path.abspath(DATABASE_PATH) + '?mode=ro'
+    conn = sqlite3.connect(uri, uri=True, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                           isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    try:
+        if archive and os.path.exists(ARCHIVE_DATABASE_PATH):
+            conn.execute("ATTACH DATABASE ? AS archive",
+                         ('file:' + os.path.abspath(ARCHIVE_DATABASE_PATH) + '?mode=ro',))
+        conn.execute("PRAGMA query_only=1")
+        conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT_MS)}")
+        conn.execute("BEGIN")
+        # Снимок фиксируется первым чтением, а не BEGIN
+        conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+        yield conn
+    finally:
+        try:
+            conn.execute("ROLLBACK")
+        except Exception:
+            pass
         conn.close()
 
+
+def _begin_immediate(conn):
+    """BEGIN IMMEDIATE, если транзакция ещё не открыта (внутри группы писателя уже открыта)."""
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+
+
+# ==================== CHANGE TRACKING ====================
+# Записи отмечают, какие кэши они делают неактуальными; кэши сбрасываются
+# после COMMIT внешнего блока, чтобы читатель не закэшировал старые данные
+# под новой версией.
+_changes = ContextVar('db_changes', default=None)
+_availability_version = 0
+_version_lock = threading.Lock()
+
+def _apply_changes(changes):
+    _invalidate_caches(changes)
+    _notify_changes(changes)
+
+def _invalidate_caches(changes):
+    # Только память процесса: до того, как писатель отдаст результат, чтобы
+    # вызывающий сразу после await не прочитал старый кэш
+    if 'availability' in changes:
+        _bump_availability_version()
+    if 'users' in changes:
+        invalidate_user_cache()
+    else:
+        for tag in changes:
+            if isinstance(tag, tuple) and tag[0] == 'user':
+                invalidate_user_cache(tag[1])
+
+def _notify_changes(changes):
+    # Перечитывание банов и слушатели (outbox, планировщик) ходят в БД и в event
+    # loop и могут упасть; данные уже закоммичены, поэтому ошибка только логируется
+    bans = [tag[1] for tag in changes if isinstance(tag, tuple) and tag[0] == 'ban']
+    jobs = [tag[1:] for tag in changes if isinstance(tag, tuple) and tag[0] == 'job']
+    hooks = []
+    if bans:
+        hooks.append(('ban reload', _reload_bans, (bans,)))
+    if 'outbox' in changes and _outbox_listener:
+        hooks.append(('outbox listener', _outbox_listener, ()))
+    if jobs and _job_listener:
+        hooks.append(('job listener', _job_listener, (jobs,)))
+    for name, fn, args in hooks:
+        try:
+            fn(*args)
+        except Exception as e:
+            logger.error(f"After-commit {name} failed: {e}")
+
+def _mark(tag):
+    changes = _changes.get()
+    if changes is None:
+        _apply_changes({tag})
+    else:
+        changes.add(tag)
+
+def mark_availability_changed():
+    """Текущая транзакция меняет spot_availability/parking_spots/пользователей из выдачи поиска."""
+    _mark('availability')
+
+def mark_user_changed(user_id=None):
+    """Текущая транзакция меняет строку users (None — любые строки)."""
+    _mark('users' if user_id is None else ('user', user_id))
+
+def _bump_availability_version():
+    global _availability_version
+    with _version_lock:
+        _availability_version += 1
+        _slots_cache.clear()
+
+def availability_version():
+    return _availability_version
+
+
+# ==================== WRITER (group commit) ====================
+# Один поток-писатель забирает операции из очереди и выполняет пачку
+# в одной транзакции: каждая операция — в своём SAVEPOINT, чтобы ошибка
+# одной не откатывала остальные. Результаты/исключения отдаются в Future
+# только после COMMIT.
+_write_queue = queue.Queue()
+_writer_thread = None
+_writer_lock = threading.Lock()
+_STOP = object()
+writer_stats = {'ops': 0, 'commits': 0, 'failed': 0}
+
+def submit_write(fn, *args, **kwargs):
+    """Ставит fn(*args, **kwargs) в очередь писателя. Возвращает concurrent.futures.Future."""
+    global _writer_thread
+    fut = Future()
+    with _writer_lock:
+        if _writer_thread is None or not _writer_thread.is_alive():
+            _writer_thread = threading.Thread(target=_writer_loop, name="db-writer", daemon=True)
+            _writer_thread.start()
+        _write_queue.put((fn, args, kwargs, fut))
+    return fut
+
+def write(fn, *args, **kwargs):
+    """Синхронный вариант submit_write: ждёт результат."""
+    return submit_write(fn, *args, **kwargs).result()
+
+def stop_writer(timeout=None):
+    """Дописывает очередь и останавливает поток писателя."""
+    global _writer_thread
+    with _writer_lock:
+        t = _writer_thread
+        _writer_thread = None
+        if t is None:
+            return
+        _write_queue.put(_STOP)
+    t.join(timeout)
+
+def _collect_batch(first):
+    batch = [first]
+    deadline = time.monotonic() + DB_GROUP_COMMIT_WAIT_MS / 1000
+    while len(batch) < DB_GROUP_COMMIT_MAX:
+        try:
+            left = deadline - time.monotonic()
+            item = _write_queue.get(timeout=left) if left > 0 else _write_queue.get_nowait()
+        except queue.Empty:
+            break
+        batch.append(item)
+        if item is _STOP:
+            break
+    return batch
+
+def _writer_loop():
+    stop = False
+    while not stop:
+        batch = _collect_batch(_write_queue.get())
+        if batch[-1] is _STOP:
+            stop = True
+            batch.pop()
+        batch = [op for op in batch if op[3].set_running_or_notify_cancel()]
+        if not batch:
+            continue
+        try:
+            _run_batch(batch)
+        except Exception as e:
+            # Поток писателя один: неожиданная ошибка пачки не должна его остановить
+            logger.error(f"DB writer crashed on a batch: {e}")
+            for *_, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+
+def _run_batch(batch):
+    try:
+        conn = _acquire()
+    except Exception as e:
+        for *_, fut in batch:
+            fut.set_exception(e)
+        return
+    token = _current_conn.set(conn)
+    changes = set()
+    ctoken = _changes.set(changes)
+    results = []
+    error = None
+    broken = False
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        for fn, args, kwargs, fut in batch:
+            conn.execute("SAVEPOINT op")
+            try:
+                res = fn(*args, **kwargs)
+            except Exception as e:
+                conn.execute("ROLLBACK TO op")
+                conn.execute("RELEASE op")
+                logger.error(f"DB error: {e}")
+                results.append((fut, False, e))
+            else:
+                conn.execute("RELEASE op")
+                results.append((fut, True, res))
+        conn.commit()
+    except Exception as e:
+        logger.error(f"DB writer batch failed: {e}")
+        try:
+            conn.rollback()
+        except Exception:
+            broken = True
+        error = e
+    finally:
+        _current_conn.reset(token)
+        _changes.reset(ctoken)
+        _release(conn, broken or conn.in_transaction)
+    if error is not None:
+        for *_, fut in batch:
+            if not fut.done():
+                fut.set_exception(error)
+        writer_stats['failed'] += len(batch)
+        return
+    writer_stats['ops'] += len(batch)
+    writer_stats['commits'] += 1
+    try:
+        _invalidate_caches(changes)
+    finally:
+        for fut, ok, val in results:
+            if ok: fut.set_result(val)
+            else: fut.set_exception(val)
+    _notify_changes(changes)
+
+
 def _log(cursor, action, user_id=None, spot_id=None, booking_id=None, details=None):
     try:
         cursor.execute('INSERT INTO admin_logs (action_type,user_id,spot_id,booking_id,details) VALUES (?,?,?,?,?)',
                        (action, user_id, spot_id, booking_id, details))
     except: pass
 
+# ==================== MIGRATIONS ====================
+# Схема версионируется через PRAGMA user_version: шаг N применяется, если
+# user_version < N. Все недостающие шаги идут в одной транзакции; если схема
+# актуальна, init_database только читает user_version.
+# Новые изменения схемы — только новым шагом в конце MIGRATIONS.
+
+def _columns(c, table):
+    return {r[1] for r in c.execute(f"PRAGMA table_info({table})").fetchall()}
+
+def _add_columns(c, table, cols):
+    have = _columns(c, table)
+    for col, typ in cols:
+        if col not in have:
+            c.execute(f"ALTER TABLE {table} ADD COLUMN {col} {typ}")
+
+def _m001_base_schema(c):
+    """Базовые таблицы. Идемпотентно: старые БД (user_version=0) уже могут их иметь."""
+    c.execute('''CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        telegram_id INTEGER UNIQUE NOT NULL,
+        username TEXT, full_name TEXT NOT NULL, phone TEXT NOT NULL,
+        card_number TEXT DEFAULT '', bank TEXT DEFAULT '',
+        license_plate TEXT DEFAULT '', car_brand TEXT DEFAULT '', car_color TEXT DEFAULT '',
+        role TEXT DEFAULT 'user', is_active INTEGER DEFAULT 1,
+        banned_until TEXT DEFAULT NULL, ban_reason TEXT DEFAULT '',
+        balance REAL DEFAULT 0, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    _add_columns(c, 'users', [('license_plate', "TEXT DEFAULT ''"), ('car_brand', "TEXT DEFAULT ''"),
+                              ('car_color', "TEXT DEFAULT ''"), ('banned_until', 'TEXT DEFAULT NULL'),
+                              ('ban_reason', "TEXT DEFAULT ''")])
+
+    c.execute('''CREATE TABLE IF NOT EXISTS parking_spots (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        supplier_id INTEGER NOT NULL, spot_number TEXT NOT NULL,
+        address TEXT, description TEXT, price_per_hour REAL NOT NULL DEFAULT 0,
+        is_available INTEGER DEFAULT 1,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (supplier_id) REFERENCES users(id))''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS spot_availability (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        spot_id INTEGER NOT NULL,
+        start_time TIMESTAMP NOT NULL, end_time TIMESTAMP NOT NULL,
+        is_booked INTEGER DEFAULT 0, booked_by INTEGER, booking_id INTEGER,
+        FOREIGN KEY (spot_id) REFERENCES parking_spots(id))''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS bookings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        customer_id INTEGER NOT NULL, spot_id INTEGER NOT NULL,
+        availability_id INTEGER,
+        start_time TIMESTAMP NOT NULL, end_time TIMESTAMP NOT NULL,
+        total_price REAL NOT NULL,
+        status TEXT DEFAULT 'pending', payment_status TEXT DEFAULT 'unpaid',
+        reviewed INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (customer_id) REFERENCES users(id))''')
+    _add_columns(c, 'bookings', [('reviewed', 'INTEGER DEFAULT 0')])
+
+    c.execute('''CREATE TABLE IF NOT EXISTS spot_notifications (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL, spot_id INTEGER,
+        desired_date DATE, start_time TIME, end_time TIME,
+        notify_any INTEGER DEFAULT 1, is_active INTEGER DEFAULT 1,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS admin_sessions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL, telegram_id INTEGER NOT NULL,
+        session_start TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS admin_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        action_type TEXT NOT NULL, user_id INTEGER, spot_id INTEGER,
+        booking_id INTEGER, details TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS reviews (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        booking_id INTEGER NOT NULL UNIQUE,
+        reviewer_id INTEGER NOT NULL, spot_id INTEGER NOT NULL,
+        supplier_id INTEGER NOT NULL,
+        rating INTEGER NOT NULL CHECK(rating BETWEEN 1 AND 5),
+        comment TEXT DEFAULT '',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS user_blacklist (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL, blocked_user_id INTEGER NOT NULL,
+        reason TEXT DEFAULT '', created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(user_id, blocked_user_id))''')
+
+    for idx in [
+        'CREATE INDEX IF NOT EXISTS idx_u_tg ON users(telegram_id)',
+        'CREATE INDEX IF NOT EXISTS idx_sp_sup ON parking_spots(supplier_id)',
+        'CREATE INDEX IF NOT EXISTS idx_bk_cust ON bookings(customer_id)',
+        'CREATE INDEX IF NOT EXISTS idx_bk_st ON bookings(status)',
+    ]: c.execute(idx)
+
+def _m002_search_indexes(c):
+    """Составные/частичные индексы поиска слотов вместо одиночных spot_id/is_booked."""
+    for idx in [
+        'DROP INDEX IF EXISTS idx_sa_sp',
+        'DROP INDEX IF EXISTS idx_sa_bk',
+        'CREATE INDEX IF NOT EXISTS idx_sa_spot_end ON spot_availability(spot_id, end_time, start_time)',
+        'CREATE INDEX IF NOT EXISTS idx_sa_free_end ON spot_availability(end_time, start_time) WHERE is_booked=0',
+        'CREATE INDEX IF NOT EXISTS idx_sa_free_start ON spot_availability(start_time) WHERE is_booked=0',
+    ]: c.execute(idx)
+
+def _m003_slot_confirms(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS slot_confirms (
+        id TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        spot_number TEXT NOT NULL,
+        start_time TEXT NOT NULL,
+        end_time TEXT NOT NULL,
+        price REAL NOT NULL,
+        created_at TEXT NOT NULL)''')
+
+def _m004_rating_aggregates(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS rating_aggregates (
+        kind TEXT NOT NULL CHECK(kind IN ('spot','supplier')),
+        target_id INTEGER NOT NULL,
+        rating_sum INTEGER NOT NULL DEFAULT 0,
+        rating_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (kind, target_id)) WITHOUT ROWID''')
+    _rebuild_rating_aggregates(c)
+
+def _m005_fsm_states(c):
+    """Состояния FSM (fsm_storage.SQLiteStorage): ключ bot:chat:user:thread:destiny."""
+    c.execute('''CREATE TABLE IF NOT EXISTS fsm_states (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT NOT NULL DEFAULT '{}',
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP) WITHOUT ROWID''')
+
+def _m006_broadcasts(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS broadcast_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        target TEXT NOT NULL,
+        text TEXT NOT NULL,
+        admin_telegram_id INTEGER,
+        progress_chat_id INTEGER,
+        progress_message_id INTEGER,
+        status TEXT NOT NULL DEFAULT 'running' CHECK(status IN ('running','done','cancelled')),
+        total INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        finished_at TIMESTAMP)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+        job_id INTEGER NOT NULL REFERENCES broadcast_jobs(id) ON DELETE CASCADE,
+        telegram_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending' CHECK(status IN ('pending','sent','failed')),
+        error TEXT,
+        PRIMARY KEY (job_id, telegram_id)) WITHOUT ROWID''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_bd_pending ON broadcast_deliveries(job_id, telegram_id) WHERE status='pending'")
+
+def _m007_notification_outbox(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS notification_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        parse_mode TEXT,
+        reply_markup TEXT,
+        status TEXT NOT NULL DEFAULT 'pending' CHECK(status IN ('pending','sent','dead')),
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at TEXT NOT NULL,
+        last_error TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        sent_at TIMESTAMP)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON notification_outbox(next_attempt_at) WHERE status='pending'")
+
+def _m008_scheduled_jobs(c):
+    """Отложенные задачи (scheduler.py) и задачи для уже существующих броней/банов.
+    Напоминания ставит _m009_reminder_ledger."""
+    c.execute('''CREATE TABLE IF NOT EXISTS scheduled_jobs (
+        kind TEXT NOT NULL,
+        ref_id INTEGER NOT NULL,
+        run_at TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (kind, ref_id)) WITHOUT ROWID''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_run_at ON scheduled_jobs(run_at)')
+    jobs = []
+    tz = ZoneInfo(TIMEZONE)
+    timeout = timedelta(minutes=BOOKING_TIMEOUT_MINUTES)
+    # created_at — CURRENT_TIMESTAMP (UTC), сроки задач — локальное время TIMEZONE
+    for r in c.execute("SELECT id, created_at FROM bookings WHERE status='pending' AND payment_status='unpaid'"):
+        created = datetime.fromisoformat(r['created_at']).replace(tzinfo=timezone.utc).astimezone(tz)
+        jobs.append(('booking_expire', r['id'], _ts(created.replace(tzinfo=None) + timeout)))
+    # banned_until до этой версии писался по часам сервера (datetime.now()), дальше
+    # пишется и сравнивается в TIMEZONE — переводим один раз, на смене версии
+    for r in c.execute("SELECT id, banned_until FROM users WHERE banned_until IS NOT NULL").fetchall():
+        until = datetime.fromisoformat(r['banned_until']).astimezone(tz).replace(tzinfo=None)
+        c.execute('UPDATE users SET banned_until=? WHERE id=?', (_ts(until), r['id']))
+    for r in c.execute("SELECT id, banned_until FROM users WHERE is_active=0 AND banned_until IS NOT NULL"):
+        jobs.append(('unban', r['id'], r['banned_until']))
+    c.executemany('INSERT OR IGNORE INTO scheduled_jobs (kind, ref_id, run_at) VALUES (?,?,?)', jobs)
+
+def _m009_reminder_ledger(c):
+    """Журнал напоминаний: (бронь, отступ) попадает сюда в транзакции, ставящей
+    напоминание в outbox, — каждое напоминание уходит один раз."""
+    c.execute('''CREATE TABLE IF NOT EXISTS booking_reminders (
+        booking_id INTEGER NOT NULL,
+        offset_minutes INTEGER NOT NULL,
+        sent_at TIMESTAMP,
+        PRIMARY KEY (booking_id, offset_minutes)) WITHOUT ROWID''')
+    # (status) покрывается префиксом нового индекса
+    c.execute('DROP INDEX IF EXISTS idx_bk_st')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_bk_status_start ON bookings(status, start_time)')
+    c.execute("DELETE FROM scheduled_jobs WHERE kind='booking_reminder'")
+    # Прошедшие сроки у уже подтверждённых броней не досылаем
+    now = now_local(precise=True)
+    for offset in REMINDER_OFFSETS_MINUTES:
+        c.execute('''INSERT OR IGNORE INTO booking_reminders (booking_id, offset_minutes)
+            SELECT id, ? FROM bookings WHERE status='confirmed' AND start_time > ? AND start_time <= ?''',
+            (offset, _ts(now), _ts(now + timedelta(minutes=offset))))
+    c.execute("INSERT OR REPLACE INTO scheduled_jobs (kind, ref_id, run_at) VALUES ('reminders', 0, ?)",
+              (_ts(now),))
+
+MIGRATIONS = [
+    (1, _m001_base_schema),
+    (2, _m002_search_indexes),
+    (3, _m003_slot_confirms),
+    (4, _m004_rating_aggregates),
+    (5, _m005_fsm_states),
+    (6, _m006_broadcasts),
+    (7, _m007_notification_outbox),
+    (8, _m008_scheduled_jobs),
+    (9, _m009_reminder_ledger),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
 def init_database():
     with get_connection() as conn:
+        if schema_version(conn) >= SCHEMA_VERSION:
+            return
+        _begin_immediate(conn)
+        # Перечитываем под блокировкой: другой процесс мог уже мигрировать
+        current = schema_version(conn)
         c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            telegram_id INTEGER UNIQUE NOT NULL,
-            username TEXT, full_name TEXT NOT NULL, phone TEXT NOT NULL,
-            card_number TEXT DEFAULT '', bank TEXT DEFAULT '',
-            license_plate TEXT DEFAULT '', car_brand TEXT DEFAULT '', car_color TEXT DEFAULT '',
-            role TEXT DEFAULT 'user', is_active INTEGER DEFAULT 1,
-            banned_until TEXT DEFAULT NULL, ban_reason TEXT DEFAULT '',
-            balance REAL DEFAULT 0, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-
-        for col, typ in [('license_plate','TEXT DEFAULT ""'),('car_brand','TEXT DEFAULT ""'),
-                         ('car_color','TEXT DEFAULT ""'),('banned_until','TEXT DEFAULT NULL'),
-                         ('ban_reason','TEXT DEFAULT ""')]:
-            try: c.execute(f"ALTER TABLE users ADD COLUMN {col} {typ}")
-            except: pass
-
-        c.execute('''CREATE TABLE IF NOT EXISTS parking_spots (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            supplier_id INTEGER NOT NULL, spot_number TEXT NOT NULL,
-            address TEXT, description TEXT, price_per_hour REAL NOT NULL DEFAULT 0,
-            is_available INTEGER DEFAULT 1,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (supplier_id) REFERENCES users(id))''')
-
-        c.execute('''CREATE TABLE IF NOT EXISTS spot_availability (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            spot_id INTEGER NOT NULL,
-            start_time TIMESTAMP NOT NULL, end_time TIMESTAMP NOT NULL,
-            is_booked INTEGER DEFAULT 0, booked_by INTEGER, booking_id INTEGER,
-            FOREIGN KEY (spot_id) REFERENCES parking_spots(id))''')
-
-        c.execute('''CREATE TABLE IF NOT EXISTS bookings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            customer_id INTEGER NOT NULL, spot_id INTEGER NOT NULL,
-            availability_id INTEGER,
-            start_time TIMESTAMP NOT NULL, end_time TIMESTAMP NOT NULL,
-            total_price REAL NOT NULL,
-            status TEXT DEFAULT 'pending', payment_status TEXT DEFAULT 'unpaid',
-            reviewed INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (customer_id) REFERENCES users(id))''')
-        try: c.execute("ALTER TABLE bookings ADD COLUMN reviewed INTEGER DEFAULT 0")
-        except: pass
-
-        c.execute('''CREATE TABLE IF NOT EXISTS spot_notifications (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL, spot_id INTEGER,
-            desired_date DATE, start_time TIME, end_time TIME,
-            notify_any INTEGER DEFAULT 1, is_active INTEGER DEFAULT 1,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-
-        c.execute('''CREATE TABLE IF NOT EXISTS admin_sessions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL, telegram_id INTEGER NOT NULL,
-            session_start TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-
-        c.execute('''CREATE TABLE IF NOT EXISTS admin_logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            action_type TEXT NOT NULL, user_id INTEGER, spot_id INTEGER,
-            booking_id INTEGER, details TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-
-        c.execute('''CREATE TABLE IF NOT EXISTS reviews (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            booking_id INTEGER NOT NULL UNIQUE,
-            reviewer_id INTEGER NOT NULL, spot_id INTEGER NOT NULL,
-            supplier_id INTEGER NOT NULL,
-            rating INTEGER NOT NULL CHECK(rating BETWEEN 1 AND 5),
-            comment TEXT DEFAULT '',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-
-        c.execute('''CREATE TABLE IF NOT EXISTS user_blacklist (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL, blocked_user_id INTEGER NOT NULL,
-            reason TEXT DEFAULT '', created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(user_id, blocked_user_id))''')
-
-        for idx in [
-            'CREATE INDEX IF NOT EXISTS idx_u_tg ON users(telegram_id)',
-            'CREATE INDEX IF NOT EXISTS idx_sp_sup ON parking_spots(supplier_id)',
-            'CREATE INDEX IF NOT EXISTS idx_sa_sp ON spot_availability(spot_id)',
-            'CREATE INDEX IF NOT EXISTS idx_sa_bk ON spot_availability(is_booked)',
-            'CREATE INDEX IF NOT EXISTS idx_bk_cust ON bookings(customer_id)',
-            'CREATE INDEX IF NOT EXISTS idx_bk_st ON bookings(status)',
-        ]: c.execute(idx)
-        logger.info("Database initialized")
+        for version, step in MIGRATIONS:
+            if version <= current:
+                continue
+            step(c)
+            logger.info(f"Migration {version}: {step.__name__}")
+        c.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+        for name, detail in check_query_plans(conn):
+            logger.warning(f"Query plan regression: {name}: {detail}")
+        logger.info(f"Database initialized (schema {current} -> {SCHEMA_VERSION})")
+
+
+# ==================== QUERY PLANS ====================
+# Горячие запросы и таблицы, которые они не должны сканировать целиком.
+# Проверяются те же SQL-константы, что выполняют функции; check_query_plans()
+# вызывается при init_database и в tests/test_query_plans.py.
+_TS = '2000-01-01 00:00:00'
+
+def hot_queries():
+    """{имя: (псевдонимы защищённых таблиц, sql, параметры)}."""
+    return {
+        'available_slots_by_date': ({'sa'}, _AVAILABLE_SLOTS_SQL + _AVAILABLE_SLOTS_DAY_SQL + _AVAILABLE_SLOTS_ORDER_SQL,
+                                    (_TS, _TS, _TS)),
+        'available_slots_all': ({'sa'}, _AVAILABLE_SLOTS_SQL + _AVAILABLE_SLOTS_ORDER_SQL, (_TS,)),
+        'slot_overlap': ({'spot_availability'}, _SLOT_OVERLAP_SQL, (1, _TS, _TS, _TS)),
+        'nearest_free_slots': ({'sa'}, _NEAREST_FREE_SLOTS_SQL, (_TS, _TS, 10)),
+        'spot_availabilities': ({'spot_availability'}, _SPOT_AVAILABILITIES_SQL, (1, _TS)),
+        'due_reminders': ({'b'}, _DUE_REMINDERS_SQL, (_TS, _TS, 60)),
+        'next_reminder': ({'bookings'}, _NEXT_REMINDER_SQL, (_TS,)),
+    }
+
+def explain(conn, sql, params=()):
+    """Строки EXPLAIN QUERY PLAN (поле detail)."""
+    return [r[3] for r in conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()]
+
+def check_query_plans(conn=None):
+    """Возвращает [(имя запроса, строка плана)] для полных сканов защищённых таблиц.
+    Скан частичного индекса (только свободные слоты) полным сканом не считается.
+    """
+    if conn is None:
+        with get_connection() as conn:
+            return check_query_plans(conn)
+    partial = {r[0] for r in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='index' AND sql LIKE '% WHERE %'").fetchall()}
+    problems = []
+    for name, (tables, sql, params) in hot_queries().items():
+        for detail in explain(conn, sql, params):
+            words = detail.split()
+            if len(words) < 2 or words[0] != 'SCAN' or words[1] not in tables:
+                continue
+            if 'INDEX' in words and words[words.index('INDEX') + 1] in partial:
+                continue
+            problems.append((name, detail))
+    return problems
 
 
 # ==================== USERS ====================
-def get_user_by_telegram_id(tid):
+# LRU-кэш строк users по telegram_id и id (USER_CACHE_SIZE, USER_CACHE_TTL_SECONDS).
+# Сбрасывается после COMMIT записей, отмеченных mark_user_changed(); _user_gen
+# не даёт читателю положить в кэш строку, прочитанную до такой записи.
+_user_cache = OrderedDict()   # ('tg', telegram_id) | ('id', id) -> (время, строка)
+_user_cache_lock = threading.Lock()
+_user_gen = 0
+user_cache_stats = {'hits': 0, 'misses': 0}   # все чтения users по кэшу, не только middleware
+
+def invalidate_user_cache(user_id=None):
+    global _user_gen
+    with _user_cache_lock:
+        _user_gen += 1
+        if user_id is None:
+            _user_cache.clear()
+            return
+        hit = _user_cache.pop(('id', user_id), None)
+        if hit:
+            _user_cache.pop(('tg', hit[1]['telegram_id']), None)
+        else:
+            for key in [k for k, v in _user_cache.items() if v[1]['id'] == user_id]:
+                del _user_cache[key]
+
+def _get_user_cached(key, sql, arg):
+    now = time.monotonic()
+    with _user_cache_lock:
+        hit = _user_cache.get(key)
+        if hit and now - hit[0] < USER_CACHE_TTL_SECONDS:
+            _user_cache.move_to_end(key)
+            user_cache_stats['hits'] += 1
+            return dict(hit[1])
+        gen = _user_gen
+    user_cache_stats['misses'] += 1
     with get_connection() as conn:
-        r = conn.cursor().execute('SELECT * FROM users WHERE telegram_id=?',(tid,)).fetchone()
-        return dict(r) if r else None
+        r = conn.cursor().execute(sql, (arg,)).fetchone()
+    if not r:
+        return None
+    row = dict(r)
+    with _user_cache_lock:
+        if gen == _user_gen:
+            for k in (('tg', row['telegram_id']), ('id', row['id'])):
+                _user_cache[k] = (now, row)
+                _user_cache.move_to_end(k)
+            while len(_user_cache) > USER_CACHE_SIZE:
+                _user_cache.popitem(last=False)
+    return dict(row)
+
+def get_user_by_telegram_id(tid):
+    return _get_user_cached(('tg', tid), 'SELECT * FROM users WHERE telegram_id=?', tid)
 
 def get_user_by_id(uid):
-    with get_connection() as conn:
-        r = conn.cursor().execute('SELECT * FROM users WHERE id=?',(uid,)).fetchone()
-        return dict(r) if r else None
+    return _get_user_cached(('id', uid), 'SELECT * FROM users WHERE id=?', uid)
 
 def create_user(telegram_id, username, full_name, phone, card_number='', bank=''):
     with get_connection() as conn:
@@ -147,6 +708,7 @@ def create_user(telegram_id, username, full_name, phone, card_number='', bank=''
         c.execute('INSERT INTO users (telegram_id,username,full_name,phone,card_number,bank) VALUES (?,?,?,?,?,?)',
                   (telegram_id, username, full_name, phone, card_number, bank))
         uid = c.lastrowid
+        mark_user_changed(uid)
         _log(c, 'user_registered', user_id=uid, details=json.dumps({'name':full_name,'phone':phone}))
         return uid
 
@@ -157,31 +719,36 @@ def update_user(user_id, **kw):
     if not u: return False
     s = ', '.join(f"{k}=?" for k in u)
     with get_connection() as conn:
+        mark_user_changed(user_id)
+        if 'is_active' in u:
+            _mark(('ban', user_id))   # реестр банов перечитает строку после COMMIT
+        if _SEARCH_USER_FIELDS & u.keys():
+            mark_availability_changed()
         return conn.cursor().execute(f'UPDATE users SET {s} WHERE id=?', list(u.values())+[user_id]).rowcount > 0
 
 def user_has_car_info(u): return bool(u.get('license_plate') and u.get('car_brand') and u.get('car_color'))
 def user_has_card_info(u): return bool(u.get('card_number') and u.get('bank'))
 
 def is_user_banned(u):
-    if not u.get('is_active'):
-        bu = u.get('banned_until')
-        if bu:
-            try:
-                until = datetime.fromisoformat(bu)
-                if until > datetime.now():
-                    return True, u.get('ban_reason',''), bu
-                else:
-                    update_user(u['id'], is_active=1, banned_until=None, ban_reason='')
-                    return False, '', None
-            except: pass
-        return True, u.get('ban_reason',''), None
-    return False, '', None
+    """(забанен, причина, до) по реестру банов — без обращения к БД."""
+    with _ban_lock:
+        ban = _bans.get(u['id'])
+    if ban is None:
+        return False, '', None
+    until, reason = ban
+    if until and until <= _ts(now_local(precise=True)):
+        return False, '', None   # срок вышел, lift_expired_bans вот-вот снимет
+    return True, reason, until
 
 def ban_user(user_id, duration_hours=None, reason=''):
     bu = None
     if duration_hours:
-        bu = (datetime.now() + timedelta(hours=duration_hours)).strftime("%Y-%m-%d %H:%M:%S")
-    return update_user(user_id, is_active=0, banned_until=bu, ban_reason=reason)
+        bu = _ts(now_local(precise=True) + timedelta(hours=duration_hours))
+    with get_connection():
+        ok = update_user(user_id, is_active=0, banned_until=bu, ban_reason=reason)
+        if bu:
+            schedule_job('unban', user_id, bu)
+        return ok
 
 def unban_user(user_id):
     return update_user(user_id, is_active=1, banned_until=None, ban_reason='')
@@ -201,9 +768,88 @@ def block_user(uid): return update_user(uid, is_active=0)
 def unblock_user(uid): return unban_user(uid)
 
 
+# ==================== BAN REGISTRY ====================
+# Забаненные держатся в памяти: _bans (id -> (banned_until|None, причина)) и
+# min-heap сроков _ban_heap. Проверка бана — поиск в dict; lift_expired_bans()
+# снимает истёкшие баны (задача 'unban' планировщика на banned_until).
+# Записи в heap не удаляются: устаревшие пропускаются при сверке с _bans.
+# banned_until — локальное время TIMEZONE, как сроки планировщика (значения,
+# записанные по часам сервера до схемы 8, переводит _m008_scheduled_jobs).
+_bans = {}
+_ban_heap = []
+_ban_lock = threading.Lock()
+
+def load_ban_registry():
+    with get_connection() as conn:
+        rows = conn.cursor().execute('SELECT id, banned_until, ban_reason FROM users WHERE is_active=0').fetchall()
+    with _ban_lock:
+        _bans.clear(); _ban_heap.clear()
+        for r in rows:
+            _bans[r['id']] = (r['banned_until'], r['ban_reason'] or '')
+            if r['banned_until']:
+                _ban_heap.append((r['banned_until'], r['id']))
+        heapq.heapify(_ban_heap)
+    logger.info(f"Ban registry: {len(rows)} banned")
+    return len(rows)
+
+def _reload_bans(user_ids):
+    # Баны редки: после COMMIT перечитываем затронутые строки, порядок операций в пачке неважен
+    with get_connection() as conn:
+        rows = conn.cursor().execute(
+            f"SELECT id, is_active, banned_until, ban_reason FROM users WHERE id IN ({','.join('?'*len(user_ids))})",
+            user_ids).fetchall()
+    with _ban_lock:
+        for uid in user_ids:
+            _bans.pop(uid, None)
+        for r in rows:
+            if r['is_active']:
+                continue
+            _bans[r['id']] = (r['banned_until'], r['ban_reason'] or '')
+            if r['banned_until']:
+                heapq.heappush(_ban_heap, (r['banned_until'], r['id']))
+
+def banned_count():
+    return len(_bans)
+
+def lift_expired_bans(now=None):
+    """Снимает баны со сроком <= now точечным UPDATE. Возвращает [{user_id, telegram_id}]."""
+    now = now or _ts(now_local(precise=True))
+    due = []
+    with _ban_lock:
+        while _ban_heap and _ban_heap[0][0] <= now:
+            until, uid = heapq.heappop(_ban_heap)
+            ban = _bans.get(uid)
+            if ban and ban[0] == until:
+                due.append((uid, until))
+    if not due:
+        return []
+    lifted = []
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            for uid, until in due:
+                # banned_until=? — не снимать бан, если его успели продлить
+                r = c.execute("UPDATE users SET is_active=1, banned_until=NULL, ban_reason='' "
+                              "WHERE id=? AND is_active=0 AND banned_until=? RETURNING telegram_id",
+                              (uid, until)).fetchone()
+                if r:
+                    mark_user_changed(uid)
+                    _mark(('ban', uid))
+                    lifted.append({'user_id': uid, 'telegram_id': r['telegram_id']})
+            if lifted:
+                mark_availability_changed()
+    except Exception:
+        with _ban_lock:   # вернуть сроки, чтобы повторить на следующем проходе
+            for uid, until in due:
+                heapq.heappush(_ban_heap, (until, uid))
+        raise
+    return lifted
+
+
 # ==================== SPOTS ====================
 def create_parking_spot(supplier_id, spot_number, price_per_hour=0, address=None, description=None):
     with get_connection() as conn:
+        mark_availability_changed()
         c = conn.cursor()
         c.execute('INSERT INTO parking_spots (supplier_id,spot_number,address,description,price_per_hour) VALUES (?,?,?,?,?)',
                   (supplier_id, spot_number, address, description, price_per_hour))
@@ -216,6 +862,7 @@ def get_or_create_spot(supplier_id, spot_number, address=None):
     Если address передан и у существующего места адрес пустой — обновляет.
     """
     with get_connection() as conn:
+        mark_availability_changed()
         c = conn.cursor()
         r = c.execute('SELECT id, address FROM parking_spots WHERE supplier_id=? AND spot_number=? AND is_available=1',
                       (supplier_id, spot_number)).fetchone()
@@ -237,17 +884,20 @@ def create_spot_availability(spot_id, start_time, end_time):
     if start_time < now_local():
         raise ValueError("Start time in past")
     with get_connection() as conn:
+        mark_availability_changed()
         return conn.cursor().execute('INSERT INTO spot_availability (spot_id,start_time,end_time) VALUES (?,?,?)',
             (spot_id, start_time.strftime("%Y-%m-%d %H:%M:%S"), end_time.strftime("%Y-%m-%d %H:%M:%S"))).lastrowid
 
 
+_SLOT_OVERLAP_SQL = '''SELECT COUNT(*) FROM spot_availability
+               WHERE spot_id=? AND start_time < ? AND end_time > ? AND end_time > ?'''
+
 def check_slot_overlap(spot_id, start_time, end_time, exclude_slot_id=None):
     """Проверяет пересечение с существующими слотами. True = есть пересечение."""
     with get_connection() as conn:
-        q = '''SELECT COUNT(*) FROM spot_availability
-               WHERE spot_id=? AND start_time < ? AND end_time > ?
-               AND end_time > datetime('now','localtime')'''
-        p = [spot_id, end_time.strftime("%Y-%m-%d %H:%M:%S"), start_time.strftime("%Y-%m-%d %H:%M:%S")]
+        q = _SLOT_OVERLAP_SQL
+        p = [spot_id, end_time.strftime("%Y-%m-%d %H:%M:%S"), start_time.strftime("%Y-%m-%d %H:%M:%S"),
+             now_local().strftime("%Y-%m-%d %H:%M:%S")]
         if exclude_slot_id:
             q += ' AND id != ?'; p.append(exclude_slot_id)
         return conn.cursor().execute(q, p).fetchone()[0] > 0
@@ -255,6 +905,7 @@ def check_slot_overlap(spot_id, start_time, end_time, exclude_slot_id=None):
 def update_slot_times(slot_id, start_time, end_time):
     """Обновляет время свободного слота."""
     with get_connection() as conn:
+        mark_availability_changed()
         return conn.cursor().execute(
             'UPDATE spot_availability SET start_time=?, end_time=? WHERE id=? AND is_booked=0',
             (start_time.strftime("%Y-%m-%d %H:%M:%S"), end_time.strftime("%Y-%m-%d %H:%M:%S"), slot_id)).rowcount > 0
@@ -262,6 +913,7 @@ def update_slot_times(slot_id, start_time, end_time):
 def delete_slot(slot_id):
     """Удаляет свободный слот."""
     with get_connection() as conn:
+        mark_availability_changed()
         return conn.cursor().execute('DELETE FROM spot_availability WHERE id=? AND is_booked=0',(slot_id,)).rowcount > 0
 
 def get_user_spots(uid):
@@ -278,31 +930,61 @@ def get_all_spots():
         return [dict(r) for r in conn.cursor().execute('SELECT ps.*, u.full_name as supplier_name FROM parking_spots ps JOIN users u ON ps.supplier_id=u.id WHERE ps.is_available=1 ORDER BY ps.created_at DESC').fetchall()]
 def delete_spot(sid):
     with get_connection() as conn:
+        mark_availability_changed()
         c = conn.cursor()
         c.execute('DELETE FROM spot_availability WHERE spot_id=? AND is_booked=0',(sid,))
         return c.execute('UPDATE parking_spots SET is_available=0 WHERE id=?',(sid,)).rowcount > 0
 
 
 # ==================== AVAILABILITY ====================
-def get_available_slots(date_str=None, exclude_supplier=None):
-    with get_connection() as conn:
-        q = '''SELECT sa.*, ps.spot_number, ps.price_per_hour,
+# Кэш свободных слотов: date_str (или None) -> (версия, время, строки по всем поставщикам).
+# Выдача для пользователя — фильтр общего списка, так что сотни пользователей,
+# листающих один день, стоят одного запроса. Сбрасывается при смене версии.
+_slots_cache = {}
+search_cache_stats = {'hits': 0, 'misses': 0}
+_SEARCH_USER_FIELDS = {'full_name', 'card_number', 'bank', 'is_active', 'banned_until'}
+
+_AVAILABLE_SLOTS_SQL = '''SELECT sa.*, ps.spot_number, ps.price_per_hour,
                ps.address, ps.description, ps.supplier_id, u.full_name as supplier_name,
                u.card_number, u.bank
                FROM spot_availability sa
                JOIN parking_spots ps ON sa.spot_id = ps.id
                JOIN users u ON ps.supplier_id = u.id
                WHERE sa.is_booked = 0 AND ps.is_available = 1
-               AND sa.end_time > datetime('now', 'localtime')'''
-        p = []
+               AND sa.end_time > ?'''
+# Слот пересекает день: начинается до конца дня и заканчивается после его начала
+_AVAILABLE_SLOTS_DAY_SQL = ' AND sa.start_time < ? AND sa.end_time >= ?'
+_AVAILABLE_SLOTS_ORDER_SQL = ' ORDER BY sa.start_time ASC'
+
+def _query_available_slots(date_str, now_str):
+    with get_connection() as conn:
+        q = _AVAILABLE_SLOTS_SQL
+        p = [now_str]
         if date_str:
-            q += ' AND DATE(sa.start_time) <= ? AND DATE(sa.end_time) >= ?'
-            p.extend([date_str, date_str])
-        if exclude_supplier:
-            q += ' AND ps.supplier_id != ?'; p.append(exclude_supplier)
-        q += ' ORDER BY sa.start_time ASC'
+            day = datetime.strptime(date_str, "%Y-%m-%d")
+            q += _AVAILABLE_SLOTS_DAY_SQL
+            p.extend([(day + timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S"), day.strftime("%Y-%m-%d %H:%M:%S")])
+        q += _AVAILABLE_SLOTS_ORDER_SQL
         return [dict(r) for r in conn.cursor().execute(q, p).fetchall()]
 
+def get_available_slots(date_str=None, exclude_supplier=None):
+    now_str = now_local().strftime("%Y-%m-%d %H:%M:%S")
+    version = _availability_version
+    hit = _slots_cache.get(date_str)
+    if hit and hit[0] == version and time.monotonic() - hit[1] < SEARCH_CACHE_TTL_SECONDS:
+        search_cache_stats['hits'] += 1
+        rows = hit[2]
+    else:
+        search_cache_stats['misses'] += 1
+        rows = _query_available_slots(date_str, now_str)
+        with _version_lock:
+            if version == _availability_version:
+                if len(_slots_cache) >= SEARCH_CACHE_MAX_DATES:
+                    _slots_cache.pop(next(iter(_slots_cache)))
+                _slots_cache[date_str] = (version, time.monotonic(), rows)
+    return [dict(r) for r in rows
+            if r['end_time'] > now_str and not (exclude_supplier and r['supplier_id'] == exclude_supplier)]
+
 def get_availability_by_id(aid):
     with get_connection() as conn:
         r = conn.cursor().execute('''SELECT sa.*, ps.spot_number, ps.price_per_hour,
@@ -319,22 +1001,23 @@ def get_slot_by_id(aid):
         r = conn.cursor().execute('SELECT * FROM spot_availability WHERE id=?',(aid,)).fetchone()
         return dict(r) if r else None
 
+_SPOT_AVAILABILITIES_SQL = "SELECT * FROM spot_availability WHERE spot_id=? AND is_booked=0 AND end_time>? ORDER BY start_time ASC"
+
 def get_spot_availabilities(sid):
     """Возвращает ТОЛЬКО свободные интервалы для места, которые ещё не закончились."""
     now_str = now_local().strftime("%Y-%m-%d %H:%M:%S")
     with get_connection() as conn:
-        return [dict(r) for r in conn.cursor().execute(
-            "SELECT * FROM spot_availability WHERE spot_id=? AND is_booked=0 AND end_time>? ORDER BY start_time ASC",
-            (sid, now_str)
-        ).fetchall()]
+        return [dict(r) for r in conn.cursor().execute(_SPOT_AVAILABILITIES_SQL, (sid, now_str)).fetchall()]
 
 
 
-# =========def create_booking(customer_id, spot_id, availability_id, start_time, end_time, total_price):
+# ==================== BOOKINGS ====================
+def create_booking(customer_id, spot_id, availability_id, start_time, end_time, total_price):
     """Создаёт бронь (pending). Помечает слот как забронированный. Разбивает остатки."""
     with get_connection() as conn:
+        mark_availability_changed()
         c = conn.cursor()
-        conn.execute('BEGIN IMMEDIATE')
+        _begin_immediate(conn)
         start_time = normalize_dt(start_time)
         end_time = normalize_dt(end_time)
         if end_time <= start_time:
@@ -366,11 +1049,13 @@ def get_spot_availabilities(sid):
             c.execute('INSERT INTO spot_availability (spot_id,start_time,end_time,is_booked) VALUES (?,?,?,0)',
                       (spot_id, end_time.strftime("%Y-%m-%d %H:%M:%S"), slot_end.strftime("%Y-%m-%d %H:%M:%S")))
         _log(c, 'booking_created', booking_id=bid, user_id=customer_id, spot_id=spot_id)
+        schedule_job('booking_expire', bid, now_local(precise=True) + timedelta(minutes=BOOKING_TIMEOUT_MINUTES))
         return bid
 
 def cancel_booking(bid):
     """Отменяет бронь. Освобождает забронированный слот с временем = бронь."""
     with get_connection() as conn:
+        mark_availability_changed()
         c = conn.cursor()
         booking = c.execute('SELECT * FROM bookings WHERE id=?',(bid,)).fetchone()
         if not booking: return False
@@ -392,7 +1077,9 @@ def confirm_booking(bid):
         c = conn.cursor()
         c.execute("UPDATE bookings SET status='confirmed' WHERE id=? AND status='pending'",(bid,))
         ok = c.rowcount > 0
-        if ok: _log(c, 'booking_confirmed', booking_id=bid)
+        if ok:
+            _log(c, 'booking_confirmed', booking_id=bid)
+            _schedule_reminders(c, bid)
         return ok
 
 def reject_booking(bid):
@@ -426,9 +1113,29 @@ def admin_edit_booking_hours(bid, paid_hours):
             _log(c, 'booking_edited', booking_id=bid, details=f"paid_hours={paid_hours} (no_split)")
             return True
 
+        # Остаток освобождаем только у действующей брони: у отменённой слот уже свободен
+        if booking['status'] not in ('pending', 'confirmed'):
+            return False
+
+        mark_availability_changed()
+        _begin_immediate(conn)
+        full_hours = (book_end - book_start).total_seconds() / 3600
+        c.execute('UPDATE bookings SET end_time=?, total_price=? WHERE id=?',
+                  (_ts(new_end), round(booking['total_price'] * paid_hours / full_hours, 2), bid))
+        # Забронированный слот сужаем до брони, как при отмене, чтобы он не перекрывал остаток
+        if booking['availability_id']:
+            c.execute('UPDATE spot_availability SET start_time=?, end_time=? WHERE id=?',
+                      (booking['start_time'], _ts(new_end), booking['availability_id']))
+        c.execute('INSERT INTO spot_availability (spot_id,start_time,end_time,is_booked) VALUES (?,?,?,0)',
+                  (booking['spot_id'], _ts(new_end), _ts(book_end)))
+        _log(c, 'booking_edited', booking_id=bid, details=f"paid_hours={paid_hours} (split)")
+        merge_free_availability(booking['spot_id'])
+        return True
+
 
 def admin_toggle_slot(availability_id):
     with get_connection() as conn:
+        mark_availability_changed()
         c = conn.cursor()
         slot = c.execute('SELECT * FROM spot_availability WHERE id=?',(availability_id,)).fetchone()
         if not slot: return None
@@ -436,28 +1143,53 @@ def admin_toggle_slot(availability_id):
         c.execute('UPDATE spot_availability SET is_booked=? WHERE id=?',(new_status, availability_id))
         return new_status
 
-def get_booking_by_id(bid):
-    with get_connection() as conn:
-        r = conn.cursor().execute('''SELECT b.*, ps.spot_number, ps.price_per_hour, ps.supplier_id,
+_BOOKING_SQL = '''SELECT b.*, ps.spot_number, ps.price_per_hour, ps.supplier_id,
                ps.address,
                u.full_name as customer_name, u.phone as customer_phone, u.username as customer_username,
                u.telegram_id as customer_telegram_id,
                u.license_plate as customer_plate, u.car_brand as customer_car, u.car_color as customer_car_color,
                s.full_name as supplier_name, s.card_number, s.bank, s.phone as supplier_phone,
                s.username as supplier_username, s.telegram_id as supplier_telegram_id
-               FROM bookings b JOIN parking_spots ps ON b.spot_id=ps.id
-               JOIN users u ON b.customer_id=u.id JOIN users s ON ps.supplier_id=s.id WHERE b.id=?''',(bid,)).fetchone()
-        return dict(r) if r else None
+               FROM {bookings} b JOIN parking_spots ps ON b.spot_id=ps.id
+               JOIN users u ON b.customer_id=u.id JOIN users s ON ps.supplier_id=s.id WHERE b.id=?'''
 
-def get_user_bookings(uid, status=None):
+def get_booking_by_id(bid):
     with get_connection() as conn:
-        q = '''SELECT b.*, ps.spot_number, ps.address, s.full_name as supplier_name, s.card_number, s.bank
-               FROM bookings b JOIN parking_spots ps ON b.spot_id=ps.id
+        r = conn.cursor().execute(_BOOKING_SQL.format(bookings='bookings'),(bid,)).fetchone()
+        return dict(r) if r else None
+
+def get_archived_booking(bid):
+    """Бронь из архива (история, archived=True) или None. Отзыв на неё уже не оставить."""
+    with get_readonly_connection(archive=True) as conn:
+        if not has_archive(conn):
+            return None
+        r = conn.execute(_BOOKING_SQL.format(bookings='archive.bookings'), (bid,)).fetchone()
+        return dict(r, archived=True) if r else None
+
+_USER_BOOKINGS_SQL = '''SELECT {cols}, ps.spot_number, ps.address, s.full_name as supplier_name, s.card_number, s.bank
+               FROM {bookings} b JOIN parking_spots ps ON b.spot_id=ps.id
                JOIN users s ON ps.supplier_id=s.id WHERE b.customer_id=?'''
-        p = [uid]
-        if status: q += ' AND b.status=?'; p.append(status)
-        q += ' ORDER BY b.created_at DESC'
-        return [dict(r) for r in conn.cursor().execute(q, p).fetchall()]
+
+def get_user_bookings(uid, status=None, include_archive=False):
+    """Брони пользователя; include_archive — вместе с историей из архива."""
+    where, p = '', [uid]
+    if status: where = ' AND b.status=?'; p.append(status)
+    if not include_archive:
+        with get_connection() as conn:
+            q = _USER_BOOKINGS_SQL.format(cols='b.*', bookings='bookings') + where + ' ORDER BY b.created_at DESC'
+            return [dict(r) for r in conn.cursor().execute(q, p).fetchall()]
+    with get_readonly_connection(archive=True) as conn:
+        q = _USER_BOOKINGS_SQL.format(cols='b.*', bookings='main.bookings') + where
+        if has_archive(conn):
+            q += ' UNION ALL ' + _USER_BOOKINGS_SQL.format(
+                cols=_archive_select(conn, 'bookings', 'b'), bookings='archive.bookings') + where
+            p = p * 2
+        rows, seen = [], set()
+        for r in conn.execute(q + ' ORDER BY created_at DESC', p).fetchall():
+            if r['id'] not in seen:
+                seen.add(r['id'])
+                rows.append(dict(r))
+        return rows
 
 def get_all_bookings(status=None, limit=30):
     with get_connection() as conn:
@@ -496,23 +1228,61 @@ def get_active_bookings_count(uid):
 
 
 # ==================== REVIEWS ====================
+# Средние считаются из rating_aggregates (сумма и количество по месту и по поставщику),
+# которые обновляются в той же транзакции, что и create_review.
 def create_review(booking_id, reviewer_id, spot_id, supplier_id, rating, comment=''):
     with get_connection() as conn:
         c = conn.cursor()
         c.execute('INSERT INTO reviews (booking_id,reviewer_id,spot_id,supplier_id,rating,comment) VALUES (?,?,?,?,?,?)',
                   (booking_id, reviewer_id, spot_id, supplier_id, rating, comment))
+        rid = c.lastrowid
         c.execute('UPDATE bookings SET reviewed=1 WHERE id=?',(booking_id,))
-        return c.lastrowid
+        for kind, target in (('spot', spot_id), ('supplier', supplier_id)):
+            c.execute('''INSERT INTO rating_aggregates (kind,target_id,rating_sum,rating_count) VALUES (?,?,?,1)
+                         ON CONFLICT(kind,target_id) DO UPDATE SET
+                         rating_sum=rating_sum+excluded.rating_sum, rating_count=rating_count+1''',
+                      (kind, target, rating))
+        return rid
+
+def _rebuild_rating_aggregates(c):
+    c.execute('DELETE FROM rating_aggregates')
+    c.execute('''INSERT INTO rating_aggregates (kind,target_id,rating_sum,rating_count)
+                 SELECT 'spot', spot_id, SUM(rating), COUNT(*) FROM reviews GROUP BY spot_id''')
+    c.execute('''INSERT INTO rating_aggregates (kind,target_id,rating_sum,rating_count)
+                 SELECT 'supplier', supplier_id, SUM(rating), COUNT(*) FROM reviews GROUP BY supplier_id''')
+
+def rebuild_rating_aggregates():
+    """Пересчитывает rating_aggregates из reviews (python database.py rebuild-ratings)."""
+    with get_connection() as conn:
+        _begin_immediate(conn)
+        _rebuild_rating_aggregates(conn.cursor())
+        return conn.execute('SELECT COUNT(*) FROM rating_aggregates').fetchone()[0]
 
-def get_spot_rating(spot_id):
+def _avg(rating_sum, cnt):
+    return (round(rating_sum / cnt, 1) if cnt else 0, cnt)
+
+def _get_ratings(kind, ids):
+    ids = list(dict.fromkeys(ids))
+    if not ids: return {}
     with get_connection() as conn:
-        r = conn.cursor().execute('SELECT AVG(rating) as avg_r, COUNT(*) as cnt FROM reviews WHERE spot_id=?',(spot_id,)).fetchone()
-        return (round(r['avg_r'],1) if r['avg_r'] else 0, r['cnt'])
+        rows = conn.cursor().execute(
+            f'''SELECT target_id, rating_sum, rating_count FROM rating_aggregates
+                WHERE kind=? AND target_id IN ({','.join('?' * len(ids))})''', [kind] + ids).fetchall()
+    found = {r['target_id']: _avg(r['rating_sum'], r['rating_count']) for r in rows}
+    return {i: found.get(i, (0, 0)) for i in ids}
+
+def get_spot_ratings(spot_ids):
+    """{spot_id: (средний, количество)} для многих мест одним запросом."""
+    return _get_ratings('spot', spot_ids)
+
+def get_supplier_ratings(supplier_ids):
+    return _get_ratings('supplier', supplier_ids)
+
+def get_spot_rating(spot_id):
+    return get_spot_ratings([spot_id])[spot_id]
 
 def get_supplier_rating(supplier_id):
-    with get_connection() as conn:
-        r = conn.cursor().execute('SELECT AVG(rating) as avg_r, COUNT(*) as cnt FROM reviews WHERE supplier_id=?',(supplier_id,)).fetchone()
-        return (round(r['avg_r'],1) if r['avg_r'] else 0, r['cnt'])
+    return get_supplier_ratings([supplier_id])[supplier_id]
 
 def get_spot_reviews(spot_id, limit=10):
     with get_connection() as conn:
@@ -596,68 +1366,491 @@ def get_admin_logs(limit=100):
     with get_connection() as conn:
         return [dict(r) for r in conn.cursor().execute('SELECT * FROM admin_logs ORDER BY created_at DESC LIMIT ?',(limit,)).fetchall()]
 
-def auto_unban_expired():
+# ==================== OUTBOX ====================
+# Уведомления пишутся в notification_outbox в той же транзакции, что и изменения
+# (get_connection реентерабелен), и отправляются outbox.py уже после COMMIT:
+# транзакции не ждут Telegram, а неотправленное переживает рестарт.
+_outbox_listener = None   # будит диспетчер outbox.py после COMMIT
+
+def set_outbox_listener(fn):
+    global _outbox_listener
+    _outbox_listener = fn
+
+def enqueue_notification(chat_id, text, parse_mode=None, reply_markup=None):
+    """reply_markup — JSON клавиатуры (outbox.markup_json)."""
+    if not chat_id:
+        return None
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute('''INSERT INTO notification_outbox (chat_id, text, parse_mode, reply_markup, next_attempt_at)
+            VALUES (?,?,?,?,?)''', (chat_id, text, parse_mode, reply_markup,
+                                   datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        _mark('outbox')
+        return c.lastrowid
+
+def get_due_notifications(limit=100):
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with get_connection() as conn:
+        return [dict(r) for r in conn.cursor().execute(
+            "SELECT * FROM notification_outbox WHERE status='pending' AND next_attempt_at<=? "
+            "ORDER BY next_attempt_at, id LIMIT ?", (now, limit)).fetchall()]
+
+def next_notification_time():
     with get_connection() as conn:
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         return conn.cursor().execute(
-            "UPDATE users SET is_active=1, banned_until=NULL, ban_reason='' WHERE is_active=0 AND banned_until IS NOT NULL AND banned_until < ?",
-            (now,)).rowcount
+            "SELECT MIN(next_attempt_at) FROM notification_outbox WHERE status='pending'").fetchone()[0]
+
+def mark_notification_sent(nid):
+    with get_connection() as conn:
+        conn.cursor().execute("UPDATE notification_outbox SET status='sent', attempts=attempts+1, "
+                              "sent_at=CURRENT_TIMESTAMP, last_error=NULL WHERE id=?", (nid,))
+
+def mark_notification_failed(nid, error, retry_in=None, max_attempts=5, count_attempt=True):
+    """retry_in=None — ошибка окончательная (dead); иначе повтор через retry_in секунд,
+    пока attempts < max_attempts."""
+    with get_connection() as conn:
+        c = conn.cursor()
+        attempts = c.execute('SELECT attempts FROM notification_outbox WHERE id=?', (nid,)).fetchone()[0]
+        attempts += 1 if count_attempt else 0
+        if retry_in is None or attempts >= max_attempts:
+            c.execute("UPDATE notification_outbox SET status='dead', attempts=?, last_error=? WHERE id=?",
+                      (attempts, error, nid))
+            return 'dead'
+        at = (datetime.now() + timedelta(seconds=retry_in)).strftime("%Y-%m-%d %H:%M:%S")
+        c.execute("UPDATE notification_outbox SET attempts=?, last_error=?, next_attempt_at=? WHERE id=?",
+                  (attempts, error, at, nid))
+        return 'retry'
+
+def get_outbox_stats():
+    with get_connection() as conn:
+        return {r[0]: r[1] for r in conn.cursor().execute(
+            'SELECT status, COUNT(*) FROM notification_outbox GROUP BY status').fetchall()}
+
+
+# ==================== SCHEDULER ====================
+# Отложенные задачи (scheduler.py): строка scheduled_jobs на (kind, ref_id) со
+# сроком run_at в локальном времени TIMEZONE, как у броней. Задача ставится в
+# транзакции изменения (бронь, подтверждение, бан) и после COMMIT попадает в
+# heap планировщика через _job_listener; выполненная удаляется claim_job().
+_job_listener = None   # получает [(kind, ref_id, run_at)] после COMMIT
+
+def _ts(dt):
+    return dt.strftime("%Y-%m-%d %H:%M:%S") if isinstance(dt, datetime) else dt
+
+def set_job_listener(fn):
+    global _job_listener
+    _job_listener = fn
+
+def schedule_job(kind, ref_id, run_at, earlier_only=False):
+    """Ставит задачу kind для ref_id на run_at (datetime или строка); существующую переносит.
+    earlier_only — переносить только на более ранний срок."""
+    run_at = _ts(run_at)
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute('''INSERT INTO scheduled_jobs (kind, ref_id, run_at) VALUES (?,?,?)
+            ON CONFLICT(kind, ref_id) DO UPDATE SET run_at=excluded.run_at'''
+            + (' WHERE excluded.run_at < scheduled_jobs.run_at' if earlier_only else ''),
+            (kind, ref_id, run_at))
+        if c.rowcount > 0:
+            _mark(('job', kind, ref_id, run_at))
+
+def cancel_job(kind, ref_id):
+    with get_connection() as conn:
+        conn.cursor().execute('DELETE FROM scheduled_jobs WHERE kind=? AND ref_id=?', (kind, ref_id))
+
+def claim_job(kind, ref_id, run_at):
+    """Забирает задачу на выполнение. False — её уже выполнили, отменили или перенесли."""
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute('DELETE FROM scheduled_jobs WHERE kind=? AND ref_id=? AND run_at=?', (kind, ref_id, run_at))
+        return c.rowcount > 0
+
+def get_scheduled_jobs():
+    """[(kind, ref_id, run_at)] — восстановление heap при старте."""
+    with get_connection() as conn:
+        return [tuple(r) for r in conn.cursor().execute(
+            'SELECT kind, ref_id, run_at FROM scheduled_jobs ORDER BY run_at').fetchall()]
+
+
+
+# ==================== REMINDERS ====================
+# Напоминания за REMINDER_OFFSETS_MINUTES до начала подтверждённых броней.
+# Одна задача 'reminders' спит до ближайшего срока: claim_due_reminders()
+# выбирает по индексу (status, start_time) брони, начинающиеся не позже чем
+# через отступ и без записи в журнале booking_reminders, и сразу пишет их в
+# журнал — в той же транзакции, что ставит сообщения в outbox.
+_DUE_REMINDERS_SQL = '''SELECT b.id, b.start_time, u.telegram_id as customer_telegram_id, ps.spot_number
+    FROM bookings b
+    JOIN users u ON b.customer_id = u.id
+    JOIN parking_spots ps ON b.spot_id = ps.id
+    WHERE b.status = 'confirmed' AND b.start_time > ? AND b.start_time <= ?
+      AND NOT EXISTS (SELECT 1 FROM booking_reminders r WHERE r.booking_id = b.id AND r.offset_minutes = ?)'''
+# Брони дальше отступа в журнале быть не могут — достаточно ближайшей
+_NEXT_REMINDER_SQL = "SELECT MIN(start_time) FROM bookings WHERE status = 'confirmed' AND start_time > ?"
+
+def _schedule_reminders(c, bid):
+    """При подтверждении: будит задачу 'reminders' к ближайшему сроку брони;
+    сроки, которые уже прошли, отмечаются в журнале без отправки."""
+    start = datetime.fromisoformat(c.execute('SELECT start_time FROM bookings WHERE id=?', (bid,)).fetchone()[0])
+    now = now_local(precise=True)
+    for offset in REMINDER_OFFSETS_MINUTES:
+        at = start - timedelta(minutes=offset)
+        if at <= now:
+            c.execute('INSERT OR IGNORE INTO booking_reminders (booking_id, offset_minutes) VALUES (?,?)',
+                      (bid, offset))
+        else:
+            schedule_job('reminders', 0, at, earlier_only=True)
+
+def claim_due_reminders(now=None):
+    """Наступившие неотправленные напоминания, сразу отмеченные в журнале.
+    [{booking_id, offset_minutes, start_time, customer_telegram_id, spot_number}]"""
+    now = now or now_local(precise=True)
+    due = []
+    with get_connection() as conn:
+        c = conn.cursor()
+        for offset in REMINDER_OFFSETS_MINUTES:
+            rows = c.execute(_DUE_REMINDERS_SQL,
+                             (_ts(now), _ts(now + timedelta(minutes=offset)), offset)).fetchall()
+            c.executemany('INSERT INTO booking_reminders (booking_id, offset_minutes, sent_at) '
+                          'VALUES (?,?,CURRENT_TIMESTAMP)', [(r['id'], offset) for r in rows])
+            due += [{'booking_id': r['id'], 'offset_minutes': offset, 'start_time': r['start_time'],
+                     'customer_telegram_id': r['customer_telegram_id'], 'spot_number': r['spot_number']}
+                    for r in rows]
+    return due
+
+def next_reminder_time(now=None):
+    """Ближайший срок напоминания (datetime) или None — по одному поиску в индексе на отступ."""
+    now = now or now_local(precise=True)
+    times = []
+    with get_connection() as conn:
+        c = conn.cursor()
+        for offset in REMINDER_OFFSETS_MINUTES:
+            start = c.execute(_NEXT_REMINDER_SQL, (_ts(now + timedelta(minutes=offset)),)).fetchone()[0]
+            if start:
+                times.append(datetime.fromisoformat(start) - timedelta(minutes=offset))
+    return min(times) if times else None
+
+
+# ==================== BROADCASTS ====================
+# Получатели копируются в broadcast_deliveries одним INSERT ... SELECT (без выборки
+# пользователей в Python); отправку ведёт broadcast.py, прогресс — в broadcast_jobs.
+_BROADCAST_TARGETS = {
+    'all': 'SELECT ?, telegram_id FROM users',
+    'active': 'SELECT ?, telegram_id FROM users WHERE is_active=1',
+}
+
+def create_broadcast_job(target, text, admin_telegram_id=None, progress_chat_id=None, progress_message_id=None):
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute('''INSERT INTO broadcast_jobs (target, text, admin_telegram_id, progress_chat_id, progress_message_id)
+            VALUES (?,?,?,?,?)''', (target, text, admin_telegram_id, progress_chat_id, progress_message_id))
+        job_id = c.lastrowid
+        c.execute(f"INSERT OR IGNORE INTO broadcast_deliveries (job_id, telegram_id) {_BROADCAST_TARGETS[target]}", (job_id,))
+        c.execute('UPDATE broadcast_jobs SET total=? WHERE id=?', (c.rowcount, job_id))
+        return job_id
+
+def get_broadcast_job(job_id):
+    with get_connection() as conn:
+        r = conn.cursor().execute('SELECT * FROM broadcast_jobs WHERE id=?', (job_id,)).fetchone()
+        return dict(r) if r else None
+
+def get_running_broadcast_jobs():
+    with get_connection() as conn:
+        return [dict(r) for r in conn.cursor().execute("SELECT * FROM broadcast_jobs WHERE status='running' ORDER BY id").fetchall()]
+
+def get_broadcast_recipients(job_id, after_telegram_id=0, limit=500):
+    """Следующая порция ещё не обработанных получателей (keyset по telegram_id)."""
+    with get_connection() as conn:
+        return [r[0] for r in conn.cursor().execute(
+            "SELECT telegram_id FROM broadcast_deliveries WHERE job_id=? AND status='pending' AND telegram_id>? "
+            "ORDER BY telegram_id LIMIT ?", (job_id, after_telegram_id, limit)).fetchall()]
+
+def record_broadcast_results(job_id, results):
+    """results: [(telegram_id, 'sent'|'failed', error)] — одной транзакцией."""
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.executemany("UPDATE broadcast_deliveries SET status=?, error=? WHERE job_id=? AND telegram_id=? AND status='pending'",
+                      [(st, err, job_id, tid) for tid, st, err in results])
+        sent = sum(1 for r in results if r[1] == 'sent')
+        c.execute('UPDATE broadcast_jobs SET sent=sent+?, failed=failed+? WHERE id=?',
+                  (sent, len(results) - sent, job_id))
+
+def finish_broadcast_job(job_id, status='done'):
+    with get_connection() as conn:
+        conn.cursor().execute("UPDATE broadcast_jobs SET status=?, finished_at=CURRENT_TIMESTAMP WHERE id=? AND status='running'",
+                              (status, job_id))
+
+
+# ==================== FSM ====================
+def load_fsm_state(key):
+    """(state, data_json) или None."""
+    with get_connection() as conn:
+        r = conn.cursor().execute('SELECT state, data FROM fsm_states WHERE key=?', (key,)).fetchone()
+    return (r['state'], r['data']) if r else None
+
+def save_fsm_states(rows):
+    """rows: [(key, state, data_json)]. Пустые записи (нет state и data) удаляются."""
+    empty = [(k,) for k, st, d in rows if st is None and d == '{}']
+    full = [r for r in rows if not (r[1] is None and r[2] == '{}')]
+    with get_connection() as conn:
+        c = conn.cursor()
+        if empty:
+            c.executemany('DELETE FROM fsm_states WHERE key=?', empty)
+        if full:
+            c.executemany('''INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?,?,?,CURRENT_TIMESTAMP)
+                ON CONFLICT(key) DO UPDATE SET state=excluded.state, data=excluded.data,
+                updated_at=excluded.updated_at''', full)
+    return len(rows)
+
+
+# ==================== RETENTION ====================
+# Политики хранения (retention.py). Каждая пачка — отдельная короткая операция
+# писателя, живые брони ждут не дольше одной пачки. Способы разбиения:
+#   range  — окна [lo, lo+N) по целочисленному ключу: пачка проверяет не больше N строк;
+#   keyset — первые N подходящих строк после последнего обработанного ключа (WITHOUT ROWID);
+#   limit  — первые N подходящих строк (условие выбирает их по индексу).
+# where — условие с :cutoff; set — SET для UPDATE (без него строки удаляются);
+# archive — строки переносятся в архив (archive_batch) вместо удаления;
+# clock — в чём хранится сравниваемое поле: local (TIMEZONE), utc (CURRENT_TIMESTAMP), date.
+RETENTION_POLICIES = {
+    'bookings_completed': dict(table='bookings', mode='range', key='rowid', set="status='completed'",
+        where="status='confirmed' AND end_time < :cutoff",
+        days=RETENTION_COMPLETE_BOOKINGS_DAYS, clock='local'),
+    # completed без отзыва остаётся в основной БД, пока на неё можно оставить отзыв
+    'archive_bookings': dict(table='bookings', mode='range', key='rowid', archive=True,
+        where="(status IN ('cancelled','expired') OR (status='completed' AND reviewed=1)) AND end_time < :cutoff",
+        days=ARCHIVE_BOOKINGS_DAYS, clock='local'),
+    'archive_unreviewed_bookings': dict(table='bookings', mode='range', key='rowid', archive=True,
+        where="status='completed' AND reviewed=0 AND end_time < :cutoff",
+        days=ARCHIVE_UNREVIEWED_BOOKINGS_DAYS, clock='local'),
+    # занятые слоты закончившихся броней; свободные просто удаляет 'availability'
+    'archive_availability': dict(table='spot_availability', mode='range', key='rowid', archive=True,
+        where="is_booked=1 AND end_time < :cutoff",
+        days=ARCHIVE_BOOKINGS_DAYS, clock='local'),
+    'archive_admin_logs': dict(table='admin_logs', mode='range', key='rowid', archive=True,
+        where="created_at < :cutoff",
+        days=ARCHIVE_ADMIN_LOGS_DAYS, clock='utc'),
+    'availability': dict(table='spot_availability', mode='range', key='rowid',
+        where="is_booked=0 AND end_time < :cutoff",
+        days=RETENTION_AVAILABILITY_DAYS, clock='local', mark='availability'),
+    'spot_notifications': dict(table='spot_notifications', mode='range', key='rowid', set="is_active=0",
+        where="is_active=1 AND desired_date < :cutoff",
+        days=RETENTION_SPOT_NOTIFICATIONS_DAYS, clock='date'),
+    # журнал напоминаний нужен только до начала брони
+    'reminder_ledger': dict(table='booking_reminders', mode='range', key='booking_id',
+        where="NOT EXISTS (SELECT 1 FROM bookings b WHERE b.id = booking_reminders.booking_id "
+              "AND b.start_time >= :cutoff)",
+        days=1, clock='local'),
+    'outbox_sent': dict(table='notification_outbox', mode='range', key='rowid',
+        where="status='sent' AND created_at < :cutoff",
+        days=RETENTION_OUTBOX_DAYS, clock='utc'),
+    'outbox_dead': dict(table='notification_outbox', mode='range', key='rowid',
+        where="status='dead' AND created_at < :cutoff",
+        days=RETENTION_OUTBOX_DEAD_DAYS, clock='utc'),
+    # получатели — до самих рассылок (иначе ON DELETE CASCADE удалит их одной операцией)
+    'broadcast_deliveries': dict(table='broadcast_deliveries', mode='limit', key='job_id, telegram_id',
+        where="job_id IN (SELECT id FROM broadcast_jobs WHERE status!='running' AND finished_at < :cutoff)",
+        days=RETENTION_BROADCAST_DAYS, clock='utc'),
+    'broadcast_jobs': dict(table='broadcast_jobs', mode='range', key='rowid',
+        where="status!='running' AND finished_at < :cutoff "
+              "AND NOT EXISTS (SELECT 1 FROM broadcast_deliveries d WHERE d.job_id = broadcast_jobs.id)",
+        days=RETENTION_BROADCAST_DAYS, clock='utc'),
+    'fsm_states': dict(table='fsm_states', mode='keyset', key='key',
+        where="updated_at < :cutoff",
+        days=RETENTION_FSM_DAYS, clock='utc'),
+}
+
+def retention_cutoff(name, now=None):
+    policy = RETENTION_POLICIES[name]
+    if policy['clock'] == 'utc':
+        now = now or datetime.now(timezone.utc).replace(tzinfo=None)
+    else:
+        now = now or now_local(precise=True)
+    cutoff = now - timedelta(days=policy['days'])
+    return cutoff.date().isoformat() if policy['clock'] == 'date' else _ts(cutoff)
+
+def retention_bounds(name, cutoff):
+    """(min, max) ключа подходящих строк для режима range или None."""
+    p = RETENTION_POLICIES[name]
+    with get_connection() as conn:
+        lo, hi = conn.cursor().execute(
+            f"SELECT MIN({p['key']}), MAX({p['key']}) FROM {p['table']} WHERE {p['where']}",
+            {'cutoff': cutoff}).fetchone()
+    return (lo, hi) if lo is not None else None
+
+def retention_batch(name, cutoff, after=None, limit=RETENTION_BATCH_SIZE):
+    """Одна пачка политики name. Возвращает (строк обработано, продолжение):
+    range — начало следующего окна; keyset — последний ключ; limit — None."""
+    p = RETENTION_POLICIES[name]
+    action = f"UPDATE {p['table']} SET {p['set']}" if p.get('set') else f"DELETE FROM {p['table']}"
+    params = {'cutoff': cutoff, 'limit': limit, 'after': after}
+    with get_connection() as conn:
+        c = conn.cursor()
+        if p['mode'] == 'range':
+            c.execute(f"{action} WHERE {p['key']} >= :after AND {p['key']} < :after + :limit AND ({p['where']})",
+                      params)
+            rows, after = c.rowcount, after + limit
+        elif p['mode'] == 'keyset':
+            keys = [r[0] for r in c.execute(
+                f"{action} WHERE {p['key']} IN (SELECT {p['key']} FROM {p['table']} "
+                f"WHERE {p['key']} > :after AND ({p['where']}) ORDER BY {p['key']} LIMIT :limit) RETURNING {p['key']}",
+                dict(params, after=after if after is not None else '')).fetchall()]
+            rows, after = len(keys), max(keys) if keys else after
+        else:
+            c.execute(f"{action} WHERE ({p['key']}) IN (SELECT {p['key']} FROM {p['table']} "
+                      f"WHERE {p['where']} LIMIT :limit)", params)
+            rows, after = c.rowcount, None
+        if rows and p.get('mark'):
+            _mark(p['mark'])
+        return rows, after
+
+
+# ==================== ARCHIVE ====================
+# Холодные строки (ARCHIVED_TABLES) переносятся в отдельный файл
+# ARCHIVE_DATABASE_PATH, горячие таблицы и их индексы остаются маленькими.
+# Архив подключается (ATTACH) только своим соединением: для переноса —
+# open_archive_connection(), для чтения истории — get_readonly_connection(archive=True).
+# Основная БД в WAL, поэтому COMMIT двух файлов не атомарен в целом: после
+# сбоя строка может оказаться в обоих — перенос идемпотентен (INSERT OR REPLACE),
+# а чтения убирают дубли по id.
+ARCHIVED_TABLES = ('bookings', 'spot_availability', 'admin_logs')
+_ARCHIVE_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS archive.idx_abk_cust ON bookings(customer_id, created_at)',
+    'CREATE INDEX IF NOT EXISTS archive.idx_asa_spot ON spot_availability(spot_id, end_time)',
+    'CREATE INDEX IF NOT EXISTS archive.idx_alog_created ON admin_logs(created_at)',
+]
+
+def _table_columns(conn, schema, table):
+    return [(r[1], r[2]) for r in conn.execute(f'PRAGMA {schema}.table_info({table})').fetchall()]
+
+def _sync_archive_schema(conn):
+    """Создаёт таблицы архива по образцу основных и добавляет новые столбцы."""
+    for table in ARCHIVED_TABLES:
+        cols = _table_columns(conn, 'main', table)
+        have = {name for name, _ in _table_columns(conn, 'archive', table)}
+        if not have:
+            defs = ', '.join(f'{name} {type_}' + (' PRIMARY KEY' if name == 'id' else '') for name, type_ in cols)
+            conn.execute(f'CREATE TABLE archive.{table} ({defs})')
+        for name, type_ in cols:
+            if have and name not in have:
+                conn.execute(f'ALTER TABLE archive.{table} ADD COLUMN {name} {type_}')
+    for idx in _ARCHIVE_INDEXES:
+        conn.execute(idx)
+
+def open_archive_connection():
+    """Отдельное соединение с подключённым архивом для переноса строк (retention.py).
+    Не из пула: ATTACH невозможен внутри транзакции писателя."""
+    conn = sqlite3.connect(DATABASE_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                           isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    try:
+        conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT_MS)}")
+        conn.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DATABASE_PATH,))
+        conn.execute("PRAGMA archive.journal_mode=WAL")
+        conn.execute("PRAGMA archive.synchronous=NORMAL")
+        _sync_archive_schema(conn)
+    except Exception:
+        conn.close()
+        raise
+    return conn
+
+def archive_batch(conn, name, cutoff, after, limit=RETENTION_BATCH_SIZE):
+    """Переносит окно [after, after+limit) политики name в архив одной короткой
+    транзакцией. Возвращает (строк, начало следующего окна)."""
+    p = RETENTION_POLICIES[name]
+    table = p['table']
+    cols = ', '.join(col for col, _ in _table_columns(conn, 'main', table))
+    window = f"rowid >= :after AND rowid < :after + :limit AND ({p['where']})"
+    params = {'cutoff': cutoff, 'after': after, 'limit': limit}
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute(f'INSERT OR REPLACE INTO archive.{table} ({cols}) '
+                     f'SELECT {cols} FROM main.{table} WHERE {window}', params)
+        rows = conn.execute(f'DELETE FROM main.{table} WHERE {window}', params).rowcount
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return rows, after + limit
+
+def has_archive(conn):
+    """Архив подключён и в нём уже есть таблицы (файл мог создаться пустым)."""
+    if not any(r[1] == 'archive' for r in conn.execute('PRAGMA database_list').fetchall()):
+        return False
+    return conn.execute("SELECT 1 FROM archive.sqlite_master WHERE name='bookings'").fetchone() is not None
+
+def _archive_select(conn, table, alias):
+    """Столбцы основной таблицы для UNION с архивом; недостающие в архиве — NULL."""
+    have = {name for name, _ in _table_columns(conn, 'archive', table)}
+    return ', '.join(f'{alias}.{name}' if name in have else f'NULL AS {name}'
+                     for name, _ in _table_columns(conn, 'main', table))
+
+
+# ==================== EXPORT ====================
+# Таблицы выгрузки в Excel и столбец, по которому фильтруется период
+# (значения сравниваются как хранятся: created_at — UTC, start_time — локальное).
+EXPORT_TABLES = {
+    'users': 'created_at',
+    'parking_spots': 'created_at',
+    'spot_availability': 'start_time',
+    'bookings': 'start_time',
+    'reviews': 'created_at',
+    'admin_logs': 'created_at',
+}
+
+def export_query(conn, table, date_from=None, date_to=None):
+    """SELECT строк таблицы за период [date_from, date_to] (даты 'YYYY-MM-DD', включительно)
+    вместе с архивом. Возвращает (sql, count_sql, params)."""
+    col = EXPORT_TABLES[table]
+    cond, params = '1', {}
+    if date_from:
+        cond += f' AND {col} >= :date_from'; params['date_from'] = date_from
+    if date_to:
+        cond += f" AND {col} < date(:date_to, '+1 day')"; params['date_to'] = date_to
+    parts = [f'SELECT * FROM main.{table} WHERE {cond}']
+    if table in ARCHIVED_TABLES and has_archive(conn):
+        # строка после сбоя переноса может быть в обоих файлах — берём основную
+        parts.append(f'SELECT {_archive_select(conn, table, "a")} FROM archive.{table} a WHERE {cond} '
+                     f'AND NOT EXISTS (SELECT 1 FROM main.{table} m WHERE m.id = a.id)')
+    sql = ' UNION ALL '.join(parts)
+    return sql, f'SELECT COUNT(*) FROM ({sql})', params
 
 # ==================== STATS ====================
+# Брони архива, которых нет в основной БД (после сбоя переноса строка может быть в обоих)
+_ARCHIVE_ONLY_BOOKINGS_SQL = '''SELECT COUNT(*) FROM archive.bookings a
+    WHERE NOT EXISTS (SELECT 1 FROM main.bookings m WHERE m.id = a.id)'''
+
 def get_statistics():
-    with get_connection() as conn:
+    with get_readonly_connection(archive=True) as conn:
         c = conn.cursor(); s = {}
         s['total_users'] = c.execute('SELECT COUNT(*) FROM users').fetchone()[0]
         s['active_users'] = c.execute('SELECT COUNT(*) FROM users WHERE is_active=1').fetchone()[0]
         s['total_spots'] = c.execute('SELECT COUNT(*) FROM parking_spots WHERE is_available=1').fetchone()[0]
         s['total_bookings'] = c.execute('SELECT COUNT(*) FROM bookings').fetchone()[0]
+        if has_archive(conn):
+            s['total_bookings'] += c.execute(_ARCHIVE_ONLY_BOOKINGS_SQL).fetchone()[0]
         s['pending_bookings'] = c.execute("SELECT COUNT(*) FROM bookings WHERE status='pending'").fetchone()[0]
         s['confirmed_bookings'] = c.execute("SELECT COUNT(*) FROM bookings WHERE status='confirmed'").fetchone()[0]
         s['total_revenue'] = c.execute("SELECT COALESCE(SUM(total_price),0) FROM bookings WHERE status='confirmed'").fetchone()[0]
         return s
 
 def get_user_statistics(uid):
-    with get_connection() as conn:
+    with get_readonly_connection(archive=True) as conn:
         c = conn.cursor(); s = {}
         s['total_bookings'] = c.execute('SELECT COUNT(*) FROM bookings WHERE customer_id=?',(uid,)).fetchone()[0]
+        if has_archive(conn):
+            s['total_bookings'] += c.execute(_ARCHIVE_ONLY_BOOKINGS_SQL + ' AND a.customer_id=?', (uid,)).fetchone()[0]
         s['total_spots'] = c.execute('SELECT COUNT(*) FROM parking_spots WHERE supplier_id=? AND is_available=1',(uid,)).fetchone()[0]
         return s
 
 
-def get_slots_by_owner(owner_id):
-    cursor.execute(
-        "SELECT * FROM parkings WHERE owner_id = ?",
-        (owner_id,)
-    )
-    return cursor.fetchall()
-
-
-def update_booking_time(booking_id, start_time, end_time):
-    cursor.execute(
-        '''
-        UPDATE bookings
-        SET start_time = ?, end_time = ?
-        WHERE id = ? AND is_paid = 0
-        ''',
-        (start_time, end_time, booking_id)
-    )
-    conn.commit()
-
-
-def set_slot_address(slot_id, address):
-    cursor.execute(
-        "UPDATE parkings SET address = ? WHERE id = ?",
-        (address, slot_id)
-    )
-    conn.commit()
-
-
 def merge_free_availability(spot_id: int) -> int:
     """Схлопывает соседние свободные интервалы availability для одного spot_id.
     Возвращает количество выполненных склеек.
     """
     merges = 0
     with get_connection() as conn:
+        mark_availability_changed()
         c = conn.cursor()
         rows = c.execute(
             """SELECT id, start_time, end_time
@@ -738,6 +1931,7 @@ def confirm_booking_idempotent(bid: int):
         c.execute("UPDATE bookings SET status='confirmed' WHERE id=? AND status='paid_wait_admin'", (bid,))
         if c.rowcount > 0:
             _log(c, 'booking_confirmed', booking_id=bid)
+            _schedule_reminders(c, bid)
             return True, 'confirmed'
         # если параллельно изменили
         b2 = c.execute("SELECT status FROM bookings WHERE id=?", (bid,)).fetchone()
@@ -746,82 +1940,68 @@ def confirm_booking_idempotent(bid: int):
         return False, 'invalid'
 
 
-def expire_unpaid_bookings(timeout_minutes: int = 30):
-    """Истекает неоплаченные брони pending/unpaid старше timeout_minutes.
+_EXPIRE_SELECT = '''SELECT b.id, b.availability_id, b.spot_id, b.start_time, b.end_time,
+                         u.telegram_id as customer_telegram_id
+                  FROM bookings b
+                  JOIN users u ON b.customer_id=u.id
+                  WHERE b.status='pending' AND b.payment_status='unpaid' AND '''
 
-    Возвращает список dict: {booking_id, customer_telegram_id}
-    """
+def _expire_rows(c, rows):
     expired = []
-    cutoff = (now_local() - timedelta(minutes=timeout_minutes)).strftime("%Y-%m-%d %H:%M:%S")
-    with get_connection() as conn:
-        c = conn.cursor()
-        # Блокируем запись, чтобы не было гонок с оплатой/отменой
-        conn.execute("BEGIN IMMEDIATE")
-        rows = c.execute(
-            '''SELECT b.id, b.availability_id, b.spot_id, b.start_time, b.end_time,
-                      u.telegram_id as customer_telegram_id
-               FROM bookings b
-               JOIN users u ON b.customer_id=u.id
-               WHERE b.status='pending' AND b.payment_status='unpaid' AND b.created_at <= ?''',
-            (cutoff,)
-        ).fetchall()
-
-        for r in rows:
-            bid = r['id']
-            # переводим в expired
-            c.execute("UPDATE bookings SET status='expired' WHERE id=? AND status='pending'", (bid,))
-            if c.rowcount == 0:
-                continue
-            # освобождаем availability до времени брони и чистим привязку
-            c.execute(
-                '''UPDATE spot_availability
-                   SET is_booked=0, booked_by=NULL, booking_id=NULL, start_time=?, end_time=?
-                   WHERE id=?''',
-                (r['start_time'], r['end_time'], r['availability_id'])
-            )
-            _log(c, 'booking_expired', booking_id=bid, spot_id=r['spot_id'])
-            try:
-                merge_free_availability(r['spot_id'])
-            except Exception:
-                pass
-            expired.append({'booking_id': bid, 'customer_telegram_id': r['customer_telegram_id']})
+    for r in rows:
+        bid = r['id']
+        # переводим в expired
+        c.execute("UPDATE bookings SET status='expired' WHERE id=? AND status='pending'", (bid,))
+        if c.rowcount == 0:
+            continue
+        # освобождаем availability до времени брони и чистим привязку
+        c.execute(
+            '''UPDATE spot_availability
+               SET is_booked=0, booked_by=NULL, booking_id=NULL, start_time=?, end_time=?
+               WHERE id=?''',
+            (r['start_time'], r['end_time'], r['availability_id'])
+        )
+        _log(c, 'booking_expired', booking_id=bid, spot_id=r['spot_id'])
+        try:
+            merge_free_availability(r['spot_id'])
+        except Exception:
+            pass
+        expired.append({'booking_id': bid, 'customer_telegram_id': r['customer_telegram_id']})
     return expired
 
 
-def get_nearest_free_slots(limit: int = 10, days: int = 7):
-    """Возвращает ближайшие свободные интервалы на ближайшие days дней.
-    Адрес возвращаем, но UI может скрыть до подтверждения.
-    """
+def expire_unpaid_booking(bid: int):
+    """Истекает бронь bid, если она всё ещё не оплачена (задача 'booking_expire').
+
+    Возвращает {booking_id, customer_telegram_id} или None."""
     with get_connection() as conn:
         c = conn.cursor()
-        now = now_local().strftime("%Y-%m-%d %H:%M:%S")
-        to = (now_local() + timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
-        rows = c.execute(
-            '''SELECT sa.id as availability_id, sa.spot_id, sa.start_time, sa.end_time,
+        _begin_immediate(conn)
+        expired = _expire_rows(c, c.execute(_EXPIRE_SELECT + 'b.id = ?', (bid,)).fetchall())
+        if expired:
+            mark_availability_changed()
+        return expired[0] if expired else None
+
+
+_NEAREST_FREE_SLOTS_SQL = '''SELECT sa.id as availability_id, sa.spot_id, sa.start_time, sa.end_time,
                       ps.spot_number, ps.price_per_hour, ps.address, ps.supplier_id
                FROM spot_availability sa
                JOIN parking_spots ps ON sa.spot_id = ps.id
                WHERE sa.is_booked=0 AND ps.is_available=1
                  AND sa.start_time >= ? AND sa.start_time <= ?
                ORDER BY sa.start_time ASC
-               LIMIT ?''',
-            (now, to, limit)
-        ).fetchall()
-        return [dict(r) for r in rows]
-
+               LIMIT ?'''
 
-def cleanup_old_bookings(days: int = 30) -> int:
-    """Удаляет старые expired/cancelled брони старше days дней. Возвращает кол-во."""
+def get_nearest_free_slots(limit: int = 10, days: int = 7):
+    """Возвращает ближайшие свободные интервалы на ближайшие days дней.
+    Адрес возвращаем, но UI может скрыть до подтверждения.
+    """
     with get_connection() as conn:
         c = conn.cursor()
-        cutoff = (now_local() - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
-        c.execute(
-            """DELETE FROM bookings
-                 WHERE status IN ('expired','cancelled')
-                   AND created_at < ?""",
-            (cutoff,)
-        )
-        return c.rowcount
+        now = now_local().strftime("%Y-%m-%d %H:%M:%S")
+        to = (now_local() + timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+        rows = c.execute(_NEAREST_FREE_SLOTS_SQL, (now, to, limit)).fetchall()
+        return [dict(r) for r in rows]
 
 
 def get_booking_full(bid: int):
@@ -856,48 +2036,32 @@ def decline_payment(bid: int, reason: str = "") -> bool:
         return ok
 
 
-def init_db():
-    pass
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS slot_confirms (
-            id TEXT PRIMARY KEY,
-            user_id INTEGER NOT NULL,
-            spot_number TEXT NOT NULL,
-            start_time TEXT NOT NULL,
-            end_time TEXT NOT NULL,
-            price REAL NOT NULL,
-            created_at TEXT NOT NULL
-        )
-    ''')
-
-import uuid
-from datetime import datetime
-
 def create_slot_confirm(user_id: int, spot_number: str, start_time: str, end_time: str, price: float) -> str:
     cid = str(uuid.uuid4())
-    cursor.execute(
-        "INSERT INTO slot_confirms (id, user_id, spot_number, start_time, end_time, price, created_at) VALUES (?,?,?,?,?,?,?)",
-        (cid, user_id, spot_number, start_time, end_time, float(price), datetime.now().isoformat(timespec="seconds"))
-    )
-    conn.commit()
+    with get_connection() as conn:
+        conn.cursor().execute(
+            "INSERT INTO slot_confirms (id, user_id, spot_number, start_time, end_time, price, created_at) VALUES (?,?,?,?,?,?,?)",
+            (cid, user_id, spot_number, start_time, end_time, float(price), datetime.now().isoformat(timespec="seconds"))
+        )
     return cid
 
 def get_slot_confirm(cid: str):
-    cursor.execute("SELECT id, user_id, spot_number, start_time, end_time, price, created_at FROM slot_confirms WHERE id = ?", (cid,))
-    row = cursor.fetchone()
-    if not row:
-        return None
-    return {
-        "id": row[0],
-        "user_id": row[1],
-        "spot_number": row[2],
-        "start_time": row[3],
-        "end_time": row[4],
-        "price": row[5],
-        "created_at": row[6],
-    }
+    with get_connection() as conn:
+        r = conn.cursor().execute(
+            "SELECT id, user_id, spot_number, start_time, end_time, price, created_at FROM slot_confirms WHERE id = ?",
+            (cid,)).fetchone()
+        return dict(r) if r else None
 
 def delete_slot_confirm(cid: str):
-    cursor.execute("DELETE FROM slot_confirms WHERE id = ?", (cid,))
-    conn.commit()
+    with get_connection() as conn:
+        return conn.cursor().execute("DELETE FROM slot_confirms WHERE id = ?", (cid,)).rowcount > 0
+
+
+if __name__ == '__main__':
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:] == ['rebuild-ratings']:
+        init_database()
+        print(f"rating_aggregates: {rebuild_rating_aggregates()} rows")
+    else:
+        print("usage: python database.py rebuild-ratings")
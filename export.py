@@ -0,0 +1,95 @@
+"""
+Выгрузка базы в Excel
+
+Строки читаются из одного снимка БД (db.get_readonly_connection, вместе с
+архивом) пачками по EXPORT_CHUNK_ROWS и сразу пишутся в книгу openpyxl в
+режиме write_only: в памяти не держится ни таблица, ни лист целиком. Сборка
+идёт в рабочем потоке (asyncio.to_thread), бот в это время отвечает всем;
+поток обновляет словарь прогресса, run() раз в EXPORT_PROGRESS_SECONDS
+передаёт его в on_progress. Одновременно собирается одна выгрузка.
+
+    path = await export.run(['bookings'], '2024-01-01', '2024-01-31', on_progress)
+"""
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+from openpyxl import Workbook
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+
+import database as db
+from config import EXPORT_CHUNK_ROWS, EXPORT_PROGRESS_SECONDS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TABLES = ('users', 'parking_spots', 'spot_availability', 'bookings')
+MAX_SHEET_ROWS = 1_048_575   # предел строк листа Excel без заголовка
+
+_lock = asyncio.Lock()
+
+
+class ExportBusy(Exception):
+    pass
+
+
+def _clean(value):
+    # Управляющие символы (бывают в текстах пользователей) openpyxl не записывает
+    return ILLEGAL_CHARACTERS_RE.sub('', value) if isinstance(value, str) else value
+
+
+def build_excel(tables, date_from=None, date_to=None, progress=None):
+    """Собирает xlsx; возвращает путь к временному файлу.
+    progress — словарь, куда пишутся table, rows, total."""
+    progress = progress if progress is not None else {}
+    wb = Workbook(write_only=True)
+    with db.get_readonly_connection(archive=True) as conn:
+        queries = {t: db.export_query(conn, t, date_from, date_to) for t in tables}
+        progress['total'] = sum(conn.execute(count_sql, params).fetchone()[0]
+                                for _, count_sql, params in queries.values())
+        progress['rows'] = 0
+        for table, (sql, _, params) in queries.items():
+            progress['table'] = table
+            cur = conn.execute(sql, params)
+            headers = [d[0] for d in cur.description]
+            ws, sheet_rows, part = None, MAX_SHEET_ROWS, 1
+            while rows := cur.fetchmany(EXPORT_CHUNK_ROWS):
+                for r in rows:
+                    if sheet_rows >= MAX_SHEET_ROWS:
+                        ws = wb.create_sheet(title=table[:27] if part == 1 else f'{table[:27]} ({part})')
+                        ws.append(headers)
+                        sheet_rows, part = 0, part + 1
+                    ws.append([_clean(v) for v in r])
+                    sheet_rows += 1
+                progress['rows'] += len(rows)
+            if ws is None:
+                wb.create_sheet(title=table[:31]).append(headers)
+    fd, path = tempfile.mkstemp(suffix='.xlsx')
+    os.close(fd)
+    try:
+        wb.save(path)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+
+async def run(tables, date_from=None, date_to=None, on_progress=None):
+    """Собирает выгрузку в рабочем потоке. on_progress(progress) — корутина.
+    ExportBusy, если другая выгрузка ещё идёт."""
+    if _lock.locked():
+        raise ExportBusy()
+    async with _lock:
+        progress = {}
+        started = time.monotonic()
+        task = asyncio.ensure_future(asyncio.to_thread(build_excel, tables, date_from, date_to, progress))
+        while not task.done():
+            await asyncio.wait([task], timeout=EXPORT_PROGRESS_SECONDS)
+            if on_progress and not task.done() and progress:
+                await on_progress(dict(progress))
+        path = task.result()
+        logger.info(f"Excel export {','.join(tables)} {date_from or ''}..{date_to or ''}: "
+                    f"{progress.get('rows', 0)} rows, {os.path.getsize(path)} bytes "
+                    f"in {time.monotonic() - started:.1f}s")
+        return path
@@ -0,0 +1,276 @@
+"""
+Хранилища FSM ParkingBot
+
+SQLiteStorage держит состояния в таблице fsm_states базы бота, поэтому
+рестарт/деплой не сбрасывает начатые сценарии (бронирование, добавление места).
+Чтения идут из кэша в памяти, изменения помечаются «грязными» и пишутся
+пачкой раз в FSM_FLUSH_INTERVAL_SECONDS (одна операция писателя на пачку,
+а не запись в БД на каждое нажатие кнопки).
+
+BoundedMemoryStorage — вариант без БД: ограниченный по числу ключей и
+времени простоя, чтобы брошенные сценарии не копились в памяти.
+
+ChatEventIsolation — порядок апдейтов внутри чата при параллельной обработке.
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import date, datetime
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+import adb
+from config import (FSM_STORAGE, FSM_FLUSH_INTERVAL_SECONDS, FSM_CACHE_SIZE,
+                    FSM_MAX_ENTRIES, FSM_IDLE_TTL_SECONDS, UPDATES_CONCURRENCY)
+
+logger = logging.getLogger(__name__)
+
+
+# ==================== SERIALIZATION ====================
+# Компактный JSON; datetime/date (slot_start, booking_start_date и т.п.)
+# кодируются как {"$dt": iso} / {"$d": iso} и восстанавливаются при чтении.
+def _encode(v):
+    if isinstance(v, datetime):
+        return {"$dt": v.isoformat()}
+    if isinstance(v, date):
+        return {"$d": v.isoformat()}
+    raise TypeError(f"FSM data: unsupported type {type(v).__name__}")
+
+def _decode(d):
+    if len(d) == 1:
+        if "$dt" in d: return datetime.fromisoformat(d["$dt"])
+        if "$d" in d: return date.fromisoformat(d["$d"])
+    return d
+
+def dumps(data):
+    return json.dumps(data, default=_encode, ensure_ascii=False, separators=(",", ":"))
+
+def loads(s):
+    return json.loads(s, object_hook=_decode) if s else {}
+
+
+# ==================== SQLITE STORAGE ====================
+class SQLiteStorage(BaseStorage):
+    """FSM в SQLite с write-behind кэшем.
+
+    Промах кэша — одно чтение из БД; запись — только отметка в памяти.
+    Кэш ограничен cache_size (LRU), вытесняются лишь уже записанные ключи."""
+
+    def __init__(self, flush_interval=FSM_FLUSH_INTERVAL_SECONDS, cache_size=FSM_CACHE_SIZE):
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self._cache = OrderedDict()   # ключ -> [state, data]
+        self._dirty = set()
+        self._flush_task = None
+        self.stats = {'hits': 0, 'misses': 0, 'flushes': 0, 'rows_written': 0}
+
+    @staticmethod
+    def _key(key: StorageKey):
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+    async def _entry(self, key: StorageKey):
+        k = self._key(key)
+        entry = self._cache.get(k)
+        if entry is None:
+            self.stats['misses'] += 1
+            row = await adb.load_fsm_state(k)
+            # пока ждали БД, ключ мог появиться в кэше — он свежее
+            entry = self._cache.setdefault(k, [row[0], loads(row[1])] if row else [None, {}])
+        else:
+            self.stats['hits'] += 1
+        self._cache.move_to_end(k)
+        return k, entry
+
+    def _touch(self, k):
+        self._dirty.add(k)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def set_state(self, key: StorageKey, state=None):
+        k, entry = await self._entry(key)
+        entry[0] = state.state if isinstance(state, State) else state
+        self._touch(k)
+
+    async def get_state(self, key: StorageKey):
+        return (await self._entry(key))[1][0]
+
+    async def set_data(self, key: StorageKey, data):
+        k, entry = await self._entry(key)
+        entry[1] = data.copy()
+        self._touch(k)
+
+    async def get_data(self, key: StorageKey):
+        return (await self._entry(key))[1][1].copy()
+
+    async def flush(self):
+        """Пишет все грязные ключи одной операцией. Возвращает число строк."""
+        if not self._dirty:
+            return 0
+        keys, self._dirty = self._dirty, set()
+        rows = [(k, self._cache[k][0], dumps(self._cache[k][1])) for k in keys]
+        try:
+            await adb.save_fsm_states(rows)
+        except BaseException:
+            self._dirty |= keys
+            raise
+        self.stats['flushes'] += 1
+        self.stats['rows_written'] += len(rows)
+        self._evict()
+        return len(rows)
+
+    def _evict(self):
+        if len(self._cache) <= self.cache_size:
+            return
+        for k in list(self._cache):
+            if len(self._cache) <= self.cache_size:
+                break
+            if k not in self._dirty:
+                del self._cache[k]
+
+    async def _flush_loop(self):
+        while self._dirty:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"FSM flush error: {e}")
+
+    async def close(self):
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+
+# ==================== BOUNDED MEMORY STORAGE ====================
+# Примерные накладные расходы на запись (StorageKey, list, dict) сверх JSON данных
+_ENTRY_OVERHEAD = 300
+
+class BoundedMemoryStorage(BaseStorage):
+    """FSM в памяти с ограничением: не больше max_entries ключей (LRU) и
+    вытеснение ключей, к которым не обращались дольше idle_ttl секунд.
+
+    Пустые состояния не хранятся. stats() — число ключей и оценка байт."""
+
+    def __init__(self, max_entries=FSM_MAX_ENTRIES, idle_ttl=FSM_IDLE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self._entries = OrderedDict()   # StorageKey -> [state, data, время доступа, байт]
+        self._bytes = 0
+        self.evicted = 0
+        self.expired = 0
+
+    def _expire(self, now):
+        # OrderedDict упорядочен по последнему доступу: простаивающие — в начале
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if now - entry[2] <= self.idle_ttl:
+                break
+            self._drop(key)
+            self.expired += 1
+
+    def _drop(self, key):
+        self._bytes -= self._entries.pop(key)[3]
+
+    def _get(self, key):
+        now = time.monotonic()
+        self._expire(now)
+        entry = self._entries.get(key)
+        if entry:
+            entry[2] = now
+            self._entries.move_to_end(key)
+        return entry
+
+    def _put(self, key, state, data):
+        entry = self._get(key)
+        if entry:
+            self._drop(key)
+        if state is None and not data:
+            return
+        size = _ENTRY_OVERHEAD + len(state or '') + len(dumps(data))
+        self._entries[key] = [state, data, time.monotonic(), size]
+        self._bytes += size
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+            self.evicted += 1
+
+    async def set_state(self, key: StorageKey, state=None):
+        entry = self._get(key)
+        self._put(key, state.state if isinstance(state, State) else state, entry[1] if entry else {})
+
+    async def get_state(self, key: StorageKey):
+        entry = self._get(key)
+        return entry[0] if entry else None
+
+    async def set_data(self, key: StorageKey, data):
+        entry = self._get(key)
+        self._put(key, entry[0] if entry else None, data.copy())
+
+    async def get_data(self, key: StorageKey):
+        entry = self._get(key)
+        return entry[1].copy() if entry else {}
+
+    def stats(self):
+        self._expire(time.monotonic())
+        return {'entries': len(self._entries), 'bytes': self._bytes,
+                'evicted': self.evicted, 'expired': self.expired}
+
+    async def close(self):
+        pass
+
+
+# ==================== EVENT ISOLATION ====================
+class ChatEventIsolation(BaseEventIsolation):
+    """Апдейты обрабатываются задачами параллельно, но апдейты одного чата — строго
+    по очереди (FIFO-замок на чат), а одновременно работает не больше limit хендлеров.
+
+    FSMContextMiddleware берёт lock() до чтения состояния, поэтому переходы FSM
+    одного пользователя не пересекаются. Слот общего лимита занимается уже после
+    замка чата: очередь одного чата не держит слоты остальных."""
+
+    def __init__(self, limit=UPDATES_CONCURRENCY):
+        self._slots = asyncio.Semaphore(limit)
+        self._chats = {}   # (bot_id, chat_id) -> [Lock, апдейтов в очереди]
+        self.active = 0
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey):
+        k = (key.bot_id, key.chat_id)
+        chat = self._chats.get(k)
+        if chat is None:
+            chat = self._chats[k] = [asyncio.Lock(), 0]
+        chat[1] += 1
+        try:
+            async with chat[0], self._slots:
+                self.active += 1
+                try:
+                    yield
+                finally:
+                    self.active -= 1
+        finally:
+            chat[1] -= 1
+            if not chat[1]:
+                del self._chats[k]
+
+    def stats(self):
+        return {'active': self.active, 'chats': len(self._chats)}
+
+    async def close(self):
+        self._chats.clear()
+
+
+def create_storage():
+    """Хранилище FSM по config.FSM_STORAGE."""
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    if FSM_STORAGE == "bounded":
+        return BoundedMemoryStorage()
+    return SQLiteStorage()
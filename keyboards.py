@@ -77,9 +77,18 @@ def get_time_slots_keyboard(prefix, min_dt=None):
 
 
 # ==================== SLOTS ====================
-def get_available_slots_keyboard(slots):
+SLOTS_PAGE_SIZE = 20
+
+def format_rating(rating):
+    """(средний, количество) → « ⭐4.5», пусто если отзывов нет."""
+    if not rating or not rating[1]: return ""
+    return f" ⭐{rating[0]}"
+
+def get_available_slots_keyboard(slots, ratings=None):
+    """ratings: {spot_id: (средний, количество)} для слотов страницы (db.get_spot_ratings)."""
+    ratings = ratings or {}
     buttons = []
-    for slot in slots[:20]:
+    for slot in slots[:SLOTS_PAGE_SIZE]:
         start = datetime.fromisoformat(slot['start_time'])
         end = datetime.fromisoformat(slot['end_time'])
         sd = start.strftime('%d.%m')
@@ -88,7 +97,7 @@ def get_available_slots_keyboard(slots):
             date_text = f"{sd} {start.strftime('%H:%M')}-{end.strftime('%H:%M')}"
         else:
             date_text = f"{sd}-{ed} {start.strftime('%H:%M')}-{end.strftime('%H:%M')}"
-        text = f"🏠 {slot['spot_number']} | {date_text}"
+        text = f"🏠 {slot['spot_number']}{format_rating(ratings.get(slot['spot_id']))} | {date_text}"
         buttons.append([InlineKeyboardButton(text=text, callback_data=f"slot_{slot['id']}")])
     buttons.append([InlineKeyboardButton(text="📅 Фильтр по дате", callback_data="search_filter")])
     buttons.append([InlineKeyboardButton(text="🔔 Уведомить", callback_data="notify_available")])
@@ -129,7 +138,7 @@ def get_booking_detail_keyboard(booking, user_id):
     buttons = []
     if booking['status'] in ('pending','confirmed'):
         buttons.append([InlineKeyboardButton(text="❌ Отменить", callback_data=f"cancel_booking_{booking['id']}")])
-    if booking['status'] == 'completed' and not booking.get('reviewed'):
+    if booking['status'] == 'completed' and not booking.get('reviewed') and not booking.get('archived'):
         buttons.append([InlineKeyboardButton(text="⭐ Отзыв", callback_data=f"review_start_{booking['id']}")])
     buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_bookings")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
@@ -246,6 +255,23 @@ def get_broadcast_target_keyboard():
     ])
 
 
+EXPORT_TABLE_LABELS = {
+    'users': 'Пользователи', 'parking_spots': 'Места', 'spot_availability': 'Слоты',
+    'bookings': 'Брони', 'reviews': 'Отзывы', 'admin_logs': 'Журнал админов',
+}
+EXPORT_PERIOD_LABELS = {'all': 'Всё время', '7': '7 дней', '30': '30 дней', 'custom': '📅 Свой'}
+
+def get_export_keyboard(selected, period):
+    tables = [InlineKeyboardButton(text=("✅ " if t in selected else "▫️ ") + label, callback_data=f"xls_t_{t}")
+              for t, label in EXPORT_TABLE_LABELS.items()]
+    periods = [InlineKeyboardButton(text=("• " if p == period else "") + label, callback_data=f"xls_p_{p}")
+               for p, label in EXPORT_PERIOD_LABELS.items()]
+    return InlineKeyboardMarkup(inline_keyboard=[tables[i:i + 2] for i in range(0, len(tables), 2)] + [
+        periods,
+        [InlineKeyboardButton(text="📥 Выгрузить", callback_data="xls_go")],
+        [InlineKeyboardButton(text="🔙 Панель", callback_data="admin_panel")]
+    ])
+
 def address_keyboard():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="", callback_data="noop")],
@@ -0,0 +1,77 @@
+"""
+Middleware ParkingBot
+"""
+from datetime import datetime
+
+from aiogram import BaseMiddleware
+from aiogram.types import Message
+
+import adb
+import database as db
+from utils import format_datetime
+
+# Что доступно без регистрации
+PUBLIC_TEXTS = {"ℹ️ О сервисе", "📜 Правила"}
+PUBLIC_STATE_PREFIX = "RegistrationStates:"
+
+# Счётчики апдейтов: на апдейт middleware читает текущего пользователя ровно
+# один раз. database.user_cache_stats считает все чтения users через кэш,
+# включая чтения других пользователей в хендлерах (поставщик при оплате,
+# карточка пользователя в админке), поэтому там hits + misses >= updates.
+user_context_stats = {'updates': 0, 'unregistered': 0, 'banned': 0}
+
+
+def _is_public(event, raw_state):
+    if raw_state and raw_state.startswith(PUBLIC_STATE_PREFIX):
+        return True
+    if not isinstance(event, Message) or not event.text:
+        return False
+    text = event.text.strip()
+    return text in PUBLIC_TEXTS or text.split()[0].split("@")[0] == "/start"
+
+
+def _ban_text(reason, until):
+    t = "🚫 Вы заблокированы"
+    if until: t += f" до {format_datetime(datetime.fromisoformat(until))}"
+    else: t += " навсегда"
+    if reason: t += f"\n📝 Причина: {reason}"
+    return t
+
+
+async def _reply(event, text):
+    if isinstance(event, Message): await event.answer(text, parse_mode="HTML")
+    else: await event.answer(text, show_alert=True)
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """Outer-middleware для message/callback_query: один раз на апдейт читает
+    пользователя и кладёт в data user (dict или None) и is_admin.
+    Незарегистрированных (кроме /start и регистрации) и забаненных дальше не пускает."""
+
+    async def __call__(self, handler, event, data):
+        tg_user = getattr(event, "from_user", None)
+        if tg_user is None:
+            return await handler(event, data)
+        user_context_stats['updates'] += 1
+        user = await adb.get_user_by_telegram_id(tg_user.id)
+        if user:
+            # Реестр банов в памяти (database.py), без запроса к БД
+            banned, reason, until = db.is_user_banned(user)
+            if banned:
+                user_context_stats['banned'] += 1
+                await _reply(event, _ban_text(reason, until))
+                return None
+        if user is None and not _is_public(event, data.get("raw_state")):
+            user_context_stats['unregistered'] += 1
+            await _reply(event, "❌ Сначала /start")
+            return None
+        data["user"] = user
+        data["is_admin"] = bool(user and user['role'] == 'admin')
+        return await handler(event, data)
+
+
+def setup(dp):
+    """Подключает middleware к диспетчеру (до фильтров всех роутеров)."""
+    mw = UserContextMiddleware()
+    dp.message.outer_middleware(mw)
+    dp.callback_query.outer_middleware(mw)
@@ -0,0 +1,127 @@
+"""
+Доставка уведомлений из notification_outbox
+
+Код, меняющий БД, кладёт уведомление в outbox в своей транзакции
+(db.enqueue_notification или notify()/notify_many() из хендлеров), а
+OUTBOX_WORKERS корутин отправляют его после COMMIT с общим лимитом скорости.
+Сетевые ошибки повторяются с экспоненциальной задержкой до OUTBOX_MAX_ATTEMPTS
+попыток, заблокировавшие бота и прочие окончательные ошибки сразу уходят в
+dead (dead-letter: строки остаются в таблице с last_error).
+"""
+import asyncio
+import logging
+from datetime import datetime
+
+from aiogram import Bot
+from aiogram.exceptions import (TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest,
+                                TelegramNetworkError, TelegramServerError)
+from aiogram.types import InlineKeyboardMarkup
+
+import adb
+import database as db
+from config import OUTBOX_WORKERS, OUTBOX_MAX_ATTEMPTS, OUTBOX_RETRY_BASE_SECONDS
+from ratelimit import telegram_limiter
+
+logger = logging.getLogger(__name__)
+
+# Страховочный опрос: новые записи и так будят диспетчер через db.set_outbox_listener
+IDLE_POLL_SECONDS = 60
+
+_task = None
+
+
+def markup_json(kb):
+    return kb.model_dump_json(exclude_none=True) if kb else None
+
+
+async def notify(chat_id, text, parse_mode=None, reply_markup=None):
+    """Ставит уведомление в очередь (отдельная запись; внутри записи в БД — db.enqueue_notification)."""
+    await adb.enqueue_notification(chat_id, text, parse_mode, markup_json(reply_markup))
+
+
+async def notify_many(chat_ids, text, parse_mode=None, reply_markup=None):
+    """Одно сообщение нескольким получателям одной транзакцией."""
+    kb = markup_json(reply_markup)
+    def _enqueue():
+        for chat_id in chat_ids:
+            db.enqueue_notification(chat_id, text, parse_mode, kb)
+    await adb.run_write(_enqueue)
+
+
+async def _deliver(bot: Bot, n):
+    await telegram_limiter.acquire(n['chat_id'])
+    try:
+        await bot.send_message(n['chat_id'], n['text'], parse_mode=n['parse_mode'],
+                               reply_markup=InlineKeyboardMarkup.model_validate_json(n['reply_markup'])
+                               if n['reply_markup'] else None)
+    except TelegramRetryAfter as e:
+        telegram_limiter.retry_after(e.retry_after)
+        await adb.mark_notification_failed(n['id'], str(e)[:200], e.retry_after, OUTBOX_MAX_ATTEMPTS, False)
+    except (TelegramNetworkError, TelegramServerError) as e:
+        retry_in = OUTBOX_RETRY_BASE_SECONDS * 2 ** n['attempts']
+        if await adb.mark_notification_failed(n['id'], str(e)[:200], retry_in, OUTBOX_MAX_ATTEMPTS) == 'dead':
+            logger.warning(f"Notification {n['id']} dead after {OUTBOX_MAX_ATTEMPTS} attempts: {e}")
+    except (TelegramForbiddenError, TelegramBadRequest) as e:
+        await adb.mark_notification_failed(n['id'], str(e)[:200])
+        logger.warning(f"Notification {n['id']} to {n['chat_id']} dead: {e}")
+    else:
+        await adb.mark_notification_sent(n['id'])
+
+
+async def _worker(bot: Bot, queue: asyncio.Queue):
+    while True:
+        n = await queue.get()
+        try:
+            await _deliver(bot, n)
+        except Exception as e:
+            logger.error(f"Outbox delivery error: {e}")
+        finally:
+            queue.task_done()
+
+
+async def run(bot: Bot):
+    loop = asyncio.get_running_loop()
+    wake = asyncio.Event()
+    db.set_outbox_listener(lambda: loop.call_soon_threadsafe(wake.set))
+    queue = asyncio.Queue()
+    workers = [asyncio.create_task(_worker(bot, queue)) for _ in range(OUTBOX_WORKERS)]
+    try:
+        while True:
+            try:
+                wake.clear()
+                due = await adb.get_due_notifications(OUTBOX_WORKERS * 4)
+                if due:
+                    for n in due:
+                        queue.put_nowait(n)
+                    await queue.join()   # статусы записаны — следующая выборка их не увидит
+                    continue
+                next_at = await adb.next_notification_time()
+                timeout = IDLE_POLL_SECONDS
+                if next_at:
+                    timeout = min(timeout, max(0.0, (datetime.fromisoformat(next_at) - datetime.now()).total_seconds()))
+                try:
+                    await asyncio.wait_for(wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Outbox dispatcher error: {e}")
+                await asyncio.sleep(5)
+    finally:
+        db.set_outbox_listener(None)
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
+def start(bot: Bot):
+    global _task
+    if _task is None or _task.done():
+        _task = asyncio.create_task(run(bot))
+
+
+async def stop():
+    if _task and not _task.done():
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
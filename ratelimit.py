@@ -0,0 +1,73 @@
+"""
+Ограничение скорости отправки в Telegram
+
+Общий для бота token bucket (TELEGRAM_RATE_PER_SECOND сообщений в секунду)
+плюс интервал между сообщениями в один чат. RetryAfter от Telegram —
+ограничение на весь бот, поэтому retry_after() приостанавливает общий bucket.
+
+    await telegram_limiter.acquire(chat_id)
+    await bot.send_message(chat_id, text)
+"""
+import asyncio
+import time
+
+from config import TELEGRAM_RATE_PER_SECOND, TELEGRAM_CHAT_INTERVAL_SECONDS
+
+
+class TokenBucket:
+    """rate токенов в секунду, запас до burst. Ожидающие обслуживаются по очереди."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+class TelegramLimiter:
+    """Общий bucket + не чаще одного сообщения в chat_interval секунд в один чат."""
+
+    def __init__(self, rate=TELEGRAM_RATE_PER_SECOND, chat_interval=TELEGRAM_CHAT_INTERVAL_SECONDS):
+        self.bucket = TokenBucket(rate)
+        self.chat_interval = chat_interval
+        self._next_in_chat = {}   # chat_id -> monotonic-время, раньше которого писать нельзя
+
+    async def acquire(self, chat_id):
+        now = time.monotonic()
+        at = self._next_in_chat.get(chat_id, 0.0)
+        self._next_in_chat[chat_id] = max(at, now) + self.chat_interval
+        if at > now:
+            await asyncio.sleep(at - now)
+        await self.bucket.acquire()
+        if len(self._next_in_chat) > 10000:
+            self._forget(time.monotonic())
+
+    def retry_after(self, seconds):
+        self.bucket.pause(seconds)
+
+    def _forget(self, now):
+        for chat_id in [c for c, t in self._next_in_chat.items() if t < now]:
+            del self._next_in_chat[chat_id]
+
+
+telegram_limiter = TelegramLimiter()
@@ -0,0 +1,130 @@
+"""
+Восстановление базы ParkingBot из фоновой копии (backup.py)
+
+Бот должен быть остановлен. Поколение восстанавливается целиком: основная база
+и архив (ARCHIVE_DATABASE_PATH) из одного снимка. Если в поколении архива нет
+(его тогда ещё не было), текущий архив тоже убирается — иначе старая база
+оказалась бы рядом с более новым архивом. Текущие файлы (вместе с -wal) не
+удаляются, а переименовываются в <файл>.before-restore-ГГГГММДД-ЧЧММСС.
+
+    python restore.py --list                      # поколения в BACKUP_DIR
+    python restore.py                             # последнее поколение
+    python restore.py --at "2025-01-31 18:00"     # последнее не позже момента
+    python restore.py path/to/parking-....        # каталог поколения или файл копии
+                                                  # (отдельный файл — только основная база)
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime
+
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except Exception:
+    pass
+
+import backup
+from config import DATABASE_PATH, ARCHIVE_DATABASE_PATH, BACKUP_DIR
+from utils import now_local
+
+
+def _pick(args):
+    if args.file:
+        return args.file
+    generations = backup.list_generations(args.dir)
+    if args.at:
+        fmt = "%Y-%m-%d %H:%M:%S" if args.at.count(':') == 2 else "%Y-%m-%d %H:%M"
+        at = datetime.strptime(args.at, fmt)
+        generations = [g for g in generations if g[0] <= at]
+    if not generations:
+        sys.exit("❌ Нет подходящих копий в " + args.dir)
+    return generations[0][1]
+
+
+def _unpack(src, dest):
+    for suffix, opener in backup.COMPRESSORS.values():
+        if src.endswith(suffix):
+            with opener(src, 'rb') as f_in, open(dest, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+            return
+    shutil.copyfile(src, dest)
+
+
+def _set_aside(path, stamp):
+    """Переименовывает файл базы (и его -wal) в .before-restore-*, удаляет -shm. Возвращает новое имя."""
+    aside = None
+    if os.path.exists(path):
+        aside = f"{path}.before-restore-{stamp}"
+        os.replace(path, aside)
+        if os.path.exists(path + '-wal'):
+            os.replace(path + '-wal', aside + '-wal')
+    if os.path.exists(path + '-shm'):
+        os.remove(path + '-shm')
+    return aside
+
+
+def restore(src, db_path=DATABASE_PATH, archive_path=ARCHIVE_DATABASE_PATH):
+    """Распаковывает и проверяет копии рядом с базой, затем подменяет базу и архив.
+    src — каталог поколения или отдельный файл (тогда только основная база).
+    Возвращает {путь: куда отложен прежний файл}."""
+    if os.path.isdir(src):
+        files = backup.generation_files(src, db_path, archive_path)
+        if 'main' not in files:
+            raise backup.BackupError(f"в {src} нет копии {os.path.basename(db_path)}")
+        targets = {db_path: files['main'], archive_path: files.get('archive')}
+    else:
+        targets = {db_path: src}
+    unpacked = {}
+    try:
+        for target, copy in targets.items():
+            if copy is None:
+                continue
+            fd, unpacked[target] = tempfile.mkstemp(prefix=os.path.basename(target) + '.restore.',
+                                                    dir=os.path.dirname(os.path.abspath(target)))
+            os.close(fd)
+            _unpack(copy, unpacked[target])
+            backup.check(unpacked[target])
+    except Exception:
+        for tmp in unpacked.values():
+            os.remove(tmp)
+        raise
+    stamp = f"{now_local(precise=True):%Y%m%d-%H%M%S}"
+    moved = {}
+    for target in targets:
+        aside = _set_aside(target, stamp)
+        if aside:
+            moved[target] = aside
+        if target in unpacked:
+            os.replace(unpacked[target], target)
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Восстановление базы из резервной копии (бот должен быть остановлен)")
+    parser.add_argument('file', nargs='?', help="каталог поколения или файл копии (по умолчанию — последнее поколение)")
+    parser.add_argument('--at', help="последняя копия не позже момента 'ГГГГ-ММ-ДД ЧЧ:ММ[:СС]'")
+    parser.add_argument('--dir', default=BACKUP_DIR, help="каталог копий (BACKUP_DIR)")
+    parser.add_argument('--list', action='store_true', help="показать поколения и выйти")
+    parser.add_argument('-y', '--yes', action='store_true', help="без подтверждения")
+    args = parser.parse_args()
+
+    if args.list:
+        for at, path in backup.list_generations(args.dir):
+            size = sum(os.path.getsize(f) for f in backup.generation_files(path).values())
+            print(f"{at:%Y-%m-%d %H:%M:%S}  {size / 1e6:8.1f} МБ  {path}")
+        return
+    src = _pick(args)
+    what = f"{DATABASE_PATH} и {ARCHIVE_DATABASE_PATH}" if os.path.isdir(src) else DATABASE_PATH
+    if not args.yes and input(f"Заменить {what} копией {src}? [y/N] ").strip().lower() != 'y':
+        sys.exit("Отменено.")
+    moved = restore(src)
+    print(f"✅ {what}: восстановлено из {src}")
+    for path, aside in moved.items():
+        print(f"Прежний {os.path.basename(path)}: {aside}")
+
+
+if __name__ == "__main__":
+    main()
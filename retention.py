@@ -0,0 +1,81 @@
+"""
+Очистка старых данных по политикам хранения (database.RETENTION_POLICIES)
+
+Вместо одного UPDATE/DELETE по всей таблице — пачки по RETENTION_BATCH_SIZE
+строк, каждая отдельной короткой операцией писателя, с паузой
+RETENTION_PAUSE_SECONDS между пачками: брони и оплаты проходят между ними.
+Сроки хранения — RETENTION_*_DAYS и ARCHIVE_*_DAYS в config.py (0 — политика
+выключена). Архивные политики переносят строки в файл архива своим
+соединением в рабочем потоке, минуя писателя (ATTACH нельзя в его транзакции).
+run() возвращает отчёт {политика: {rows, batches, seconds}} и пишет его в лог.
+"""
+import asyncio
+import logging
+import time
+
+import adb
+import database as db
+from config import RETENTION_BATCH_SIZE, RETENTION_PAUSE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+last_report = {}
+
+
+async def _apply(name, cutoff, conns):
+    """Все пачки одной политики. Возвращает (строк, пачек).
+    conns — соединения на время run(): архив открывается при первой архивной пачке."""
+    policy = db.RETENTION_POLICIES[name]
+    rows = batches = 0
+    if policy['mode'] == 'range':
+        bounds = await adb.retention_bounds(name, cutoff)
+        if not bounds:
+            return 0, 0
+        after, hi = bounds
+        if policy.get('archive') and 'archive' not in conns:
+            conns['archive'] = await asyncio.to_thread(db.open_archive_connection)
+        while after <= hi:
+            if policy.get('archive'):
+                n, after = await asyncio.to_thread(db.archive_batch, conns['archive'], name, cutoff, after)
+            else:
+                n, after = await adb.retention_batch(name, cutoff, after)
+            rows += n
+            batches += 1
+            await asyncio.sleep(RETENTION_PAUSE_SECONDS)
+        return rows, batches
+    after = None
+    while True:
+        n, after = await adb.retention_batch(name, cutoff, after)
+        rows += n
+        batches += 1
+        if n < RETENTION_BATCH_SIZE:
+            return rows, batches
+        await asyncio.sleep(RETENTION_PAUSE_SECONDS)
+
+
+async def run(names=None):
+    """Применяет политики (все или names) по очереди."""
+    report = {}
+    conns = {}
+    started = time.monotonic()
+    try:
+        for name, policy in db.RETENTION_POLICIES.items():
+            if (names and name not in names) or policy['days'] <= 0:
+                continue
+            t0 = time.monotonic()
+            try:
+                rows, batches = await _apply(name, db.retention_cutoff(name), conns)
+            except Exception as e:
+                logger.error(f"Retention {name} failed: {e}")
+                continue
+            report[name] = {'rows': rows, 'batches': batches, 'seconds': round(time.monotonic() - t0, 3)}
+            if rows:
+                logger.info(f"Retention {name}: {rows} rows in {batches} batches, {report[name]['seconds']}s")
+    finally:
+        for conn in conns.values():
+            conn.close()
+    total = sum(r['rows'] for r in report.values())
+    logger.info(f"Retention done: {total} rows in {time.monotonic() - started:.1f}s")
+    last_report.clear()
+    last_report.update(report)
+    return report
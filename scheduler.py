@@ -0,0 +1,154 @@
+"""
+Планировщик отложенных задач ParkingBot
+
+Задачи хранятся в scheduled_jobs (database.py) и в min-heap по сроку: цикл
+спит ровно до ближайшего срока или до появления новой задачи, а не
+просматривает таблицы по таймеру. Обработчик — синхронная функция, она
+выполняется в потоке писателя в одной транзакции с claim_job(), поэтому
+задача срабатывает один раз, а её уведомления уходят через outbox.
+При старте задачи восстанавливаются из таблицы; просроченные за время
+простоя выполняются сразу.
+
+Долгие задачи (очистка) регистрируются async-обработчиком: он работает
+отдельной задачей вне транзакции, не задерживая остальные сроки, а отметка о
+выполнении ставится после него — такие обработчики должны быть идемпотентны.
+
+    @scheduler.job('booking_expire')
+    def expire_booking(booking_id): ...
+
+    db.schedule_job('booking_expire', bid, run_at)   # внутри транзакции
+"""
+import asyncio
+import heapq
+import logging
+from datetime import datetime, timedelta
+
+import adb
+import database as db
+from utils import now_local
+
+logger = logging.getLogger(__name__)
+
+RETRY_DELAY = timedelta(minutes=1)
+# Сон ограничен: сроки — локальное время, часы могут сдвинуться (перевод, NTP)
+MAX_SLEEP_SECONDS = 600
+
+_handlers = {}   # kind -> fn(ref_id)
+_heap = []       # (когда выполнить, kind, ref_id, run_at из таблицы)
+_running = {}    # (kind, ref_id) -> asyncio.Task async-обработчика
+_wake = None
+_task = None
+
+
+def job(kind):
+    """Регистрирует обработчик задач kind."""
+    def register(fn):
+        _handlers[kind] = fn
+        return fn
+    return register
+
+
+def _now():
+    return now_local(precise=True)
+
+
+def _ts(dt):
+    return dt.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _push(jobs):
+    for kind, ref_id, run_at in jobs:
+        heapq.heappush(_heap, (run_at, kind, ref_id, run_at))
+    if _wake:
+        _wake.set()
+
+
+def _fire(kind, ref_id, run_at):
+    with db.get_connection():
+        if not db.claim_job(kind, ref_id, run_at):
+            return False   # устаревшая запись heap: задачу перенесли или уже выполнили
+        _handlers[kind](ref_id)
+        return True
+
+
+async def _run_async(kind, ref_id, run_at):
+    try:
+        await _handlers[kind](ref_id)
+        # Если обработчик перенёс задачу, строка с новым сроком останется
+        await adb.run_write(db.claim_job, kind, ref_id, run_at)
+    except Exception as e:
+        logger.error(f"Job {kind}:{ref_id} failed: {e}")
+        heapq.heappush(_heap, (_ts(_now() + RETRY_DELAY), kind, ref_id, run_at))
+        if _wake:
+            _wake.set()
+    finally:
+        _running.pop((kind, ref_id), None)
+
+
+async def _run_job(kind, ref_id, run_at):
+    if kind not in _handlers:
+        logger.warning(f"No handler for job {kind}:{ref_id}")
+        return
+    if asyncio.iscoroutinefunction(_handlers[kind]):
+        if (kind, ref_id) not in _running:   # уже работает — сам перенесёт себя
+            _running[(kind, ref_id)] = asyncio.create_task(_run_async(kind, ref_id, run_at))
+        return
+    try:
+        await adb.run_write(_fire, kind, ref_id, run_at)
+    except Exception as e:
+        # Транзакция откатилась вместе с claim_job — повторим позже
+        logger.error(f"Job {kind}:{ref_id} failed: {e}")
+        heapq.heappush(_heap, (_ts(_now() + RETRY_DELAY), kind, ref_id, run_at))
+
+
+async def run():
+    global _wake
+    loop = asyncio.get_running_loop()
+    _wake = asyncio.Event()
+    # Подписка до загрузки: задачи, поставленные во время загрузки, не потеряются
+    db.set_job_listener(lambda jobs: loop.call_soon_threadsafe(_push, jobs))
+    try:
+        _heap.clear()
+        _push(await adb.get_scheduled_jobs())
+        logger.info(f"Scheduler: {len(_heap)} jobs restored")
+        while True:
+            try:
+                _wake.clear()
+                now = _ts(_now())
+                due = []
+                while _heap and _heap[0][0] <= now:
+                    due.append(heapq.heappop(_heap))
+                if due:
+                    await asyncio.gather(*(_run_job(*j[1:]) for j in due))
+                    continue
+                timeout = MAX_SLEEP_SECONDS
+                if _heap:
+                    left = (datetime.fromisoformat(_heap[0][0]) - _now()).total_seconds()
+                    timeout = min(timeout, max(0.0, left))
+                try:
+                    await asyncio.wait_for(_wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Scheduler error: {e}")
+                await asyncio.sleep(5)
+    finally:
+        db.set_job_listener(None)
+        _wake = None
+        for task in list(_running.values()):
+            task.cancel()
+        await asyncio.gather(*_running.values(), return_exceptions=True)
+
+
+def start():
+    global _task
+    if _task is None or _task.done():
+        _task = asyncio.create_task(run())
+
+
+async def stop():
+    if _task and not _task.done():
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
@@ -0,0 +1,24 @@
+"""
+Общие настройки тестов: база во временном каталоге (config читает
+DATABASE_PATH при импорте, поэтому окружение задаётся до импорта модулей бота).
+"""
+import os
+import sys
+import tempfile
+
+_tmp = tempfile.mkdtemp(prefix="parkingbot-tests-")
+os.environ["DATABASE_PATH"] = os.path.join(_tmp, "parking.db")
+os.environ["BACKUP_DIR"] = os.path.join(_tmp, "backups")
+os.environ.setdefault("BOT_TOKEN", "0:test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import database as db
+
+
+@pytest.fixture
+def conn():
+    db.init_database()
+    with db.get_connection() as c:
+        yield c
@@ -0,0 +1,64 @@
+import asyncio
+from datetime import timedelta
+
+import database as db
+import retention
+from config import RETENTION_COMPLETE_BOOKINGS_DAYS, ARCHIVE_UNREVIEWED_BOOKINGS_DAYS
+from keyboards import get_booking_detail_keyboard
+from utils import now_local
+
+
+def _booking(c, customer_id, spot_id, ended_days_ago, status='confirmed', reviewed=0):
+    end = now_local(precise=True) - timedelta(days=ended_days_ago)
+    return c.execute('INSERT INTO bookings (customer_id, spot_id, start_time, end_time, total_price, status, reviewed) '
+                     'VALUES (?,?,?,?,?,?,?)', (customer_id, spot_id, db._ts(end - timedelta(hours=2)), db._ts(end),
+                                                100, status, reviewed)).lastrowid
+
+
+def _buttons(booking):
+    kb = get_booking_detail_keyboard(booking, booking['customer_id'])
+    return [b.callback_data for row in kb.inline_keyboard for b in row]
+
+
+def test_completed_booking_stays_reviewable_after_retention():
+    db.init_database()
+    with db.get_connection() as c:
+        cur = c.cursor()
+        cur.execute("INSERT INTO users (telegram_id, full_name, phone) VALUES (9001, 'Клиент', '1')")
+        customer = cur.lastrowid
+        cur.execute("INSERT INTO users (telegram_id, full_name, phone) VALUES (9002, 'Поставщик', '2')")
+        supplier = cur.lastrowid
+        cur.execute("INSERT INTO parking_spots (supplier_id, spot_number) VALUES (?, 'R1')", (supplier,))
+        spot = cur.lastrowid
+        # закончилась давно, отзыва нет — в этом проходе станет completed
+        fresh = _booking(cur, customer, spot, RETENTION_COMPLETE_BOOKINGS_DAYS + 1)
+        # completed с отзывом — архивируется сразу
+        reviewed = _booking(cur, customer, spot, RETENTION_COMPLETE_BOOKINGS_DAYS + 1, 'completed', reviewed=1)
+        # completed без отзыва дольше льготного срока — в архив, отзыв уже не принимается
+        stale = _booking(cur, customer, spot, ARCHIVE_UNREVIEWED_BOOKINGS_DAYS + 1, 'completed')
+
+    asyncio.run(retention.run())
+
+    b = db.get_booking_by_id(fresh)
+    assert b['status'] == 'completed' and not b.get('archived')
+    assert [r['id'] for r in db.get_completed_unreviewed_bookings(customer)] == [fresh]
+    assert f"review_start_{fresh}" in _buttons(b)
+
+    assert db.get_booking_by_id(reviewed) is None
+    assert db.get_booking_by_id(stale) is None
+    archived = db.get_archived_booking(stale)
+    assert archived['archived'] and f"review_start_{stale}" not in _buttons(archived)
+
+    # все три брони видны в статистике пользователя и в истории
+    assert db.get_user_statistics(customer)['total_bookings'] == 3
+    assert {r['id'] for r in db.get_user_bookings(customer, include_archive=True)} == {fresh, reviewed, stale}
+
+    db.create_review(fresh, customer, spot, supplier, 5, 'ok')
+    assert db.get_booking_by_id(fresh)['reviewed'] == 1
+    assert db.get_completed_unreviewed_bookings(customer) == []
+
+    # со следующим проходом отзыв уже оставлен — бронь уходит в архив
+    asyncio.run(retention.run())
+    assert db.get_booking_by_id(fresh) is None
+    assert db.get_archived_booking(fresh)['reviewed'] == 1
+    assert db.get_user_statistics(customer)['total_bookings'] == 3
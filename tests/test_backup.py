@@ -0,0 +1,46 @@
+import os
+import sqlite3
+from datetime import datetime
+
+import backup
+import database as db
+import restore
+from config import DATABASE_PATH, ARCHIVE_DATABASE_PATH
+
+
+def _count(path, table):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_generation_covers_archive_and_is_never_overwritten(tmp_path, monkeypatch):
+    db.init_database()
+    conn = db.open_archive_connection()
+    try:
+        conn.execute("INSERT INTO archive.admin_logs (action_type, details) VALUES ('test', 'в архиве')")
+    finally:
+        conn.close()
+    archived = _count(ARCHIVE_DATABASE_PATH, 'admin_logs')
+
+    # два поколения в одну секунду
+    monkeypatch.setattr(backup, 'now_local', lambda precise=False: datetime(2025, 1, 31, 18, 0, 0))
+    dest = str(tmp_path / 'backups')
+    first, _ = backup._create_generation(dest)
+    second, _ = backup._create_generation(dest)
+    assert first != second
+    assert [path for _, path in backup.list_generations(dest)] == [second, first]
+    assert set(backup.generation_files(first)) == {'main', 'archive'}
+
+    # восстановление возвращает обе базы из одного поколения
+    target = tmp_path / 'restored'
+    target.mkdir()
+    db_path = str(target / os.path.basename(DATABASE_PATH))
+    archive_path = str(target / os.path.basename(ARCHIVE_DATABASE_PATH))
+    sqlite3.connect(archive_path).close()   # «новый» архив, который должен уйти в сторону
+    moved = restore.restore(first, db_path, archive_path)
+    assert list(moved) == [archive_path]
+    assert _count(archive_path, 'admin_logs') == archived
+    assert _count(db_path, 'users') == _count(DATABASE_PATH, 'users')
@@ -0,0 +1,31 @@
+from datetime import timedelta
+
+import database as db
+from utils import now_local
+
+
+def test_paid_hours_free_the_rest_of_the_booking():
+    db.init_database()
+    customer = db.create_user(9201, 'c', 'Клиент', '1')
+    supplier = db.create_user(9202, 's', 'Поставщик', '2')
+    spot = db.create_parking_spot(supplier, 'H1', 100)
+    day = (now_local() + timedelta(days=2)).replace(hour=0, minute=0, second=0, microsecond=0)
+    aid = db.create_spot_availability(spot, day + timedelta(hours=10), day + timedelta(hours=18))
+    bid = db.create_booking(customer, spot, aid, day + timedelta(hours=12), day + timedelta(hours=16), 400)
+    version = db.availability_version()
+
+    assert db.admin_edit_booking_hours(bid, 2) is True
+
+    booking = db.get_booking_by_id(bid)
+    assert booking['end_time'] == db._ts(day + timedelta(hours=14))
+    assert booking['total_price'] == 200
+    assert db.availability_version() > version
+    free = [(r['start_time'], r['end_time']) for r in db.get_spot_availabilities(spot)]
+    assert free == [(db._ts(day + timedelta(hours=10)), db._ts(day + timedelta(hours=12))),
+                    (db._ts(day + timedelta(hours=14)), db._ts(day + timedelta(hours=18)))]
+
+    # полная оплата ничего не меняет, отменённую бронь не трогаем
+    assert db.admin_edit_booking_hours(bid, 5) is True
+    assert db.get_booking_by_id(bid)['end_time'] == db._ts(day + timedelta(hours=14))
+    db.cancel_booking(bid)
+    assert db.admin_edit_booking_hours(bid, 1) is False
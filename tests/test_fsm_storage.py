@@ -0,0 +1,122 @@
+import asyncio
+from datetime import date, datetime
+from types import SimpleNamespace
+
+import pytest
+from aiogram.fsm.storage.base import StorageKey
+
+import adb
+import database as db
+import fsm_storage
+from fsm_storage import BoundedMemoryStorage, ChatEventIsolation, SQLiteStorage, dumps
+
+
+def _key(chat_id, user_id=None):
+    return StorageKey(bot_id=42, chat_id=chat_id, user_id=user_id or chat_id)
+
+
+def test_chat_isolation_keeps_chat_order_and_global_limit():
+    async def scenario():
+        iso = ChatEventIsolation(limit=2)
+        handled = {1: [], 2: [], 3: []}
+        peak = 0
+
+        async def update(chat_id, n):
+            nonlocal peak
+            async with iso.lock(_key(chat_id)):
+                peak = max(peak, iso.active)
+                # поздние апдейты короче: без замка чата они обогнали бы ранние
+                await asyncio.sleep(0.005 * (5 - n))
+                handled[chat_id].append(n)
+
+        updates = [(chat_id, n) for n in range(5) for chat_id in (1, 2, 3)]
+        await asyncio.gather(*(update(chat_id, n) for chat_id, n in updates))
+        assert iso.stats() == {'active': 0, 'chats': 0}
+        return handled, peak
+
+    handled, peak = asyncio.run(scenario())
+    # внутри чата — в порядке поступления
+    assert handled == {1: list(range(5)), 2: list(range(5)), 3: list(range(5))}
+    # чаты обрабатываются параллельно, но не больше limit сразу
+    assert peak == 2
+
+
+def test_sqlite_storage_write_behind_round_trip(monkeypatch):
+    db.init_database()
+    key, other = _key(9401), _key(9402)
+    data = {'slot_start': datetime(2025, 1, 31, 18, 30), 'booking_start_date': date(2025, 1, 31),
+            'spot_id': 7, 'note': 'Ул. Ленина'}
+
+    async def scenario():
+        storage = SQLiteStorage(flush_interval=3600, cache_size=1)
+        await storage.set_state(key, 'BookingStates:choose_time')
+        await storage.set_data(key, data)
+        # write-behind: до flush в БД ничего нет
+        assert db.load_fsm_state(SQLiteStorage._key(key)) is None
+
+        async def failing(rows):
+            raise RuntimeError('disk I/O error')
+
+        monkeypatch.setattr(adb, 'save_fsm_states', failing)
+        with pytest.raises(RuntimeError):
+            await storage.flush()
+        # неудачная запись возвращает ключи в грязные
+        assert storage._dirty == {SQLiteStorage._key(key)}
+        monkeypatch.undo()
+
+        assert await storage.flush() == 1
+        assert storage._dirty == set()
+
+        # вытесняются только записанные ключи
+        await storage.set_state(other, 'SpotStates:address')
+        storage._evict()
+        assert list(storage._cache) == [SQLiteStorage._key(other)]
+        await storage.close()
+
+        fresh = SQLiteStorage(flush_interval=3600)
+        return (await fresh.get_state(key), await fresh.get_data(key),
+                await fresh.get_state(other), fresh.stats['misses'])
+
+    state, restored, other_state, misses = asyncio.run(scenario())
+    assert state == 'BookingStates:choose_time'
+    assert restored == data
+    assert type(restored['slot_start']) is datetime and type(restored['booking_start_date']) is date
+    assert other_state == 'SpotStates:address'
+    assert misses == 2
+
+
+def test_bounded_memory_storage_limits_and_byte_accounting(monkeypatch):
+    clock = [1000.0]
+    # часы только для fsm_storage: time.monotonic нужен и event loop
+    monkeypatch.setattr(fsm_storage, 'time', SimpleNamespace(monotonic=lambda: clock[0]))
+
+    def size(state, data):
+        return fsm_storage._ENTRY_OVERHEAD + len(state) + len(dumps(data))
+
+    async def scenario():
+        storage = BoundedMemoryStorage(max_entries=2, idle_ttl=60)
+        data = {'spot_id': 1, 'slot_start': datetime(2025, 1, 31, 18, 30)}
+        for chat_id in (1, 2, 3):
+            await storage.set_state(_key(chat_id), 'BookingStates:choose_time')
+            await storage.set_data(_key(chat_id), data)
+            clock[0] += 1
+        # LRU: первый ключ вытеснен
+        assert await storage.get_state(_key(1)) is None
+        assert storage.stats() == {'entries': 2, 'bytes': 2 * size('BookingStates:choose_time', data),
+                                   'evicted': 1, 'expired': 0}
+
+        # пустое состояние не хранится и не учитывается
+        await storage.set_state(_key(2), None)
+        await storage.set_data(_key(2), {})
+        assert storage.stats() == {'entries': 1, 'bytes': size('BookingStates:choose_time', data),
+                                   'evicted': 1, 'expired': 0}
+
+        # обращение продлевает жизнь ключа
+        clock[0] += 50
+        assert await storage.get_data(_key(3)) == data
+        clock[0] += 50
+        assert storage.stats()['entries'] == 1
+        clock[0] += 11
+        return storage.stats()
+
+    assert asyncio.run(scenario()) == {'entries': 0, 'bytes': 0, 'evicted': 1, 'expired': 1}
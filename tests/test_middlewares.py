@@ -0,0 +1,59 @@
+import asyncio
+from types import SimpleNamespace
+
+import database as db
+import middlewares
+from middlewares import UserContextMiddleware, user_context_stats
+
+
+class FakeCallback:
+    """Апдейт не-Message: ответ идёт через answer(text, show_alert=True)."""
+
+    def __init__(self, telegram_id):
+        self.from_user = SimpleNamespace(id=telegram_id)
+        self.answers = []
+
+    async def answer(self, text, **kwargs):
+        self.answers.append(text)
+
+
+def test_one_user_read_per_update():
+    db.init_database()
+    registered = db.create_user(9101, 'reg', 'Зарегистрированный', '1')
+    banned = db.create_user(9102, 'ban', 'Забаненный', '2')
+    db.ban_user(banned, 24, 'тест')
+    db.invalidate_user_cache()
+
+    handled = []
+
+    async def handler(event, data):
+        handled.append((event.from_user.id, data['user']['id'], data['is_admin']))
+        return 'ok'
+
+    mw = UserContextMiddleware()
+    events = {tid: FakeCallback(tid) for tid in (9101, 9102, 9103)}
+    stats_before, reads_before = dict(user_context_stats), dict(db.user_cache_stats)
+
+    async def feed():
+        return [await mw(handler, events[tid], {}) for tid in (9101, 9102, 9103)]
+
+    assert asyncio.run(feed()) == ['ok', None, None]
+    # хендлер видит только зарегистрированного и не забаненного
+    assert handled == [(9101, registered, False)]
+    assert events[9102].answers[0].startswith('🚫 Вы заблокированы')
+    assert events[9103].answers == ['❌ Сначала /start']
+
+    reads = sum(db.user_cache_stats.values()) - sum(reads_before.values())
+    assert reads == 3
+    assert {k: user_context_stats[k] - stats_before[k] for k in user_context_stats} == \
+        {'updates': 3, 'unregistered': 1, 'banned': 1}
+
+
+def test_registration_state_is_public():
+    async def handler(event, data):
+        return data['user']
+
+    event = FakeCallback(9199)
+    data = {'raw_state': middlewares.PUBLIC_STATE_PREFIX + 'phone'}
+    assert asyncio.run(UserContextMiddleware()(handler, event, data)) is None
+    assert event.answers == []
@@ -0,0 +1,17 @@
+import sqlite3
+
+import database as db
+
+
+def test_hot_queries_use_indexes(conn):
+    assert db.check_query_plans(conn) == []
+
+
+def test_full_scan_is_reported(conn):
+    # копия схемы без индексов слотов: те же запросы должны считаться регрессией
+    copy = sqlite3.connect(':memory:')
+    conn.backup(copy)
+    for idx in ('idx_sa_spot_end', 'idx_sa_free_end', 'idx_sa_free_start'):
+        copy.execute(f'DROP INDEX {idx}')
+    names = {name for name, _ in db.check_query_plans(copy)}
+    assert {'available_slots_all', 'slot_overlap', 'spot_availabilities'} <= names
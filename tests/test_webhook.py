@@ -0,0 +1,68 @@
+import asyncio
+import json
+import os
+
+from aiogram import Bot, Dispatcher
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from webhook import BoundedRequestHandler
+
+SECRET = 'test-secret'
+UPDATE = os.path.join(os.path.dirname(__file__), 'updates', 'message_start.json')
+
+
+def _update(update_id):
+    with open(UPDATE, encoding='utf-8') as f:
+        update = json.load(f)
+    update['update_id'] = update_id
+    return update
+
+
+def test_webhook_secret_bad_json_and_concurrency_limit():
+    async def scenario():
+        dp = Dispatcher()
+        release = asyncio.Event()
+        state = {'in_flight': 0, 'peak': 0, 'handled': []}
+
+        @dp.message()
+        async def handler(message):
+            state['in_flight'] += 1
+            state['peak'] = max(state['peak'], state['in_flight'])
+            await release.wait()
+            state['in_flight'] -= 1
+            state['handled'].append(message.text)
+
+        bot = Bot('42:TEST')
+        app = web.Application()
+        BoundedRequestHandler(dp, bot, max_concurrent=2, secret_token=SECRET).register(app, path='/webhook')
+        client = TestClient(TestServer(app))
+        await client.start_server()
+        try:
+            ok = {'X-Telegram-Bot-Api-Secret-Token': SECRET}
+            assert (await client.post('/webhook', json=_update(1))).status == 401
+            assert (await client.post('/webhook', json=_update(1),
+                                      headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'})).status == 401
+            bad = await client.post('/webhook', data='{not json', headers=ok)
+            assert bad.status == 400
+
+            posts = [asyncio.create_task(client.post('/webhook', json=_update(i), headers=ok))
+                     for i in range(2, 7)]
+            await asyncio.sleep(0.3)
+            # два апдейта в обработке, остальные ждут слота, не получив ответа
+            assert state['in_flight'] == 2
+            assert sum(p.done() for p in posts) == 2
+            release.set()
+            responses = await asyncio.gather(*posts)
+            assert [r.status for r in responses] == [200] * 5
+            for _ in range(50):
+                if len(state['handled']) == 5:
+                    break
+                await asyncio.sleep(0.02)
+            assert state['handled'] == ['/start'] * 5
+            assert state['peak'] == 2
+        finally:
+            await client.close()
+            await bot.session.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,18 @@
+import database as db
+
+
+def test_failing_after_commit_hook_keeps_writer_alive(monkeypatch):
+    def listener(jobs):
+        raise RuntimeError('Event loop is closed')
+
+    db.init_database()
+    db.write(db.cancel_job, 'test_hook', 1)
+    monkeypatch.setattr(db, '_job_listener', listener)
+    created = db._pool.qsize()
+    fut = db.submit_write(db.schedule_job, 'test_hook', 1, '2030-01-01 00:00:00')
+    assert fut.result(timeout=5) is None
+    assert db._writer_thread.is_alive()
+    # соединение пачки вернулось в пул
+    assert db._pool.qsize() == created
+
+    assert db.write(db.claim_job, 'test_hook', 1, '2030-01-01 00:00:00') is True
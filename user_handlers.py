@@ -17,6 +17,8 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
 import database as db
+import adb
+import outbox
 from config import BANKS, MAX_ACTIVE_BOOKINGS, MAX_SPOTS_PER_USER, ABOUT_TEXT, RULES_TEXT, TIME_STEP_MINUTES, WORKING_HOURS_START, WORKING_HOURS_END, MIN_BOOKING_MINUTES, AVAILABILITY_LOOKAHEAD_DAYS, ADMIN_CHECK_USERNAME, CARD_NUMBER, TIMEZONE
 from keyboards import *
 from utils import *
@@ -105,44 +107,26 @@ class EditSlotStates(StatesGroup):
     waiting_end_time = State()
 
 # ==================== HELPERS ====================
-def _adm(tid):
-    u = db.get_user_by_telegram_id(tid)
-    return u and u['role'] == 'admin'
+# user и is_admin подставляет UserContextMiddleware (middlewares.py):
+# строка пользователя читается один раз на апдейт, незарегистрированные и
+# забаненные отсекаются до хендлеров.
+async def _slots_keyboard(slots):
+    """Клавиатура выдачи поиска с рейтингами — один запрос на всю страницу."""
+    ratings = await adb.get_spot_ratings([s['spot_id'] for s in slots[:SLOTS_PAGE_SIZE]])
+    return get_available_slots_keyboard(slots, ratings)
 
 def _cancel_check(text):
     return text and text in ["❌ Отмена", "🔙 Главное меню"]
 
-async def _check_ban(msg_or_cb):
-    tid = msg_or_cb.from_user.id
-    user = db.get_user_by_telegram_id(tid)
-    if not user: return False
-    banned, reason, until = db.is_user_banned(user)
-    if banned:
-        t = "🚫 Вы заблокированы"
-        if until: t += f" до {format_datetime(datetime.fromisoformat(until))}"
-        else: t += " навсегда"
-        if reason: t += f"\n📝 Причина: {reason}"
-        if isinstance(msg_or_cb, Message): await msg_or_cb.answer(t, parse_mode="HTML")
-        else: await msg_or_cb.answer(t, show_alert=True)
-        return True
-    return False
-
 
 # ==================== REGISTRATION ====================
 @router.message(Command("start"))
-async def cmd_start(message: Message, state: FSMContext):
+async def cmd_start(message: Message, state: FSMContext, user: dict):
     await state.clear()
-    user = db.get_user_by_telegram_id(message.from_user.id)
     if user:
-        banned, reason, until = db.is_user_banned(user)
-        if banned:
-            t = "🚫 Вы заблокированы"
-            if until: t += f" до {format_datetime(datetime.fromisoformat(until))}"
-            if reason: t += f"\n📝 {reason}"
-            await message.answer(t, parse_mode="HTML"); return
         await message.answer(f"👋 <b>{user['full_name']}</b>, выберите действие:",
             reply_markup=get_main_menu_keyboard(user['role']=='admin'), parse_mode="HTML")
-        unreviewed = db.get_completed_unreviewed_bookings(user['id'])
+        unreviewed = await adb.get_completed_unreviewed_bookings(user['id'])
         if unreviewed:
             b = unreviewed[0]
             await message.answer(
@@ -184,40 +168,39 @@ async def reg_phone(message: Message, state: FSMContext):
         ok, r = validate_phone(message.text)
         if not ok: await message.answer(r); return
     data = await state.get_data()
-    db.create_user(telegram_id=message.from_user.id, username=message.from_user.username or "",
+    await adb.create_user(telegram_id=message.from_user.id, username=message.from_user.username or "",
                    full_name=data['full_name'], phone=r)
     await state.clear()
     await message.answer(f"✅ <b>Готово!</b>\n\n👤 {data['full_name']}\n📞 {r}",
         reply_markup=get_main_menu_keyboard(), parse_mode="HTML")
-    for a in db.get_admins():
-        try: await message.bot.send_message(a['telegram_id'], f"👤 Новый: {data['full_name']} {r}")
-        except: pass
+    await outbox.notify_many([a['telegram_id'] for a in await adb.get_admins()],
+                             f"👤 Новый: {data['full_name']} {r}")
 
 
 # ==================== NAV ====================
 @router.message(F.text == "🔙 Главное меню")
-async def go_menu(message: Message, state: FSMContext):
+async def go_menu(message: Message, state: FSMContext, is_admin: bool):
     await state.clear()
-    await message.answer("🏠", reply_markup=get_main_menu_keyboard(_adm(message.from_user.id)))
+    await message.answer("🏠", reply_markup=get_main_menu_keyboard(is_admin))
 
 @router.message(F.text == "❌ Отмена")
-async def cancel_msg(message: Message, state: FSMContext):
+async def cancel_msg(message: Message, state: FSMContext, is_admin: bool):
     await state.clear()
-    await message.answer("❌ Отменено.", reply_markup=get_main_menu_keyboard(_adm(message.from_user.id)))
+    await message.answer("❌ Отменено.", reply_markup=get_main_menu_keyboard(is_admin))
 
 @router.callback_query(F.data == "cancel")
-async def cancel_cb(callback: CallbackQuery, state: FSMContext):
+async def cancel_cb(callback: CallbackQuery, state: FSMContext, is_admin: bool):
     await callback.answer(); await state.clear()
     try: await callback.message.edit_text("❌ Отменено.")
     except: pass
-    await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(_adm(callback.from_user.id)))
+    await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(is_admin))
 
 @router.callback_query(F.data == "main_menu")
-async def menu_cb(callback: CallbackQuery, state: FSMContext):
+async def menu_cb(callback: CallbackQuery, state: FSMContext, is_admin: bool):
     await callback.answer(); await state.clear()
     try: await callback.message.edit_text("🏠")
     except: pass
-    await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(_adm(callback.from_user.id)))
+    await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(is_admin))
 
 
 # ==================== О СЕРВИСЕ / ПРАВИЛА ====================
@@ -232,9 +215,7 @@ async def rules(message: Message):
 
 # ==================== SEARCH ====================
 @router.message(F.text == "📅 Найти место")
-async def search_start(message: Message, state: FSMContext):
-    if await _check_ban(message): return
-    user = db.get_user_by_telegram_id(message.from_user.id)
+async def search_start(message: Message, state: FSMContext, user: dict):
     if not user: await message.answer("❌ /start"); return
     if not db.user_has_car_info(user):
         await state.update_data(pending_action='search')
@@ -242,19 +223,19 @@ async def search_start(message: Message, state: FSMContext):
             reply_markup=get_cancel_menu_keyboard(), parse_mode="HTML")
         await state.set_state(CarInfoStates.waiting_license_plate); return
     await state.update_data(user_id=user['id'])
-    slots = db.get_available_slots(None, exclude_supplier=user['id'])
+    slots = await adb.get_available_slots(None, exclude_supplier=user['id'])
     if not slots:
         await message.answer("😔 Нет доступных мест.", reply_markup=get_no_slots_keyboard(), parse_mode="HTML")
     else:
         await message.answer(f"🏠 <b>Доступные места ({len(slots)})</b>\n\n{format_price_info()}",
-            reply_markup=get_available_slots_keyboard(slots), parse_mode="HTML")
+            reply_markup=await _slots_keyboard(slots), parse_mode="HTML")
     await state.set_state(SearchStates.selecting_slot)
 
 
 # CAR INFO
 @router.message(CarInfoStates.waiting_license_plate)
-async def car_plate(message: Message, state: FSMContext):
-    if _cancel_check(message.text): await cancel_msg(message, state); return
+async def car_plate(message: Message, state: FSMContext, is_admin: bool):
+    if _cancel_check(message.text): await cancel_msg(message, state, is_admin); return
     ok, r = validate_license_plate(message.text)
     if not ok: await message.answer(r); return
     await state.update_data(license_plate=r)
@@ -262,8 +243,8 @@ async def car_plate(message: Message, state: FSMContext):
     await state.set_state(CarInfoStates.waiting_car_brand)
 
 @router.message(CarInfoStates.waiting_car_brand)
-async def car_brand(message: Message, state: FSMContext):
-    if _cancel_check(message.text): await cancel_msg(message, state); return
+async def car_brand(message: Message, state: FSMContext, is_admin: bool):
+    if _cancel_check(message.text): await cancel_msg(message, state, is_admin); return
     ok, r = validate_car_brand(message.text)
     if not ok: await message.answer(r); return
     await state.update_data(car_brand=r)
@@ -271,33 +252,31 @@ async def car_brand(message: Message, state: FSMContext):
     await state.set_state(CarInfoStates.waiting_car_color)
 
 @router.message(CarInfoStates.waiting_car_color)
-async def car_color(message: Message, state: FSMContext):
-    if _cancel_check(message.text): await cancel_msg(message, state); return
+async def car_color(message: Message, state: FSMContext, user: dict, is_admin: bool):
+    if _cancel_check(message.text): await cancel_msg(message, state, is_admin); return
     ok, r = validate_car_color(message.text)
     if not ok: await message.answer(r); return
     data = await state.get_data()
-    user = db.get_user_by_telegram_id(message.from_user.id)
-    db.update_user(user['id'], license_plate=data['license_plate'], car_brand=data['car_brand'], car_color=r)
+    await adb.update_user(user['id'], license_plate=data['license_plate'], car_brand=data['car_brand'], car_color=r)
     pending = data.get('pending_action')
     await state.clear()
     if pending == 'search':
         await state.update_data(user_id=user['id'])
-        slots = db.get_available_slots(None, exclude_supplier=user['id'])
+        slots = await adb.get_available_slots(None, exclude_supplier=user['id'])
         if not slots:
             await message.answer("✅ Авто сохранено!\n\n😔 Нет мест.", reply_markup=get_no_slots_keyboard())
         else:
             await message.answer(f"✅ Авто!\n\n🏠 <b>Места ({len(slots)})</b>\n\n{format_price_info()}",
-                reply_markup=get_available_slots_keyboard(slots), parse_mode="HTML")
+                reply_markup=await _slots_keyboard(slots), parse_mode="HTML")
         await state.set_state(SearchStates.selecting_slot)
     else:
-        await message.answer("✅ Авто обновлено!", reply_markup=get_main_menu_keyboard(_adm(message.from_user.id)))
+        await message.answer("✅ Авто обновлено!", reply_markup=get_main_menu_keyboard(is_admin))
 
 
 # SEARCH FILTER
 @router.callback_query(F.data == "search_filter")
-async def search_filter(callback: CallbackQuery, state: FSMContext):
+async def search_filter(callback: CallbackQuery, state: FSMContext, user: dict):
     await callback.answer()
-    user = db.get_user_by_telegram_id(callback.from_user.id)
     if user: await state.update_data(user_id=user['id'])
     await callback.message.edit_text("📅 <b>Фильтр по дате</b>:",
         reply_markup=get_dates_keyboard("search_date"), parse_mode="HTML")
@@ -313,47 +292,47 @@ async def search_date(callback: CallbackQuery, state: FSMContext):
         await callback.message.edit_text("📅 <b>ДД.ММ.ГГГГ</b>:", parse_mode="HTML")
         await state.set_state(SearchStates.waiting_date_manual); return
     if dv == "all":
-        slots = db.get_available_slots(None, exclude_supplier=uid)
+        slots = await adb.get_available_slots(None, exclude_supplier=uid)
         if not slots:
             await callback.message.edit_text("😔 Нет мест.", reply_markup=get_no_slots_keyboard())
         else:
             await callback.message.edit_text(f"🏠 <b>Все ({len(slots)})</b>\n\n{format_price_info()}",
-                reply_markup=get_available_slots_keyboard(slots), parse_mode="HTML")
+                reply_markup=await _slots_keyboard(slots), parse_mode="HTML")
         await state.set_state(SearchStates.selecting_slot); return
     ok, _ = validate_date(dv)
     if not ok: return
     date_obj = datetime.strptime(dv, "%d.%m.%Y")
-    slots = db.get_available_slots(date_obj.strftime("%Y-%m-%d"), exclude_supplier=uid)
+    slots = await adb.get_available_slots(date_obj.strftime("%Y-%m-%d"), exclude_supplier=uid)
     if not slots:
-        all_s = db.get_available_slots(None, exclude_supplier=uid)
+        all_s = await adb.get_available_slots(None, exclude_supplier=uid)
         if all_s:
             await callback.message.edit_text(f"😔 На {dv} нет.\n\n🏠 <b>Все ({len(all_s)})</b>:",
-                reply_markup=get_available_slots_keyboard(all_s), parse_mode="HTML")
+                reply_markup=await _slots_keyboard(all_s), parse_mode="HTML")
         else:
             await callback.message.edit_text("😔 Нет мест.", reply_markup=get_no_slots_keyboard())
     else:
         await callback.message.edit_text(f"🏠 <b>На {dv} ({len(slots)})</b>\n\n{format_price_info()}",
-            reply_markup=get_available_slots_keyboard(slots), parse_mode="HTML")
+            reply_markup=await _slots_keyboard(slots), parse_mode="HTML")
     await state.set_state(SearchStates.selecting_slot)
 
 @router.message(SearchStates.waiting_date_manual)
-async def search_date_m(message: Message, state: FSMContext):
-    if _cancel_check(message.text): await cancel_msg(message, state); return
+async def search_date_m(message: Message, state: FSMContext, is_admin: bool):
+    if _cancel_check(message.text): await cancel_msg(message, state, is_admin); return
     ok, _ = validate_date(message.text)
     if not ok: await message.answer("❌ ДД.ММ.ГГГГ"); return
     data = await state.get_data()
     uid = data.get('user_id')
     date_obj = datetime.strptime(message.text, "%d.%m.%Y")
-    slots = db.get_available_slots(date_obj.strftime("%Y-%m-%d"), exclude_supplier=uid)
+    slots = await adb.get_available_slots(date_obj.strftime("%Y-%m-%d"), exclude_supplier=uid)
     if not slots:
-        all_s = db.get_available_slots(None, exclude_supplier=uid)
+        all_s = await adb.get_available_slots(None, exclude_supplier=uid)
         if all_s:
             await message.answer(f"😔 Нет на {message.text}.\n\n🏠 <b>Все ({len(all_s)})</b>:",
-                reply_markup=get_available_slots_keyboard(all_s), parse_mode="HTML")
+                reply_markup=await _slots_keyboard(all_s), parse_mode="HTML")
         else: await message.answer("😔 Нет мест.", reply_markup=get_no_slots_keyboard())
     else:
         await message.answer(f"🏠 <b>На {message.text} ({len(slots)})</b>\n\n{format_price_info()}",
-            reply_markup=get_available_slots_keyboard(slots), parse_mode="HTML")
+            reply_markup=await _slots_keyboard(slots), parse_mode="HTML")
     await state.set_state(SearchStates.selecting_slot)
 
 
@@ -393,27 +372,25 @@ def _confirm_text(spot_number, bs, be):
 
 
 @router.callback_query(SearchStates.selecting_slot, F.data.startswith("slot_"))
-async def select_slot(callback: CallbackQuery, state: FSMContext):
+async def select_slot(callback: CallbackQuery, state: FSMContext, user: dict):
     await callback.answer()
-    if await _check_ban(callback): return
     slot_id = int(callback.data.replace("slot_",""))
-    slot = db.get_availability_by_id(slot_id)
+    slot = await adb.get_availability_by_id(slot_id)
     if not slot or slot['is_booked']:
         await callback.message.edit_text("❌ Слот уже занят или не найден."); return
-    user = db.get_user_by_telegram_id(callback.from_user.id)
     if not user: return
     uid = user['id']
     await state.update_data(user_id=uid)
     if slot['supplier_id'] == uid:
         await callback.message.answer("❌ Нельзя бронировать своё место."); return
-    if db.is_blacklisted_either(uid, slot['supplier_id']):
+    if await adb.is_blacklisted_either(uid, slot['supplier_id']):
         await callback.message.answer("❌ Бронирование невозможно."); return
-    if db.get_active_bookings_count(uid) >= MAX_ACTIVE_BOOKINGS:
+    if await adb.get_active_bookings_count(uid) >= MAX_ACTIVE_BOOKINGS:
         await callback.message.answer(f"❌ Лимит бронирований ({MAX_ACTIVE_BOOKINGS})."); return
     sdt = datetime.fromisoformat(slot['start_time'])
     edt = datetime.fromisoformat(slot['end_time'])
     hours = (edt - sdt).total_seconds() / 3600
-    avg_r, cnt_r = db.get_spot_rating(slot['spot_id'])
+    avg_r, cnt_r = await adb.get_spot_rating(slot['spot_id'])
     rating = f"\n⭐ {avg_r}/5 ({cnt_r})" if cnt_r else ""
     full_price = calculate_price(sdt, edt)
     rate = get_price_per_hour(hours)
@@ -539,18 +516,18 @@ async def bk_end_time(callback: CallbackQuery, state: FSMContext):
 
 # Booking: Confirm → заявка (pending) → админу
 @router.callback_query(SearchStates.confirming_booking, F.data.startswith("booking_confirm_"))
-async def confirm_booking(callback: CallbackQuery, state: FSMContext):
+async def confirm_booking(callback: CallbackQuery, state: FSMContext, user: dict, is_admin: bool):
     await callback.answer()
     if callback.data == "booking_confirm_no":
         await state.clear()
         await callback.message.edit_text("❌ Отменено.")
-        await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(_adm(callback.from_user.id))); return
+        await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(is_admin)); return
     data = await state.get_data()
     needed = ('user_id','spot_id','selected_slot_id','start_time','end_time','total_price')
     if not all(k in data for k in needed):
         await state.clear(); await callback.message.edit_text("❌ Данные потеряны."); return
     try:
-        bid = db.create_booking(data['user_id'], data['spot_id'], data['selected_slot_id'],
+        bid = await adb.create_booking(data['user_id'], data['spot_id'], data['selected_slot_id'],
                                 data['start_time'], data['end_time'], data['total_price'])
     except Exception as e:
         logger.error(f"Booking: {e}")
@@ -566,11 +543,10 @@ async def confirm_booking(callback: CallbackQuery, state: FSMContext):
         await state.clear()
         await callback.message.edit_text(text)
         return
-    user = db.get_user_by_telegram_id(callback.from_user.id)
     await state.clear()
     h = (data['end_time'] - data['start_time']).total_seconds() / 3600
     rate = get_price_per_hour(h)
-    supplier = db.get_user_by_id(data.get('supplier_id')) if data.get('supplier_id') else None
+    supplier = await adb.get_user_by_id(data.get('supplier_id')) if data.get('supplier_id') else None
     card_number = ""
     bank_name = ""
     if supplier and supplier.get('card_number'):
@@ -592,7 +568,7 @@ async def confirm_booking(callback: CallbackQuery, state: FSMContext):
         reply_markup=booking_payment_keyboard(bid),
         parse_mode="HTML"
     )
-    await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(_adm(callback.from_user.id)))
+    await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(is_admin))
     # Админам
     try:
         car = ""
@@ -600,7 +576,7 @@ async def confirm_booking(callback: CallbackQuery, state: FSMContext):
             car = f"\n🚗 {user['car_brand']} {user['car_color']} ({user['license_plate']})"
         cust_info = f"👤 {user['full_name']}\n📞 {user['phone']}"
         if user.get('username'): cust_info += f"\n📱 @{user['username']}"
-        supplier = db.get_user_by_id(data.get('supplier_id'))
+        supplier = await adb.get_user_by_id(data.get('supplier_id'))
         sup_info = ""
         if supplier:
             sup_info = f"\n\n🟢 <b>Поставщик:</b>\n👤 {supplier['full_name']}\n📞 {supplier['phone']}"
@@ -616,24 +592,20 @@ async def confirm_booking(callback: CallbackQuery, state: FSMContext):
              InlineKeyboardButton(text="❌ Отклонить", callback_data=f"adm_reject_{bid}")],
             [InlineKeyboardButton(text="✏️ Редактировать", callback_data=f"adm_edit_{bid}")]
         ])
-        for adm in db.get_admins():
-            try: await callback.bot.send_message(adm['telegram_id'], admin_msg, reply_markup=kb, parse_mode="HTML")
-            except: pass
+        await outbox.notify_many([adm['telegram_id'] for adm in await adb.get_admins()],
+                                 admin_msg, parse_mode="HTML", reply_markup=kb)
     except: pass
     # Поставщику
-    try:
-        await callback.bot.send_message(data.get('supplier_telegram_id'),
+    if data.get('supplier_telegram_id'):
+        await outbox.notify(data['supplier_telegram_id'],
             f"📋 <b>Новая заявка #{bid}!</b>\n🏠 {data.get('spot_number','')}\n"
             f"📅 {format_datetime(data['start_time'])} — {format_datetime(data['end_time'])}\n"
             f"⏳ Ожидает подтверждения.", parse_mode="HTML")
-    except: pass
 
 
 # ==================== ADD SPOT — запоминаем места ====================
 @router.message(F.text == "➕ Добавить место")
-async def add_spot_start(message: Message, state: FSMContext):
-    if await _check_ban(message): return
-    user = db.get_user_by_telegram_id(message.from_user.id)
+async def add_spot_start(message: Message, state: FSMContext, user: dict):
     if not user: await message.answer("❌ /start"); return
     if not db.user_has_card_info(user):
         await state.update_data(pending_action='add_spot', supplier_id=user['id'])
@@ -641,7 +613,7 @@ async def add_spot_start(message: Message, state: FSMContext):
             reply_markup=get_cancel_menu_keyboard(), parse_mode="HTML")
         await state.set_state(CardInfoStates.waiting_card); return
     # Если есть места — показать их + кнопку "Новое место"
-    existing = db.get_user_spots(user['id'])
+    existing = await adb.get_user_spots(user['id'])
     await state.update_data(supplier_id=user['id'])
     if existing:
         buttons = []
@@ -665,15 +637,14 @@ async def new_spot(callback: CallbackQuery, state: FSMContext):
 
 # CARD INFO
 @router.callback_query(CardInfoStates.waiting_bank, F.data.startswith("bank_"))
-async def card_bank(callback: CallbackQuery, state: FSMContext):
+async def card_bank(callback: CallbackQuery, state: FSMContext, user: dict, is_admin: bool):
     await callback.answer()
     bank = callback.data.replace("bank_","")
     if bank == "Другой":
         await callback.message.edit_text("🏦 Введите название банка:")
         await state.set_state(CardInfoStates.waiting_bank_name); return
     data = await state.get_data()
-    user = db.get_user_by_telegram_id(callback.from_user.id)
-    db.update_user(user['id'], card_number=data['card_number'], bank=bank)
+    await adb.update_user(user['id'], card_number=data['card_number'], bank=bank)
     pending = data.get('pending_action')
     await state.clear()
     if pending == 'add_spot':
@@ -683,16 +654,15 @@ async def card_bank(callback: CallbackQuery, state: FSMContext):
         await state.set_state(AddSpotStates.waiting_spot_number)
     else:
         await callback.message.edit_text(f"✅ Карта: {bank}")
-        await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(_adm(callback.from_user.id)))
+        await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(is_admin))
 
 @router.message(CardInfoStates.waiting_bank_name)
-async def card_bank_manual(message: Message, state: FSMContext):
-    if _cancel_check(message.text): await cancel_msg(message, state); return
+async def card_bank_manual(message: Message, state: FSMContext, user: dict, is_admin: bool):
+    if _cancel_check(message.text): await cancel_msg(message, state, is_admin); return
     bank = message.text.strip()
     if len(bank) < 2 or len(bank) > 30: await message.answer("❌ 2-30 символов"); return
     data = await state.get_data()
-    user = db.get_user_by_telegram_id(message.from_user.id)
-    db.update_user(user['id'], card_number=data['card_number'], bank=bank)
+    await adb.update_user(user['id'], card_number=data['card_number'], bank=bank)
     pending = data.get('pending_action')
     await state.clear()
     if pending == 'add_spot':
@@ -701,11 +671,11 @@ async def card_bank_manual(message: Message, state: FSMContext):
             reply_markup=get_cancel_menu_keyboard(), parse_mode="HTML")
         await state.set_state(AddSpotStates.waiting_spot_number)
     else:
-        await message.answer(f"✅ Карта: {bank}", reply_markup=get_main_menu_keyboard(_adm(message.from_user.id)))
+        await message.answer(f"✅ Карта: {bank}", reply_markup=get_main_menu_keyboard(is_admin))
 
 @router.message(CardInfoStates.waiting_card)
-async def card_number(message: Message, state: FSMContext):
-    if _cancel_check(message.text): await cancel_msg(message, state); return
+async def card_number(message: Message, state: FSMContext, is_admin: bool):
+    if _cancel_check(message.text): await cancel_msg(message, state, is_admin); return
     ok, r = validate_card(message.text)
     if not ok: await message.answer(r); return
     await state.update_data(card_number=r)
@@ -718,9 +688,9 @@ async def card_number(message: Message, state: FSMContext):
 
 
 @router.message(AddSpotStates.waiting_spot_number)
-async def sp_num(message: Message, state: FSMContext):
+async def sp_num(message: Message, state: FSMContext, is_admin: bool):
     if _cancel_check(message.text):
-        await cancel_msg(message, state)
+        await cancel_msg(message, state, is_admin)
         return
     ok, r = validate_spot_number(message.text)
     if not ok:
@@ -744,8 +714,8 @@ async def sp_sd(callback: CallbackQuery, state: FSMContext):
     await state.set_state(AddSpotStates.waiting_start_time)
 
 @router.message(AddSpotStates.waiting_start_date_manual)
-async def sp_sd_m(message: Message, state: FSMContext):
-    if _cancel_check(message.text): await cancel_msg(message, state); return
+async def sp_sd_m(message: Message, state: FSMContext, is_admin: bool):
+    if _cancel_check(message.text): await cancel_msg(message, state, is_admin); return
     ok, _ = validate_date(message.text)
     if not ok: await message.answer("❌ ДД.ММ.ГГГГ"); return
     await state.update_data(start_date=message.text)
@@ -763,8 +733,8 @@ async def sp_st(callback: CallbackQuery, state: FSMContext):
     await state.set_state(AddSpotStates.waiting_end_date)
 
 @router.message(AddSpotStates.waiting_start_time_manual)
-async def sp_st_m(message: Message, state: FSMContext):
-    if _cancel_check(message.text): await cancel_msg(message, state); return
+async def sp_st_m(message: Message, state: FSMContext, is_admin: bool):
+    if _cancel_check(message.text): await cancel_msg(message, state, is_admin); return
     ok, r = validate_time(message.text)
     if not ok: await message.answer("❌ ЧЧ:ММ"); return
     await state.update_data(start_time_str=r)
@@ -786,8 +756,8 @@ async def sp_ed(callback: CallbackQuery, state: FSMContext):
     await state.set_state(AddSpotStates.waiting_end_time)
 
 @router.message(AddSpotStates.waiting_end_date_manual)
-async def sp_ed_m(message: Message, state: FSMContext):
-    if _cancel_check(message.text): await cancel_msg(message, state); return
+async def sp_ed_m(message: Message, state: FSMContext, is_admin: bool):
+    if _cancel_check(message.text): await cancel_msg(message, state, is_admin); return
     data = await state.get_data()
     ok, pe = validate_date(message.text); _, ps = validate_date(data['start_date'])
     if not ok or pe < ps: await message.answer("❌"); return
@@ -813,8 +783,8 @@ async def sp_et(callback: CallbackQuery, state: FSMContext):
     await state.set_state(AddSpotStates.confirming)
 
 @router.message(AddSpotStates.waiting_end_time_manual)
-async def sp_et_m(message: Message, state: FSMContext):
-    if _cancel_check(message.text): await cancel_msg(message, state); return
+async def sp_et_m(message: Message, state: FSMContext, is_admin: bool):
+    if _cancel_check(message.text): await cancel_msg(message, state, is_admin); return
     ok, r = validate_time(message.text)
     if not ok: await message.answer("❌ ЧЧ:ММ"); return
     data = await state.get_data()
@@ -829,14 +799,14 @@ async def sp_et_m(message: Message, state: FSMContext):
     await state.set_state(AddSpotStates.confirming)
 
 @router.callback_query(AddSpotStates.confirming, F.data.startswith("spot_confirm_"))
-async def spot_confirm(callback: CallbackQuery, state: FSMContext):
+async def spot_confirm(callback: CallbackQuery, state: FSMContext, is_admin: bool):
     # Always answer callback immediately so Telegram button never spins forever
     await callback.answer()
 
     if callback.data == "spot_confirm_no":
         await state.clear()
         await callback.message.edit_text("❌ Отменено.")
-        await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(_adm(callback.from_user.id)))
+        await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(is_admin))
         return
 
     # YES
@@ -874,21 +844,21 @@ async def spot_confirm(callback: CallbackQuery, state: FSMContext):
         )
         if not ok:
             await callback.message.edit_text(msg)
-            await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(_adm(callback.from_user.id)))
+            await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(is_admin))
             await state.clear()
             return
 
         # Save spot (remember place)
-        spot_id = db.get_or_create_spot(data['supplier_id'], data['spot_number'])
+        spot_id = await adb.get_or_create_spot(data['supplier_id'], data['spot_number'])
 
         # Overlap check
-        if db.check_slot_overlap(spot_id, sdt, edt):
+        if await adb.check_slot_overlap(spot_id, sdt, edt):
             await callback.message.edit_text("❌ Слот пересекается с существующим!")
-            await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(_adm(callback.from_user.id)))
+            await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(is_admin))
             await state.clear()
             return
 
-        db.create_spot_availability(spot_id, sdt, edt)
+        await adb.create_spot_availability(spot_id, sdt, edt)
 
         await state.clear()
         await callback.message.edit_text(
@@ -896,15 +866,12 @@ async def spot_confirm(callback: CallbackQuery, state: FSMContext):
             f"📅 {format_datetime(sdt)} — {format_datetime(edt)}",
             parse_mode="HTML"
         )
-        await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(_adm(callback.from_user.id)))
+        await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(is_admin))
 
         # Notify subscribers (optional)
-        for n in db.get_matching_notifications(spot_id, sdt, edt):
-            try:
-                await callback.bot.send_message(n['telegram_id'], f"🔔 Место {data['spot_number']} освободилось!")
-                db.deactivate_notification(n['id'])
-            except Exception:
-                pass
+        for n in await adb.get_matching_notifications(spot_id, sdt, edt):
+            await outbox.notify(n['telegram_id'], f"🔔 Место {data['spot_number']} освободилось!")
+            await adb.deactivate_notification(n['id'])
 
     except Exception as e:
         try:
@@ -914,10 +881,9 @@ async def spot_confirm(callback: CallbackQuery, state: FSMContext):
         await state.clear()
         return
 @router.message(F.text == "🏠 Мои слоты")
-async def my_spots(message: Message, state: FSMContext):
-    user = db.get_user_by_telegram_id(message.from_user.id)
+async def my_spots(message: Message, state: FSMContext, user: dict):
     if not user: await message.answer("❌ /start"); return
-    spots = db.get_user_spots(user['id'])
+    spots = await adb.get_user_spots(user['id'])
     if not spots:
         await message.answer("😔 У вас нет мест.\nДобавьте через «➕ Добавить место»"); return
     await message.answer("🏠 <b>Ваши места:</b>", reply_markup=get_my_spots_keyboard(spots), parse_mode="HTML")
@@ -926,10 +892,10 @@ async def my_spots(message: Message, state: FSMContext):
 async def spot_detail(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     sid = int(callback.data.replace("myspot_",""))
-    spot = db.get_spot_by_id(sid)
+    spot = await adb.get_spot_by_id(sid)
     if not spot: await callback.message.edit_text("❌ Не найдено."); return
     await state.update_data(current_spot_id=sid)
-    avails = db.get_spot_availabilities(sid)
+    avails = await adb.get_spot_availabilities(sid)
     at = ""
     for a in avails:
         s = datetime.fromisoformat(a['start_time'])
@@ -957,7 +923,7 @@ async def spot_detail(callback: CallbackQuery, state: FSMContext):
 async def myslot_actions(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     aid = int(callback.data.replace("myslot_",""))
-    slot = db.get_slot_by_id(aid)
+    slot = await adb.get_slot_by_id(aid)
     if not slot or slot['is_booked']:
         await callback.message.edit_text("❌ Слот занят или не найден."); return
     s = datetime.fromisoformat(slot['start_time'])
@@ -969,20 +935,20 @@ async def myslot_actions(callback: CallbackQuery, state: FSMContext):
 
 # Удалить слот
 @router.callback_query(F.data.startswith("delslot_"))
-async def del_slot(callback: CallbackQuery, state: FSMContext):
+async def del_slot(callback: CallbackQuery, state: FSMContext, is_admin: bool):
     await callback.answer()
     aid = int(callback.data.replace("delslot_",""))
-    ok = db.delete_slot(aid)
+    ok = await adb.delete_slot(aid)
     if ok: await callback.message.edit_text("✅ Слот удалён.")
     else: await callback.message.edit_text("❌ Не удалось удалить (возможно забронирован).")
-    await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(_adm(callback.from_user.id)))
+    await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(is_admin))
 
 # Редактировать слот — выбор что менять
 @router.callback_query(F.data.startswith("editslot_"))
 async def edit_slot_start(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     aid = int(callback.data.replace("editslot_",""))
-    slot = db.get_slot_by_id(aid)
+    slot = await adb.get_slot_by_id(aid)
     if not slot or slot['is_booked']:
         await callback.message.edit_text("❌ Слот занят."); return
     await state.update_data(edit_slot_id=aid, edit_slot_spot_id=slot['spot_id'],
@@ -1007,8 +973,8 @@ async def es_start(callback: CallbackQuery, state: FSMContext):
     await state.set_state(EditSlotStates.waiting_start_date)
 
 @router.message(EditSlotStates.waiting_start_date)
-async def es_start_date(message: Message, state: FSMContext):
-    if _cancel_check(message.text): await cancel_msg(message, state); return
+async def es_start_date(message: Message, state: FSMContext, is_admin: bool):
+    if _cancel_check(message.text): await cancel_msg(message, state, is_admin); return
     ok, _ = validate_date(message.text)
     if not ok: await message.answer("❌ ДД.ММ.ГГГГ"); return
     await state.update_data(es_new_start_date=message.text)
@@ -1016,8 +982,8 @@ async def es_start_date(message: Message, state: FSMContext):
     await state.set_state(EditSlotStates.waiting_start_time)
 
 @router.message(EditSlotStates.waiting_start_time)
-async def es_start_time(message: Message, state: FSMContext):
-    if _cancel_check(message.text): await cancel_msg(message, state); return
+async def es_start_time(message: Message, state: FSMContext, is_admin: bool):
+    if _cancel_check(message.text): await cancel_msg(message, state, is_admin); return
     ok, r = validate_time(message.text)
     if not ok: await message.answer("❌ ЧЧ:ММ"); return
     data = await state.get_data()
@@ -1025,12 +991,12 @@ async def es_start_time(message: Message, state: FSMContext):
     old_end = datetime.fromisoformat(data['edit_orig_end'])
     if new_start >= old_end: await message.answer("❌ Начало должно быть раньше конца"); return
     aid = data['edit_slot_id']; spot_id = data['edit_slot_spot_id']
-    if db.check_slot_overlap(spot_id, new_start, old_end, exclude_slot_id=aid):
+    if await adb.check_slot_overlap(spot_id, new_start, old_end, exclude_slot_id=aid):
         await message.answer("❌ Пересечение с другим слотом!"); return
-    db.update_slot_times(aid, new_start, old_end)
+    await adb.update_slot_times(aid, new_start, old_end)
     await state.clear()
     await message.answer(f"✅ Слот обновлён!\n📅 {format_datetime(new_start)} — {format_datetime(old_end)}",
-        reply_markup=get_main_menu_keyboard(_adm(message.from_user.id)))
+        reply_markup=get_main_menu_keyboard(is_admin))
 
 @router.callback_query(EditSlotStates.choosing_field, F.data == "es_end")
 async def es_end(callback: CallbackQuery, state: FSMContext):
@@ -1039,8 +1005,8 @@ async def es_end(callback: CallbackQuery, state: FSMContext):
     await state.set_state(EditSlotStates.waiting_end_date)
 
 @router.message(EditSlotStates.waiting_end_date)
-async def es_end_date(message: Message, state: FSMContext):
-    if _cancel_check(message.text): await cancel_msg(message, state); return
+async def es_end_date(message: Message, state: FSMContext, is_admin: bool):
+    if _cancel_check(message.text): await cancel_msg(message, state, is_admin); return
     ok, _ = validate_date(message.text)
     if not ok: await message.answer("❌ ДД.ММ.ГГГГ"); return
     await state.update_data(es_new_end_date=message.text)
@@ -1048,8 +1014,8 @@ async def es_end_date(message: Message, state: FSMContext):
     await state.set_state(EditSlotStates.waiting_end_time)
 
 @router.message(EditSlotStates.waiting_end_time)
-async def es_end_time(message: Message, state: FSMContext):
-    if _cancel_check(message.text): await cancel_msg(message, state); return
+async def es_end_time(message: Message, state: FSMContext, is_admin: bool):
+    if _cancel_check(message.text): await cancel_msg(message, state, is_admin); return
     ok, r = validate_time(message.text)
     if not ok: await message.answer("❌ ЧЧ:ММ"); return
     data = await state.get_data()
@@ -1057,12 +1023,12 @@ async def es_end_time(message: Message, state: FSMContext):
     new_end = parse_datetime(data['es_new_end_date'], r)
     if new_end <= old_start: await message.answer("❌ Конец после начала"); return
     aid = data['edit_slot_id']; spot_id = data['edit_slot_spot_id']
-    if db.check_slot_overlap(spot_id, old_start, new_end, exclude_slot_id=aid):
+    if await adb.check_slot_overlap(spot_id, old_start, new_end, exclude_slot_id=aid):
         await message.answer("❌ Пересечение!"); return
-    db.update_slot_times(aid, old_start, new_end)
+    await adb.update_slot_times(aid, old_start, new_end)
     await state.clear()
     await message.answer(f"✅ Слот обновлён!\n📅 {format_datetime(old_start)} — {format_datetime(new_end)}",
-        reply_markup=get_main_menu_keyboard(_adm(message.from_user.id)))
+        reply_markup=get_main_menu_keyboard(is_admin))
 
 
 @router.callback_query(F.data == "back_spot_detail")
@@ -1072,9 +1038,9 @@ async def back_spot_detail(callback: CallbackQuery, state: FSMContext):
     sid = data.get('current_spot_id') or data.get('edit_slot_spot_id')
     if not sid:
         await callback.message.edit_text("🔙"); return
-    spot = db.get_spot_by_id(sid)
+    spot = await adb.get_spot_by_id(sid)
     if not spot: return
-    avails = db.get_spot_availabilities(sid)
+    avails = await adb.get_spot_availabilities(sid)
     buttons = []
     for a in avails:
         if not a['is_booked']:
@@ -1096,10 +1062,9 @@ async def back_spot_detail(callback: CallbackQuery, state: FSMContext):
         reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons), parse_mode="HTML")
 
 @router.callback_query(F.data == "back_spots")
-async def back_spots(callback: CallbackQuery, state: FSMContext):
+async def back_spots(callback: CallbackQuery, state: FSMContext, user: dict):
     await callback.answer()
-    user = db.get_user_by_telegram_id(callback.from_user.id)
-    spots = db.get_user_spots(user['id'])
+    spots = await adb.get_user_spots(user['id'])
     if not spots: await callback.message.edit_text("😔 Нет мест.")
     else: await callback.message.edit_text("🏠 <b>Ваши места:</b>",
         reply_markup=get_my_spots_keyboard(spots), parse_mode="HTML")
@@ -1127,8 +1092,8 @@ async def aslot_sd(callback: CallbackQuery, state: FSMContext):
     await state.set_state(AddSlotStates.waiting_start_time)
 
 @router.message(AddSlotStates.waiting_start_date_manual)
-async def aslot_sd_m(message: Message, state: FSMContext):
-    if _cancel_check(message.text): await cancel_msg(message, state); return
+async def aslot_sd_m(message: Message, state: FSMContext, is_admin: bool):
+    if _cancel_check(message.text): await cancel_msg(message, state, is_admin); return
     ok, _ = validate_date(message.text)
     if not ok: await message.answer("❌"); return
     await state.update_data(aslot_start_date=message.text)
@@ -1146,8 +1111,8 @@ async def aslot_st(callback: CallbackQuery, state: FSMContext):
     await state.set_state(AddSlotStates.waiting_end_date)
 
 @router.message(AddSlotStates.waiting_start_time_manual)
-async def aslot_st_m(message: Message, state: FSMContext):
-    if _cancel_check(message.text): await cancel_msg(message, state); return
+async def aslot_st_m(message: Message, state: FSMContext, is_admin: bool):
+    if _cancel_check(message.text): await cancel_msg(message, state, is_admin); return
     ok, r = validate_time(message.text)
     if not ok: await message.answer("❌"); return
     await state.update_data(aslot_start_time=r)
@@ -1169,8 +1134,8 @@ async def aslot_ed(callback: CallbackQuery, state: FSMContext):
     await state.set_state(AddSlotStates.waiting_end_time)
 
 @router.message(AddSlotStates.waiting_end_date_manual)
-async def aslot_ed_m(message: Message, state: FSMContext):
-    if _cancel_check(message.text): await cancel_msg(message, state); return
+async def aslot_ed_m(message: Message, state: FSMContext, is_admin: bool):
+    if _cancel_check(message.text): await cancel_msg(message, state, is_admin); return
     data = await state.get_data()
     ok, pe = validate_date(message.text); _, ps = validate_date(data['aslot_start_date'])
     if not ok or pe < ps: await message.answer("❌"); return
@@ -1179,7 +1144,7 @@ async def aslot_ed_m(message: Message, state: FSMContext):
     await state.set_state(AddSlotStates.waiting_end_time)
 
 @router.callback_query(AddSlotStates.waiting_end_time, F.data.startswith("aslot_et_"))
-async def aslot_et(callback: CallbackQuery, state: FSMContext):
+async def aslot_et(callback: CallbackQuery, state: FSMContext, is_admin: bool):
     await callback.answer()
     tv = callback.data.replace("aslot_et_","")
     if tv == "manual":
@@ -1189,18 +1154,18 @@ async def aslot_et(callback: CallbackQuery, state: FSMContext):
     edt = parse_datetime(data['aslot_end_date'], tv)
     if not edt or edt <= sdt: return
     sid = data['addslot_spot_id']
-    if db.check_slot_overlap(sid, sdt, edt):
+    if await adb.check_slot_overlap(sid, sdt, edt):
         await callback.message.edit_text("❌ Пересечение с существующим слотом!")
-        await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(_adm(callback.from_user.id)))
+        await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(is_admin))
         await state.clear(); return
-    db.create_spot_availability(sid, sdt, edt)
+    await adb.create_spot_availability(sid, sdt, edt)
     await state.clear()
     await callback.message.edit_text(f"✅ Слот добавлен!\n📅 {format_datetime(sdt)} — {format_datetime(edt)}")
-    await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(_adm(callback.from_user.id)))
+    await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(is_admin))
 
 @router.message(AddSlotStates.waiting_end_time_manual)
-async def aslot_et_m(message: Message, state: FSMContext):
-    if _cancel_check(message.text): await cancel_msg(message, state); return
+async def aslot_et_m(message: Message, state: FSMContext, is_admin: bool):
+    if _cancel_check(message.text): await cancel_msg(message, state, is_admin); return
     ok, r = validate_time(message.text)
     if not ok: await message.answer("❌"); return
     data = await state.get_data()
@@ -1208,53 +1173,67 @@ async def aslot_et_m(message: Message, state: FSMContext):
     edt = parse_datetime(data['aslot_end_date'], r)
     if not edt or edt <= sdt: await message.answer("❌"); return
     sid = data['addslot_spot_id']
-    if db.check_slot_overlap(sid, sdt, edt):
+    if await adb.check_slot_overlap(sid, sdt, edt):
         await message.answer("❌ Пересечение с существующим слотом!")
         await state.clear(); return
-    db.create_spot_availability(sid, sdt, edt)
+    await adb.create_spot_availability(sid, sdt, edt)
     await state.clear()
     await message.answer(f"✅ Слот!\n📅 {format_datetime(sdt)} — {format_datetime(edt)}",
-        reply_markup=get_main_menu_keyboard(_adm(message.from_user.id)))
+        reply_markup=get_main_menu_keyboard(is_admin))
 
 # Удалить место
 @router.callback_query(F.data.startswith("delspot_"))
-async def delspot(callback: CallbackQuery, state: FSMContext):
+async def delspot(callback: CallbackQuery, state: FSMContext, is_admin: bool):
     await callback.answer()
     sid = int(callback.data.replace("delspot_",""))
-    db.delete_spot(sid)
+    await adb.delete_spot(sid)
     await callback.message.edit_text("✅ Место удалено.")
-    await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(_adm(callback.from_user.id)))
+    await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(is_admin))
 
 
 # ==================== MY BOOKINGS ====================
-@router.message(F.text == "📋 Мои бронирования")
-async def my_bookings(message: Message, state: FSMContext):
-    user = db.get_user_by_telegram_id(message.from_user.id)
-    if not user: await message.answer("❌ /start"); return
-    bookings = db.get_user_bookings(user['id'])
-    if not bookings: await message.answer("😔 Нет бронирований."); return
+def _bookings_markup(bookings, limit=15, history=True):
     buttons = []
-    for b in bookings[:15]:
+    for b in bookings[:limit]:
         s = datetime.fromisoformat(b['start_time'])
         e = datetime.fromisoformat(b['end_time'])
-        st = {"pending":"⏳","confirmed":"✅","cancelled":"❌","completed":"✔️"}.get(b['status'],'')
+        st = {"pending":"⏳","confirmed":"✅","cancelled":"❌","completed":"✔️","expired":"⌛️"}.get(b['status'],'')
         text = f"{st} {b['spot_number']} {s.strftime('%d.%m %H:%M')}-{e.strftime('%d.%m %H:%M')}"
         buttons.append([InlineKeyboardButton(text=text, callback_data=f"mybk_{b['id']}")])
+    if history:
+        # старые брони лежат в архиве и читаются только по запросу
+        buttons.append([InlineKeyboardButton(text="🗂 История", callback_data="bk_history")])
     buttons.append([InlineKeyboardButton(text="🔙 Меню", callback_data="main_menu")])
-    await message.answer("📋 <b>Бронирования:</b>",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons), parse_mode="HTML")
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+@router.message(F.text == "📋 Мои бронирования")
+async def my_bookings(message: Message, state: FSMContext, user: dict):
+    if not user: await message.answer("❌ /start"); return
+    bookings = await adb.get_user_bookings(user['id'])
+    if not bookings:
+        await message.answer("😔 Нет текущих бронирований.", reply_markup=_bookings_markup([])); return
+    await message.answer("📋 <b>Бронирования:</b>", reply_markup=_bookings_markup(bookings), parse_mode="HTML")
+
+@router.callback_query(F.data == "bk_history")
+async def bookings_history(callback: CallbackQuery, state: FSMContext, user: dict):
+    await callback.answer()
+    bookings = await adb.get_user_bookings(user['id'], include_archive=True)
+    if not bookings: await callback.message.edit_text("😔 Нет бронирований."); return
+    await callback.message.edit_text("🗂 <b>История бронирований:</b>",
+        reply_markup=_bookings_markup(bookings, limit=40, history=False), parse_mode="HTML")
 
 @router.callback_query(F.data.startswith("mybk_"))
 async def booking_detail(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     bid = int(callback.data.replace("mybk_",""))
-    b = db.get_booking_by_id(bid)
+    b = await adb.get_booking_by_id(bid) or await adb.get_archived_booking(bid)
     if not b: await callback.message.edit_text("❌ Не найдена."); return
     s = datetime.fromisoformat(b['start_time'])
     e = datetime.fromisoformat(b['end_time'])
     h = (e-s).total_seconds()/3600
     rate = get_price_per_hour(h)
-    st = {"pending":"⏳ Ожидает","confirmed":"✅ Подтверждена","cancelled":"❌ Отменена","completed":"✔️ Завершена"}.get(b['status'],'')
+    st = {"pending":"⏳ Ожидает","confirmed":"✅ Подтверждена","cancelled":"❌ Отменена","completed":"✔️ Завершена",
+          "expired":"⌛️ Истекла"}.get(b['status'],'')
     await callback.message.edit_text(
         f"📋 <b>Бронь #{bid}</b>\n\n🏠 {b['spot_number']}\n"
         f"📅 {format_datetime(s)} — {format_datetime(e)}\n"
@@ -1263,28 +1242,18 @@ async def booking_detail(callback: CallbackQuery, state: FSMContext):
         reply_markup=get_booking_detail_keyboard(b, b['customer_id']), parse_mode="HTML")
 
 @router.callback_query(F.data == "back_bookings")
-async def back_bk(callback: CallbackQuery, state: FSMContext):
+async def back_bk(callback: CallbackQuery, state: FSMContext, user: dict):
     await callback.answer()
-    user = db.get_user_by_telegram_id(callback.from_user.id)
-    bookings = db.get_user_bookings(user['id'])
-    buttons = []
-    for b in bookings[:15]:
-        s = datetime.fromisoformat(b['start_time'])
-        e = datetime.fromisoformat(b['end_time'])
-        st = {"pending":"⏳","confirmed":"✅","cancelled":"❌","completed":"✔️"}.get(b['status'],'')
-        text = f"{st} {b['spot_number']} {s.strftime('%d.%m %H:%M')}-{e.strftime('%d.%m %H:%M')}"
-        buttons.append([InlineKeyboardButton(text=text, callback_data=f"mybk_{b['id']}")])
-    buttons.append([InlineKeyboardButton(text="🔙 Меню", callback_data="main_menu")])
-    await callback.message.edit_text("📋 <b>Бронирования:</b>",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons), parse_mode="HTML")
+    bookings = await adb.get_user_bookings(user['id'])
+    await callback.message.edit_text("📋 <b>Бронирования:</b>", reply_markup=_bookings_markup(bookings), parse_mode="HTML")
 
 @router.callback_query(F.data.startswith("cancel_booking_"))
-async def cancel_bk(callback: CallbackQuery, state: FSMContext):
+async def cancel_bk(callback: CallbackQuery, state: FSMContext, is_admin: bool):
     await callback.answer()
     bid = int(callback.data.replace("cancel_booking_",""))
-    db.cancel_booking(bid)
+    await adb.cancel_booking(bid)
     await callback.message.edit_text(f"❌ Бронь #{bid} отменена.")
-    await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(_adm(callback.from_user.id)))
+    await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(is_admin))
 
 
 # ==================== REVIEWS ====================
@@ -1292,9 +1261,14 @@ async def cancel_bk(callback: CallbackQuery, state: FSMContext):
 async def review_start(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     bid = int(callback.data.replace("review_start_",""))
-    booking = db.get_booking_by_id(bid)
-    if not booking or booking.get('reviewed'):
+    booking = await adb.get_booking_by_id(bid)
+    if not booking:
+        # бронь уже в архиве (или удалена) — отзыв на неё не принимается
+        await callback.message.answer("⌛️ Срок для отзыва по этой брони истёк."); return
+    if booking.get('reviewed'):
         await callback.message.answer("❌ Отзыв уже оставлен."); return
+    if booking['status'] != 'completed':
+        await callback.message.answer("❌ Отзыв можно оставить после завершения брони."); return
     await state.update_data(review_booking_id=bid, review_spot_id=booking['spot_id'],
                             review_supplier_id=booking['supplier_id'])
     await callback.message.edit_text(f"⭐ <b>Оцените {booking['spot_number']}</b>:",
@@ -1311,30 +1285,27 @@ async def review_rate(callback: CallbackQuery, state: FSMContext):
     await state.set_state(ReviewStates.waiting_comment)
 
 @router.callback_query(ReviewStates.waiting_comment, F.data == "review_nocomment")
-async def review_nocomment(callback: CallbackQuery, state: FSMContext):
+async def review_nocomment(callback: CallbackQuery, state: FSMContext, user: dict, is_admin: bool):
     await callback.answer()
     data = await state.get_data()
-    user = db.get_user_by_telegram_id(callback.from_user.id)
-    db.create_review(data['review_booking_id'], user['id'], data['review_spot_id'],
+    await adb.create_review(data['review_booking_id'], user['id'], data['review_spot_id'],
                      data['review_supplier_id'], data['review_rating'])
     await state.clear()
     await callback.message.edit_text("✅ Отзыв!")
-    await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(_adm(callback.from_user.id)))
+    await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(is_admin))
 
 @router.message(ReviewStates.waiting_comment)
-async def review_comment(message: Message, state: FSMContext):
+async def review_comment(message: Message, state: FSMContext, user: dict, is_admin: bool):
     data = await state.get_data()
-    user = db.get_user_by_telegram_id(message.from_user.id)
-    db.create_review(data['review_booking_id'], user['id'], data['review_spot_id'],
+    await adb.create_review(data['review_booking_id'], user['id'], data['review_spot_id'],
                      data['review_supplier_id'], data['review_rating'], message.text[:500])
     await state.clear()
-    await message.answer("✅ Отзыв!", reply_markup=get_main_menu_keyboard(_adm(message.from_user.id)))
+    await message.answer("✅ Отзыв!", reply_markup=get_main_menu_keyboard(is_admin))
 
 
 # ==================== PROFILE ====================
 @router.message(F.text == "👤 Профиль")
-async def profile(message: Message, state: FSMContext):
-    user = db.get_user_by_telegram_id(message.from_user.id)
+async def profile(message: Message, state: FSMContext, user: dict):
     if not user: await message.answer("❌ /start"); return
     card = f"\n💳 {user['bank']}: {mask_card(user['card_number'])}" if user.get('card_number') else ""
     car = ""
@@ -1351,12 +1322,11 @@ async def edit_name(callback: CallbackQuery, state: FSMContext):
     await state.set_state(EditProfileStates.waiting_name)
 
 @router.message(EditProfileStates.waiting_name)
-async def save_name(message: Message, state: FSMContext):
+async def save_name(message: Message, state: FSMContext, user: dict, is_admin: bool):
     ok, r = validate_name(message.text)
     if not ok: await message.answer(r); return
-    user = db.get_user_by_telegram_id(message.from_user.id)
-    db.update_user(user['id'], full_name=r); await state.clear()
-    await message.answer(f"✅ Имя: {r}", reply_markup=get_main_menu_keyboard(_adm(message.from_user.id)))
+    await adb.update_user(user['id'], full_name=r); await state.clear()
+    await message.answer(f"✅ Имя: {r}", reply_markup=get_main_menu_keyboard(is_admin))
 
 @router.callback_query(F.data == "edit_phone")
 async def edit_phone(callback: CallbackQuery, state: FSMContext):
@@ -1365,7 +1335,7 @@ async def edit_phone(callback: CallbackQuery, state: FSMContext):
     await state.set_state(EditProfileStates.waiting_phone)
 
 @router.message(EditProfileStates.waiting_phone)
-async def save_phone(message: Message, state: FSMContext):
+async def save_phone(message: Message, state: FSMContext, user: dict, is_admin: bool):
     if message.contact:
         phone = message.contact.phone_number
         if phone.startswith('+'): phone = phone[1:]
@@ -1374,9 +1344,8 @@ async def save_phone(message: Message, state: FSMContext):
     else:
         ok, r = validate_phone(message.text)
         if not ok: await message.answer(r); return
-    user = db.get_user_by_telegram_id(message.from_user.id)
-    db.update_user(user['id'], phone=r); await state.clear()
-    await message.answer(f"✅ Телефон: {r}", reply_markup=get_main_menu_keyboard(_adm(message.from_user.id)))
+    await adb.update_user(user['id'], phone=r); await state.clear()
+    await message.answer(f"✅ Телефон: {r}", reply_markup=get_main_menu_keyboard(is_admin))
 
 @router.callback_query(F.data == "edit_car")
 async def edit_car(callback: CallbackQuery, state: FSMContext):
@@ -1391,28 +1360,26 @@ async def edit_card(callback: CallbackQuery, state: FSMContext):
     await state.set_state(CardInfoStates.waiting_card)
 
 @router.callback_query(EditProfileStates.waiting_bank, F.data.startswith("bank_"))
-async def edit_bank(callback: CallbackQuery, state: FSMContext):
+async def edit_bank(callback: CallbackQuery, state: FSMContext, user: dict, is_admin: bool):
     await callback.answer()
     bank = callback.data.replace("bank_","")
     if bank == "Другой":
         await callback.message.edit_text("🏦 Введите название банка:")
         await state.set_state(EditProfileStates.waiting_bank_name); return
     data = await state.get_data()
-    user = db.get_user_by_telegram_id(callback.from_user.id)
-    db.update_user(user['id'], card_number=data['card_number'], bank=bank)
+    await adb.update_user(user['id'], card_number=data['card_number'], bank=bank)
     await state.clear()
     await callback.message.edit_text(f"✅ Карта: {bank}")
-    await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(_adm(callback.from_user.id)))
+    await callback.message.answer("Меню:", reply_markup=get_main_menu_keyboard(is_admin))
 
 @router.message(EditProfileStates.waiting_bank_name)
-async def edit_bank_manual(message: Message, state: FSMContext):
+async def edit_bank_manual(message: Message, state: FSMContext, user: dict, is_admin: bool):
     bank = message.text.strip()
     if len(bank) < 2 or len(bank) > 30: await message.answer("❌ 2-30 символов"); return
     data = await state.get_data()
-    user = db.get_user_by_telegram_id(message.from_user.id)
-    db.update_user(user['id'], card_number=data['card_number'], bank=bank)
+    await adb.update_user(user['id'], card_number=data['card_number'], bank=bank)
     await state.clear()
-    await message.answer(f"✅ Карта: {bank}", reply_markup=get_main_menu_keyboard(_adm(message.from_user.id)))
+    await message.answer(f"✅ Карта: {bank}", reply_markup=get_main_menu_keyboard(is_admin))
 
 
 # ==================== NOTIFICATIONS ====================
@@ -1422,10 +1389,9 @@ async def notify_start(callback: CallbackQuery, state: FSMContext):
     await callback.message.edit_text("🔔 <b>Уведомление</b>:", reply_markup=get_notify_keyboard(), parse_mode="HTML")
 
 @router.callback_query(F.data == "notify_any")
-async def notify_any(callback: CallbackQuery, state: FSMContext):
+async def notify_any(callback: CallbackQuery, state: FSMContext, user: dict):
     await callback.answer()
-    user = db.get_user_by_telegram_id(callback.from_user.id)
-    db.create_spot_notification(user['id'])
+    await adb.create_spot_notification(user['id'])
     await callback.message.edit_text("✅ Уведомим!")
 
 @router.callback_query(F.data == "notify_date")
@@ -1435,15 +1401,14 @@ async def notify_date(callback: CallbackQuery, state: FSMContext):
     await state.set_state(NotifyStates.waiting_date)
 
 @router.callback_query(NotifyStates.waiting_date, F.data.startswith("ndate_"))
-async def ndate(callback: CallbackQuery, state: FSMContext):
+async def ndate(callback: CallbackQuery, state: FSMContext, user: dict):
     await callback.answer()
     dv = callback.data.replace("ndate_","")
     if dv in ("manual","all"): return
-    user = db.get_user_by_telegram_id(callback.from_user.id)
     ok, _ = validate_date(dv)
     if not ok: return
     date_obj = datetime.strptime(dv, "%d.%m.%Y")
-    db.create_spot_notification(user['id'], desired_date=date_obj.strftime("%Y-%m-%d"), notify_any=False)
+    await adb.create_spot_notification(user['id'], desired_date=date_obj.strftime("%Y-%m-%d"), notify_any=False)
     await state.clear()
     await callback.message.edit_text(f"✅ Уведомим на {dv}!")
 
@@ -1458,12 +1423,11 @@ class EditBooking(StatesGroup):
 
 @router.message(F.text == "⏱ Ближайшие слоты")
 async def nearest_slots(message: Message, state: FSMContext):
-    if await _check_ban(message): 
-        return
-    slots = db.get_nearest_free_slots(limit=12, days=AVAILABILITY_LOOKAHEAD_DAYS)
+    slots = await adb.get_nearest_free_slots(limit=12, days=AVAILABILITY_LOOKAHEAD_DAYS)
     if not slots:
         await message.answer("Сейчас нет доступных слотов.")
         return
+    ratings = await adb.get_spot_ratings([s['spot_id'] for s in slots])
     lines = ["⏱ <b>Ближайшие слоты</b> (без адреса до подтверждения):\n"]
     for s in slots:
         st = datetime.fromisoformat(str(s["start_time"]))
@@ -1471,7 +1435,7 @@ async def nearest_slots(message: Message, state: FSMContext):
         dur = (en - st).total_seconds() / 3600
         price = s.get("price_per_hour", 0) * dur
         lines.append(
-            f"🏠 {s.get('spot_number','')} | 📅 {format_datetime(st)} — {format_datetime(en)} | 💰 {price:.0f}₽"
+            f"🏠 {s.get('spot_number','')}{format_rating(ratings.get(s['spot_id']))} | 📅 {format_datetime(st)} — {format_datetime(en)} | 💰 {price:.0f}₽"
         )
     await message.answer("\n".join(lines), parse_mode="HTML")
 
@@ -1480,7 +1444,7 @@ async def nearest_slots(message: Message, state: FSMContext):
 async def booking_cancel_cb(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     bid = int(callback.data.replace("booking_cancel_", ""))
-    ok = db.cancel_booking(bid)
+    ok = await adb.cancel_booking(bid)
     if ok:
         await callback.message.edit_text(f"❌ Бронь #{bid} отменена.")
     else:
@@ -1490,7 +1454,7 @@ async def booking_cancel_cb(callback: CallbackQuery, state: FSMContext):
 async def booking_paid_cb(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     bid = int(callback.data.replace("booking_paid_", ""))
-    st = db.get_booking_status(bid)
+    st = await adb.get_booking_status(bid)
     if not st:
         await callback.message.answer("❌ Бронь не найдена.")
         return
@@ -1511,9 +1475,9 @@ async def booking_paid_cb(callback: CallbackQuery, state: FSMContext):
     )
 
 @router.message(PayReceiptStates.waiting_receipt)
-async def receipt_upload(message: Message, state: FSMContext):
+async def receipt_upload(message: Message, state: FSMContext, is_admin: bool):
     if _cancel_check(message.text):
-        await cancel_msg(message, state)
+        await cancel_msg(message, state, is_admin)
         return
     data = await state.get_data()
     bid = data.get("paid_booking_id")
@@ -1534,8 +1498,8 @@ async def receipt_upload(message: Message, state: FSMContext):
         await message.answer("❌ Пришлите фото или файл чека (документ).")
         return
 
-    ok = db.mark_booking_paid(bid)
-    b = db.get_booking_full(bid)
+    ok = await adb.mark_booking_paid(bid)
+    b = await adb.get_booking_full(bid)
 
     # Отправляем админам
     caption = f"🧾 <b>Чек по брони #{bid}</b>\n"
@@ -1549,7 +1513,7 @@ async def receipt_upload(message: Message, state: FSMContext):
             caption += f"👤 {b.get('customer_name','')}\n"
         caption += f"📍 {b.get('address','')}"
     kb = admin_payment_review_keyboard(bid)
-    for adm in db.get_admins():
+    for adm in await adb.get_admins():
         try:
             if kind == "photo":
                 await message.bot.send_photo(adm["telegram_id"], file_id, caption=caption, reply_markup=kb, parse_mode="HTML")
@@ -1588,12 +1552,7 @@ from aiogram import F
 async def iron_spot_confirm_yes(callback: CallbackQuery):
     await callback.answer()  # stop Telegram spinner immediately
     cid = callback.data.split(":", 1)[1]
-    try:
-        from database import create_spot, add_availability, create_spot_confirm, get_slot_confirm, delete_slot_confirm  # noqa
-    except Exception:
-        from database import get_slot_confirm, delete_slot_confirm  # type: ignore
-
-    data = get_slot_confirm(cid)
+    data = await adb.get_slot_confirm(cid)
     if not data:
         await callback.message.answer("⚠️ Кнопка устарела. Нажмите /start и попробуйте снова.")
         return
@@ -1614,7 +1573,7 @@ async def iron_spot_confirm_yes(callback: CallbackQuery):
         # create_spot may return spot_id; if spot already exists for user, fallback logic should be inside create_spot in your code.
         spot_id = create_spot(data["user_id"], data["spot_number"])
         add_availability(spot_id, data["start_time"], data["end_time"], data["price"])
-        delete_slot_confirm(cid)
+        await adb.delete_slot_confirm(cid)
         await callback.message.answer("✅ Слот добавлен!")
     except Exception as e:
         await callback.message.answer(f"❌ Ошибка при создании слота: {e}")
@@ -1623,10 +1582,9 @@ async def iron_spot_confirm_yes(callback: CallbackQuery):
 async def iron_spot_confirm_no(callback: CallbackQuery):
     await callback.answer()
     cid = callback.data.split(":", 1)[1]
-    from database import delete_slot_confirm, get_slot_confirm
-    data = get_slot_confirm(cid)
+    data = await adb.get_slot_confirm(cid)
     if data and callback.from_user.id == data["user_id"]:
-        delete_slot_confirm(cid)
+        await adb.delete_slot_confirm(cid)
     await callback.message.answer("Ок, отменил. Начните заново: /start")
 
 @router.callback_query(F.data.in_({"spot_confirm_yes", "spot_confirm_no"}))
@@ -136,11 +136,14 @@ def mask_card(card):
     if card and len(card) >= 4: return f"****{card[-4:]}"
     return "—"
 
-def now_local():
-    """Текущее локальное время в TZ из config.TIMEZONE (naive datetime)."""
+def now_local(precise=False):
+    """Текущее локальное время в TZ из config.TIMEZONE (naive datetime).
+
+    precise=True — с секундами (сроки планировщика и банов)."""
     from config import TIMEZONE
     tz = ZoneInfo(TIMEZONE)
-    return datetime.now(tz).replace(tzinfo=None, second=0, microsecond=0)
+    now = datetime.now(tz).replace(tzinfo=None)
+    return now if precise else now.replace(second=0, microsecond=0)
 
 def normalize_dt(dt: datetime) -> datetime:
     """Нормализует datetime: обнуляет секунды/микросекунды."""
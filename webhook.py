@@ -0,0 +1,80 @@
+"""
+Webhook-режим ParkingBot (BOT_MODE=webhook)
+
+aiohttp-сервер на WEBAPP_HOST:WEBAPP_PORT принимает апдейты на WEBHOOK_PATH
+(обычно за локальным reverse proxy). Запросы без верного заголовка
+X-Telegram-Bot-Api-Secret-Token отклоняются (401). Одновременно
+обрабатывается не больше WEBHOOK_MAX_CONCURRENT апдейтов: сверх лимита
+ответ Telegram задерживается, а не копятся задачи в памяти.
+
+Локальная проверка записанным апдейтом (WEBHOOK_URL пустой — setWebhook не вызывается):
+
+    BOT_MODE=webhook WEBHOOK_SECRET=test python main.py
+    curl -X POST http://127.0.0.1:8080/webhook -H 'Content-Type: application/json' \\
+         -H 'X-Telegram-Bot-Api-Secret-Token: test' -d @tests/updates/message_start.json
+
+То же без сервера и Telegram — tests/test_webhook.py (aiohttp test client).
+"""
+import asyncio
+import logging
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from config import (WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBAPP_HOST, WEBAPP_PORT,
+                    WEBHOOK_MAX_CONCURRENT)
+
+logger = logging.getLogger(__name__)
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Обработка апдейтов в фоне, не больше max_concurrent одновременно."""
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, max_concurrent=WEBHOOK_MAX_CONCURRENT, **kwargs):
+        super().__init__(dispatcher, bot, handle_in_background=True, **kwargs)
+        self._slots = asyncio.Semaphore(max_concurrent)
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        # Слот берём до ответа: при перегрузке Telegram ждёт ответа и сам притормаживает
+        await self._slots.acquire()
+        try:
+            update = await request.json(loads=bot.session.json_loads)
+        except Exception:
+            self._slots.release()
+            return web.Response(status=400, text="Bad update")
+        task = asyncio.create_task(self._background_feed_update(bot=bot, update=update))
+        self._background_feed_update_tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    def _task_done(self, task):
+        self._background_feed_update_tasks.discard(task)
+        self._slots.release()
+        if not task.cancelled() and task.exception():
+            logger.error(f"Webhook update error: {task.exception()}")
+
+
+def build_app(dp: Dispatcher, bot: Bot) -> web.Application:
+    app = web.Application()
+    BoundedRequestHandler(dp, bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    """Запускает сервер и, если задан WEBHOOK_URL, регистрирует webhook в Telegram."""
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET is required for BOT_MODE=webhook")
+    runner = web.AppRunner(build_app(dp, bot))
+    await runner.setup()
+    await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+    logger.info(f"Webhook server on {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+    if WEBHOOK_URL:
+        await bot.set_webhook(WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                              allowed_updates=dp.resolve_used_update_types(),
+                              max_connections=min(max(WEBHOOK_MAX_CONCURRENT, 1), 100))
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()